@@ -1,70 +1,95 @@
-from flask import Flask, request, jsonify
+from flask import Flask, g, request, jsonify, Response, send_file, stream_with_context
 import os
-import cv2
-import tempfile
+import atexit
 import base64
+import random
 from flask_cors import CORS
-import firebase_admin
-from firebase_admin import credentials, storage, firestore
 import uuid
-import json
-from PIL import Image
-import io
 import sys
-import numpy as np
-import torch
-from torchvision.transforms import functional as F
-from torchvision.models.detection import maskrcnn_resnet50_fpn
+import time
 import urllib.parse
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 
-# Add the current directory to the path to ensure module imports work
+# Add the current directory and the scripts directory to the path to ensure module imports work
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts'))
 
-# Try to import the MaskRCNN module
-try:
-    from test_maskrcnn import load_model, analyze_image
-    maskrcnn_import_successful = True
-    print("Successfully imported test_maskrcnn module")
-except ImportError as e:
-    print(f"Warning: Could not import test_maskrcnn module: {e}")
-    maskrcnn_import_successful = False
+# Only lightweight modules are imported here. torch, torchvision, cv2 and
+# firebase_admin are imported by the startup sequence (see start_server)
+# so the server can answer health checks while the model loads.
+from startup import Startup
+import metrics
+import cloud_client
+from cloud_client import CloudUnavailable
+from metrics import observe_stage, stage
+from batching import InferenceBatcher
+from result_cache import ResultCache, file_fingerprint, make_cache_key
+from profiles import DEFAULT_PROFILE, INFERENCE_PROFILES, get_profile
+from uploads import UploadManager
+from image_store import DEFAULT_IMAGE_STORE_DIR, ImageStore
+from sample_cache import DEFAULT_SAMPLE_CACHE_DIR, BlobCache, TTLCache
+from sample_gallery import DEFAULT_GALLERY_DIR, SampleGallery
+from sample_index import SHARED_OWNER, SampleIndex
+from scan_repository import ScanRepository
+from batch_analysis import iter_archive_images, iter_uploaded_images, spool_upload, stream_ndjson
+from profiling import DEFAULT_TRACE_DIR, TraceStore, run_profiled
+
+startup = Startup()
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
-# Initialize Firebase
-cred_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'service-account.json')
-try:
-    cred = credentials.Certificate(cred_path)
-    # Check if app is already initialized
+# Firebase clients, set by init_firebase during startup
+db = None
+bucket = None
+sample_index = None
+scan_repository = None
+
+def init_firebase():
+    """Initialize Firebase, continuing without it if anything fails"""
+    global db, bucket, upload_manager, sample_index, scan_repository
+    
+    cred_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'service-account.json')
     try:
-        firebase_admin.get_app()
-    except ValueError:
-        firebase_admin.initialize_app(cred, {
-            'storageBucket': 'vertex-ai-436310.firebasestorage.app'  # Firebase storage bucket
-        })
-    db = firestore.client()
-    bucket = storage.bucket()
-    print("Firebase initialized successfully!")
-except Exception as e:
-    print(f"Firebase initialization error: {e}")
-    # Continue without Firebase if there's an error
-    db = None
-    bucket = None
+        # Shared clients with a sized connection pool, deadlines, retries and
+        # a circuit breaker (see cloud_client.py)
+        cloud_client.configure(pool_size=CLOUD_HTTP_POOL_SIZE, max_attempts=CLOUD_MAX_ATTEMPTS,
+                               deadlines=CLOUD_DEADLINES, failure_threshold=CLOUD_BREAKER_FAILURES,
+                               reset_timeout=CLOUD_BREAKER_RESET_SECONDS)
+        db, bucket = cloud_client.shared().connect(
+            cred_path, 'vertex-ai-436310.firebasestorage.app')  # Firebase storage bucket
+        upload_manager = UploadManager(bucket, max_workers=UPLOAD_WORKERS, max_attempts=UPLOAD_MAX_ATTEMPTS)
+        sample_index = SampleIndex(db, cache_ttl=SAMPLE_INDEX_TTL)
+        scan_repository = ScanRepository(db, flush_interval=SCAN_WRITE_FLUSH_INTERVAL,
+                                         cache_ttl=HISTORY_CACHE_TTL)
+        # Commit the scans still queued when the server exits
+        atexit.register(scan_repository.close)
+        print("Firebase initialized successfully!")
+    except Exception as e:
+        print(f"Firebase initialization error: {e}")
+        # Continue without Firebase if there's an error
+        db = None
+        bucket = None
 
 # Fallback function to load model directly if test_maskrcnn import fails
-def fallback_load_model(model_path=None):
+def fallback_load_model(model_path=None, profile=None):
     """
     Fallback function to load the tumor detection model
     """
+    from checkpoints import build_maskrcnn, build_on_meta, load_weights
+    
     if model_path is None:
         model_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 
                               'model', 'maskrcnn_tumor.pth')
     
-    model = maskrcnn_resnet50_fpn(num_classes=2)  # 1 class (tumor) + background
+    model = build_on_meta(build_maskrcnn,
+                          num_classes=2,  # 1 class (tumor) + background
+                          **get_profile(profile))
     
     try:
-        model.load_state_dict(torch.load(model_path, map_location=torch.device('cpu')))
+        load_weights(model, model_path)
         model.eval()  # Set the model to evaluation mode
         print(f"Model loaded successfully from {model_path}")
         return model
@@ -73,25 +98,44 @@ def fallback_load_model(model_path=None):
         return None
 
 # Fallback function for image analysis if test_maskrcnn import fails
-def fallback_analyze_image(model, image_path):
+def fallback_analyze_image(model, image_path, predict=None, conf_thresh=0.7, segmentation=False):
     """
-    Fallback function to analyze an image with the model
+    Fallback function to analyze an image file with the model
     """
-    # Load and preprocess the image
+    import cv2
+    
     image = cv2.imread(image_path)
     if image is None:
         raise ValueError("Failed to load image")
-        
-    image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    image_tensor = F.to_tensor(image_rgb)
-    image_tensor = image_tensor.unsqueeze(0)  # Add batch dimension
+
+    return fallback_analyze_image_array(model, image, predict=predict, conf_thresh=conf_thresh,
+                                        segmentation=segmentation)
+
+# Fallback function for analysis of an already decoded BGR image
+def fallback_analyze_image_array(model, image, predict=None, conf_thresh=0.7, segmentation=False):
+    """
+    Fallback function to analyze a decoded BGR image with the model
+    (boxes only: segmentation is accepted for compatibility but not drawn)
+    """
+    import cv2
+    import numpy as np
+    from torchvision.transforms import functional as F
+    from detection import detect
+    from findings import summarize_detections
+    
+    with stage('to_tensor'):
+        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        image_tensor = F.to_tensor(image_rgb)
 
     # Make predictions
-    with torch.no_grad():
-        predictions = model(image_tensor)
+    if predict is not None:
+        pred = predict(image_tensor)
+    else:
+        # Boxes only: skip the mask head entirely
+        predictions = detect(model, [image_tensor], with_masks=False)
 
-    # Get the prediction
-    pred = predictions[0]
+        # Get the prediction
+        pred = predictions[0]
 
     # Initialize results
     results = {
@@ -105,79 +149,521 @@ def fallback_analyze_image(model, image_path):
     # Convert image back to BGR for OpenCV operations
     output_image = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2BGR)
 
-    # Extract predictions
-    boxes = pred['boxes'].cpu().numpy()
-    scores = pred['scores'].cpu().numpy()
-    conf_thresh = 0.7
-    valid = scores > conf_thresh
+    # Same findings as analyze_image_array, from the boxes alone
+    findings, _ = summarize_detections(pred['boxes'].cpu(), pred['scores'].cpu(), image.shape[:2], conf_thresh)
 
-    if np.any(valid):
-        best_idx = np.argmax(scores[valid])
-        best_box = boxes[valid][best_idx].astype(int)
+    if findings:
         box_color = (153, 159, 250)  # Light purple
-        cv2.rectangle(output_image, (best_box[0], best_box[1]), (best_box[2], best_box[3]), box_color, 2)
-        
-        # Calculate tumor size
-        width_px = best_box[2] - best_box[0]
-        height_px = best_box[3] - best_box[1]
-        size_px = max(width_px, height_px)
-        size_cm = (size_px / 100.0) * 2.5  # Approximate conversion
+        corners = np.array([finding['box'] for finding in findings]).round().astype(np.int32)
+        outlines = corners[:, [[0, 1], [2, 1], [2, 3], [0, 3]]]
+        cv2.polylines(output_image, list(outlines), True, box_color, 2)
         
-        # Simple tumor type classification
-        if size_cm < 2.0:
-            tumor_type = "Meningioma"
-        elif size_cm < 3.0:
-            tumor_type = "Glioma"
-        else:
-            tumor_type = "Pituitary"
-            
-        confidence = float(scores[valid][best_idx])
-        
-        # Update results
+        # The top-level fields describe the most confident finding
+        best = findings[0]
         results = {
             'hasTumor': True,
-            'confidence': confidence,
-            'tumorSize': f"{size_cm:.1f} cm",
-            'tumorType': tumor_type,
-            'tumorLocation': 'Frontal Lobe',
+            'confidence': best['confidence'],
+            'tumorSize': f"{best['sizeCm']:.1f} cm",
+            'tumorType': best['tumorType'],
+            'tumorLocation': best['tumorLocation'],
+            'findings': findings,
         }
 
     return results, output_image
 
-# Load the model using the appropriate function
 MODEL_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'model', 'maskrcnn_tumor.pth')
-if maskrcnn_import_successful:
-    model = load_model(MODEL_PATH)
-    analyze_func = analyze_image
-    print("Using imported analyze_image function")
-else:
-    model = fallback_load_model(MODEL_PATH)
-    analyze_func = fallback_analyze_image
-    print("Using fallback analyze_image function")
-
-def process_image(image_path):
-    """Process the image with the MaskRCNN model and return the results"""
+
+# Inference backend: eager, torchscript, compile or onnx. Exported backends
+# read their artifact (see scripts/export_model.py) instead of the .pth weights.
+INFERENCE_BACKEND = os.environ.get('INFERENCE_BACKEND', 'eager')
+INFERENCE_BACKEND_PATH = os.environ.get('INFERENCE_BACKEND_PATH') or None
+needs_eager_model = INFERENCE_BACKEND in ('eager', 'compile')
+
+# Inference profile used when a request doesn't name one. Exported backends
+# (torchscript, onnx) only serve the profile they were exported with.
+INFERENCE_PROFILE = os.environ.get('INFERENCE_PROFILE', DEFAULT_PROFILE)
+get_profile(INFERENCE_PROFILE)
+
+# Minimum detection score for a region to be reported as a tumor
+DETECTION_CONF_THRESH = float(os.environ.get('DETECTION_CONF_THRESH', '0.7'))
+
+# Result cache settings: the in-memory tier is bounded by RESULT_CACHE_MAX_MB,
+# the on-disk tier is only enabled when RESULT_CACHE_DIR is set
+RESULT_CACHE_MAX_MB = float(os.environ.get('RESULT_CACHE_MAX_MB', '64'))
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR') or None
+RESULT_CACHE_DISK_MAX_MB = float(os.environ.get('RESULT_CACHE_DISK_MAX_MB', '1024'))
+
+result_cache = ResultCache(max_bytes=int(RESULT_CACHE_MAX_MB * 1024 * 1024),
+                           disk_dir=RESULT_CACHE_DIR,
+                           disk_max_bytes=int(RESULT_CACHE_DISK_MAX_MB * 1024 * 1024))
+
+def parse_flag(value):
+    """Interpret a form field such as 'true' / '1' / 'yes' as a boolean"""
+    return str(value or '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+# Micro-batching settings: concurrent requests are collected for up to
+# INFERENCE_MAX_WAIT_MS and run through the model together
+INFERENCE_MAX_BATCH_SIZE = int(os.environ.get('INFERENCE_MAX_BATCH_SIZE', '4'))
+INFERENCE_MAX_WAIT_MS = float(os.environ.get('INFERENCE_MAX_WAIT_MS', '10'))
+
+# Production serving mode: fork this many inference worker processes that
+# share the loaded weights. 0 runs inference in the server process.
+INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', '0'))
+
+# CPU threads: the cores this process may use (affinity mask, cgroup quota)
+# are split between the SERVER_PROCESSES x INFERENCE_WORKERS processes running
+# forward passes, unless INFERENCE_THREADS sets the intra-op threads per
+# process. INFERENCE_PIN_CPUS gives each worker its own cores and
+# INFERENCE_CALIBRATE_THREADS times a few thread counts at startup and keeps
+# the fastest.
+SERVER_PROCESSES = int(os.environ.get('SERVER_PROCESSES', '1'))
+INFERENCE_THREADS = int(os.environ.get('INFERENCE_THREADS', '0')) or None
+INFERENCE_INTEROP_THREADS = int(os.environ.get('INFERENCE_INTEROP_THREADS', '0')) or None
+INFERENCE_PIN_CPUS = parse_flag(os.environ.get('INFERENCE_PIN_CPUS'))
+INFERENCE_CALIBRATE_THREADS = parse_flag(os.environ.get('INFERENCE_CALIBRATE_THREADS'))
+
+# Warm-up before reporting ready: one forward pass per profile, input size
+# and mask setting (and per worker process). Sizes are "HxW" or "N" for NxN,
+# comma separated; an empty value skips the warm-up.
+def parse_image_sizes(value):
+    """Parse e.g. '512,384x640' into [(512, 512), (384, 640)]"""
+    sizes = []
+    for size in value.split(','):
+        size = size.strip().lower()
+        if size:
+            height, _, width = size.partition('x')
+            sizes.append((int(height), int(width or height)))
+    return sizes
+
+WARMUP_IMAGE_SIZES = parse_image_sizes(os.environ.get('WARMUP_IMAGE_SIZES', '512'))
+
+# Set by load_inference during startup
+model = None
+analyze_func = None
+model_fingerprint = 'unknown'
+inference_backends = {}
+worker_pool = None
+batchers = {}
+thread_settings = {}
+
+def make_forward(profile):
+    """
+    Forward function running one list of CHW image tensors with a profile
+
+    Masks are only computed for images that asked for segmentation, and only
+    for their detections above DETECTION_CONF_THRESH. With a trace_path the
+    forward pass runs under the torch profiler (see profiling.py).
+    """
+    if worker_pool is not None:
+        def pool_forward(image_tensors, with_masks, trace_path=None):
+            kwargs = {'trace_path': trace_path} if trace_path else {}
+            return worker_pool.forward(image_tensors, profile, with_masks=with_masks,
+                                       mask_score_thresh=DETECTION_CONF_THRESH, **kwargs)
+        return pool_forward
+
+    def model_forward(image_tensors, with_masks, trace_path=None):
+        if profile not in inference_backends:
+            raise RuntimeError("Model not loaded")
+        forward = lambda: inference_backends[profile](image_tensors, with_masks=with_masks,
+                                                      mask_score_thresh=DETECTION_CONF_THRESH)
+        return run_profiled(forward, trace_path) if trace_path else forward()
+    return model_forward
+
+def load_inference():
+    """
+    Load the model and set up the backends, worker pool and batchers
+
+    Raises:
+        RuntimeError: If no inference backend could be created
+    """
+    global model, analyze_func, model_fingerprint, inference_backends, worker_pool, batchers
+    global thread_settings, INFERENCE_BACKEND_PATH
+
+    with startup.phase('import torch'):
+        import torch
+        import torchvision
+        import cv2
+
+    with startup.phase('configure threads'):
+        from cpu_threads import apply_threads, plan_threads
+
+        processes = SERVER_PROCESSES * max(1, INFERENCE_WORKERS)
+        # Pinned core sets are only disjoint when one server owns all the workers
+        pin = INFERENCE_PIN_CPUS and INFERENCE_WORKERS > 0 and SERVER_PROCESSES == 1
+        if INFERENCE_PIN_CPUS and not pin:
+            print("INFERENCE_PIN_CPUS needs INFERENCE_WORKERS and a single server process, not pinning")
+        thread_plans = plan_threads(processes, INFERENCE_THREADS, INFERENCE_INTEROP_THREADS, pin=pin)
+        if INFERENCE_WORKERS > 0:
+            # Applied (and calibrated) by each worker after the fork
+            for plan in thread_plans:
+                plan['calibrationSize'] = calibration_image_size() if INFERENCE_CALIBRATE_THREADS else None
+        else:
+            apply_threads(thread_plans[0])
+            thread_settings = {'intraOpThreads': torch.get_num_threads(),
+                               'interOpThreads': torch.get_num_interop_threads()}
+        print(f"Inference threads: {thread_plans[0]['intraOpThreads']} intra-op, "
+              f"{thread_plans[0]['interOpThreads']} inter-op per process, {processes} processes")
+
+    with startup.phase('import inference modules'):
+        from inference_backends import create_profile_backends, default_artifact_path
+        from workers import InferenceWorkerPool
+        from checkpoints import weights_fingerprint
+
+        # Try to import the MaskRCNN module
+        try:
+            from test_maskrcnn import load_model, analyze_image_array
+            maskrcnn_import_successful = True
+            print("Successfully imported test_maskrcnn module")
+        except ImportError as e:
+            print(f"Warning: Could not import test_maskrcnn module: {e}")
+            maskrcnn_import_successful = False
+
+    INFERENCE_BACKEND_PATH = INFERENCE_BACKEND_PATH or default_artifact_path(MODEL_PATH, INFERENCE_BACKEND)
+
+    # Load the model using the appropriate function
+    with startup.phase('load model'):
+        if maskrcnn_import_successful:
+            model = load_model(MODEL_PATH, profile=INFERENCE_PROFILE) if needs_eager_model else None
+            analyze_func = analyze_image_array
+            print("Using imported analyze_image function")
+        else:
+            model = fallback_load_model(MODEL_PATH, profile=INFERENCE_PROFILE) if needs_eager_model else None
+            analyze_func = fallback_analyze_image_array
+            print("Using fallback analyze_image function")
+
+    with startup.phase('fingerprint model'):
+        # Eager weights are fingerprinted by their tensors (so converting the
+        # checkpoint keeps the result cache), exported artifacts by their bytes
+        model_fingerprint = (weights_fingerprint(MODEL_PATH) if needs_eager_model
+                             else file_fingerprint(INFERENCE_BACKEND_PATH))
+
+    # One backend per available profile, all sharing the same weights
+    with startup.phase('create backends'):
+        if model is None and needs_eager_model:
+            raise RuntimeError(f"Model could not be loaded from {MODEL_PATH}")
+        inference_backends = create_profile_backends(INFERENCE_BACKEND, model, INFERENCE_BACKEND_PATH,
+                                                     INFERENCE_PROFILES, INFERENCE_PROFILE)
+        print(f"Using {INFERENCE_BACKEND} inference backend with profiles: {', '.join(inference_backends)}")
+
+    if INFERENCE_WORKERS > 0:
+        with startup.phase('start workers'):
+            # Fork before any forward pass runs in this process
+            worker_pool = InferenceWorkerPool(inference_backends, INFERENCE_WORKERS,
+                                              thread_plans=thread_plans[:INFERENCE_WORKERS])
+
+    # Images with different profiles are resized differently and can't share a
+    # forward pass, so each profile gets its own batching queue
+    batchers = {
+        profile: InferenceBatcher(make_forward(profile),
+                                  max_batch_size=INFERENCE_MAX_BATCH_SIZE,
+                                  max_wait_ms=INFERENCE_MAX_WAIT_MS,
+                                  concurrency=worker_pool.num_workers if worker_pool else 1)
+        for profile in inference_backends
+    }
+    print(f"Inference batching enabled (max batch size {INFERENCE_MAX_BATCH_SIZE}, "
+          f"max wait {INFERENCE_MAX_WAIT_MS} ms)")
+
+def calibration_image_size():
+    """(height, width) of the image thread calibration times, the first warm-up size"""
+    return WARMUP_IMAGE_SIZES[0] if WARMUP_IMAGE_SIZES else (512, 512)
+
+def calibrate_inference_threads():
+    """
+    Keep the fastest intra-op thread count for in-process inference
+
+    Workers calibrate themselves, see workers.py.
+    """
+    import torch
+    from cpu_threads import calibrate_threads, calibration_candidates
+
+    backend = inference_backends.get(INFERENCE_PROFILE) or next(iter(inference_backends.values()))
+    image = torch.rand(3, *calibration_image_size())
+    threads, timings = calibrate_threads(lambda: backend([image], with_masks=False),
+                                         calibration_candidates(thread_settings['intraOpThreads']))
+    thread_settings.update(intraOpThreads=threads, calibration=timings)
+    print(f"Calibrated inference threads to {threads}: {timings}")
+
+def warm_up():
+    """
+    Run a forward pass per profile, warm-up size and mask setting
+
+    The first forward at a new input size pays for kernel selection and
+    allocator growth; doing it here keeps that off the first requests. With
+    a worker pool, every worker is warmed by running the passes concurrently.
+    """
+    import torch
+
+    concurrency = worker_pool.num_workers if worker_pool else 1
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for profile in batchers:
+            forward = make_forward(profile)
+            for height, width in WARMUP_IMAGE_SIZES:
+                image = torch.rand(3, height, width)
+                for with_masks in (False, True):
+                    list(executor.map(lambda _: forward([image], [with_masks]), range(concurrency)))
+    print(f"Warmed up profiles {', '.join(batchers)} at sizes "
+          f"{', '.join(f'{h}x{w}' for h, w in WARMUP_IMAGE_SIZES)}")
+
+def decode_image(image_bytes):
+    """Decode encoded image bytes (JPEG, PNG, ...) into a BGR array"""
+    import cv2
+    import numpy as np
+
+    buffer = np.frombuffer(image_bytes, dtype=np.uint8)
+    image = cv2.imdecode(buffer, cv2.IMREAD_COLOR) if buffer.size else None
+    if image is None:
+        raise ValueError("Failed to load image")
+    return image
+
+def encode_image(image):
+    """Encode a BGR array as JPEG bytes"""
+    import cv2
+
+    success, buffer = cv2.imencode('.jpg', image)
+    if not success:
+        raise ValueError("Failed to encode processed image")
+    return buffer.tobytes()
+
+def resolve_profile(profile):
+    """
+    Pick the inference profile for a request
+
+    Raises:
+        ValueError: If the profile is unknown or not served by this backend
+    """
+    profile = profile or INFERENCE_PROFILE
+    get_profile(profile)
+    if profile not in batchers:
+        raise ValueError(f"Inference profile '{profile}' is not available with the "
+                         f"{INFERENCE_BACKEND} backend (available: {', '.join(batchers)})")
+    return profile
+
+def detection_settings(profile, segmentation):
+    """The settings besides the model and the image that a result depends on"""
+    return {'confThresh': DETECTION_CONF_THRESH, 'backend': INFERENCE_BACKEND,
+            'profile': profile, 'segmentation': segmentation}
+
+def process_image_bytes(image_bytes, profile=None, segmentation=False, trace=None):
+    """
+    Process an encoded image with the MaskRCNN model entirely in memory
+
+    Args:
+        image_bytes (bytes): Encoded image data
+        profile (str, optional): Inference profile name, see profiles.py
+        segmentation (bool): Whether to compute the tumor mask
+        trace (tuple, optional): (trace_id, trace_path) from pick_trace to
+            profile this request's forward pass. The result cache and the
+            batching queue are skipped so the trace covers this image alone.
+
+    Returns:
+        tuple: (result (dict), processed_image_bytes (bytes)) where the
+            processed image is JPEG encoded
+    """
+    profile = resolve_profile(profile)
+    batch_info = {}
+
+    def predict(image_tensor):
+        if trace is not None:
+            started_at = time.perf_counter()
+            prediction = make_forward(profile)([image_tensor], [segmentation], trace_path=trace[1])[0]
+            batch_info.update(batchSize=1, queueDepth=0, queueWaitMs=0.0,
+                              inferenceMs=round((time.perf_counter() - started_at) * 1000, 2))
+            return prediction
+        prediction, info = batchers[profile].submit(image_tensor, with_masks=segmentation)
+        batch_info.update(info)
+        return prediction
+
+    with stage('decode'):
+        image = decode_image(image_bytes)
+
+    # Identical pixels with the same model and settings give the same result
+    with stage('cache_lookup'):
+        cache_key = make_cache_key(image, model_fingerprint, detection_settings(profile, segmentation))
+        cached = result_cache.get(cache_key) if trace is None else None
+    if trace is None:
+        CACHE_LOOKUPS.inc(result='miss' if cached is None else 'hit')
+    if cached is not None:
+        print("Result cache hit, skipping inference")
+        result, processed_image_bytes = cached
+        result['cacheHit'] = True
+        result['profile'] = profile
+        return result, processed_image_bytes
+
     # Use the appropriate analysis function
-    result, processed_image = analyze_func(model, image_path)
-    
-    # Save the processed image
-    output_path = image_path.replace('.', '_processed.')
-    cv2.imwrite(output_path, processed_image)
-    
-    return result, output_path
+    result, processed_image = analyze_func(model, image, predict=predict,
+                                           conf_thresh=DETECTION_CONF_THRESH,
+                                           segmentation=segmentation)
+    with stage('encode'):
+        processed_image_bytes = encode_image(processed_image)
+    result_cache.put(cache_key, result, processed_image_bytes)
 
-def ensure_file_extension(filename):
-    """Ensure the filename has a valid image extension"""
-    valid_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff']
-    
-    # Check if file already has a valid extension
-    if any(filename.lower().endswith(ext) for ext in valid_extensions):
-        return filename
-    
-    # If not, add .jpg as default extension
-    return filename + '.jpg'
+    if trace is not None:
+        trace_id = trace[0]
+        result['profileTrace'] = {'traceId': trace_id, 'url': f"/api/admin/traces/{trace_id}"}
+        print(f"Profiled forward pass written to trace {trace_id}")
+    elif batch_info:
+        # Every request in a batch sees the whole batch's forward time
+        observe_stage('queue_wait', batch_info['queueWaitMs'] / 1000.0)
+        observe_stage('forward', batch_info['inferenceMs'] / 1000.0)
+        BATCH_SIZE.observe(batch_info['batchSize'])
+    result['inference'] = batch_info
+    result['cacheHit'] = False
+    result['profile'] = profile
+    return result, processed_image_bytes
+
+# Background uploads to Firebase Storage: UPLOAD_WORKERS concurrent uploads,
+# each retried up to UPLOAD_MAX_ATTEMPTS times with exponential backoff
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', '4'))
+UPLOAD_MAX_ATTEMPTS = int(os.environ.get('UPLOAD_MAX_ATTEMPTS', '4'))
+upload_manager = None
+
+def parse_deadlines(value):
+    """Parse "operation=seconds,..." (e.g. "storage.upload=30") into a dict"""
+    deadlines = {}
+    for item in value.split(','):
+        if item.strip():
+            operation, seconds = item.split('=', 1)
+            deadlines[operation.strip()] = float(seconds)
+    return deadlines
+
+# Firebase calls: CLOUD_HTTP_POOL_SIZE pooled Storage connections, per-operation
+# deadlines (CLOUD_DEADLINES overrides cloud_client.OPERATION_DEADLINES),
+# CLOUD_MAX_ATTEMPTS attempts on transient errors, and local-only mode for
+# CLOUD_BREAKER_RESET_SECONDS after CLOUD_BREAKER_FAILURES failures in a row
+CLOUD_HTTP_POOL_SIZE = int(os.environ.get('CLOUD_HTTP_POOL_SIZE', '32'))
+CLOUD_MAX_ATTEMPTS = int(os.environ.get('CLOUD_MAX_ATTEMPTS', '3'))
+CLOUD_DEADLINES = parse_deadlines(os.environ.get('CLOUD_DEADLINES', ''))
+CLOUD_BREAKER_FAILURES = int(os.environ.get('CLOUD_BREAKER_FAILURES', '5'))
+CLOUD_BREAKER_RESET_SECONDS = float(os.environ.get('CLOUD_BREAKER_RESET_SECONDS', '30'))
+
+# Processed images are kept in a local store and served by /api/images/<id>;
+# responses carry their URL and only inline base64 when includeImageData is set
+IMAGE_STORE_DIR = os.environ.get('IMAGE_STORE_DIR', DEFAULT_IMAGE_STORE_DIR)
+IMAGE_STORE_MAX_MB = float(os.environ.get('IMAGE_STORE_MAX_MB', '512'))
+image_store = ImageStore(IMAGE_STORE_DIR, max_bytes=int(IMAGE_STORE_MAX_MB * 1024 * 1024))
+# Behind nginx/Apache, let the web server send image files (X-Sendfile)
+app.config['USE_X_SENDFILE'] = parse_flag(os.environ.get('USE_X_SENDFILE'))
+
+# Profiler traces: a request is profiled when it sends X-Profile-Request or is
+# sampled at PROFILE_SAMPLE_RATE (0 to 1). With ADMIN_TOKEN set, both the
+# header and the trace endpoints require a matching X-Admin-Token header.
+TRACE_DIR = os.environ.get('TRACE_DIR', DEFAULT_TRACE_DIR)
+TRACE_MAX_FILES = int(os.environ.get('TRACE_MAX_FILES', '20'))
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+trace_store = TraceStore(TRACE_DIR, max_traces=TRACE_MAX_FILES)
+
+def is_admin():
+    """Whether the request may use the admin features"""
+    return not ADMIN_TOKEN or request.headers.get('X-Admin-Token') == ADMIN_TOKEN
+
+def pick_trace():
+    """
+    Decide whether to profile the current request
+
+    Returns:
+        tuple: (trace_id, trace_path) for process_image_bytes, or None
+    """
+    requested = parse_flag(request.headers.get('X-Profile-Request')) and is_admin()
+    if requested or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE):
+        return trace_store.new_trace()
+    return None
+
+def attach_processed_image(result, processed_image_bytes, host_url, inline=False):
+    """
+    Store the processed image and reference it from the result
+
+    Args:
+        result (dict): Analysis result to update
+        processed_image_bytes (bytes): JPEG encoded processed image
+        host_url (str): Root URL of this server, e.g. request.host_url
+        inline (bool): Also embed the image as a base64 data URI
+    """
+    image_id = image_store.put(processed_image_bytes)
+    result['processedImageId'] = image_id
+    result['processedImageUrl'] = f"{host_url.rstrip('/')}/api/images/{image_id}"
+    if inline:
+        processed_image_b64 = base64.b64encode(processed_image_bytes).decode('utf-8')
+        result['processedImageData'] = f"data:image/jpeg;base64,{processed_image_b64}"
+
+def start_uploads(result, files):
+    """Queue background uploads and point the result at their status endpoint"""
+    if not cloud_client.available():
+        print("Firebase is unavailable, keeping the images local only")
+        return
+    job_id = upload_manager.submit(files)
+    result['uploadJobId'] = job_id
+    result['uploadStatusUrl'] = f"/api/uploads/{job_id}"
+    print(f"Queued {len(files)} uploads as job {job_id}")
+
+# Prometheus metrics served by /metrics. Stage timings are recorded along the
+# request path with metrics.stage(), see tumor_stage_duration_seconds.
+HTTP_REQUESTS = metrics.counter('tumor_http_requests_total', 'HTTP requests by endpoint, method and status',
+                                ['endpoint', 'method', 'status'])
+HTTP_REQUEST_SECONDS = metrics.histogram('tumor_http_request_duration_seconds',
+                                         'HTTP request latency by endpoint', ['endpoint'])
+HTTP_IN_FLIGHT = metrics.gauge('tumor_http_requests_in_flight', 'HTTP requests being handled', ['endpoint'])
+CACHE_LOOKUPS = metrics.counter('tumor_result_cache_lookups_total', 'Result cache lookups by outcome', ['result'])
+BATCH_SIZE = metrics.histogram('tumor_inference_batch_size', 'Images in the forward pass each request ran in',
+                               buckets=(1, 2, 4, 8, 16, 32))
+metrics.gauge('tumor_inference_queue_depth', 'Requests queued or running per inference profile', ['profile'],
+              callback=lambda: {(profile,): batcher.queue_depth() for profile, batcher in batchers.items()})
+metrics.gauge('tumor_ready', '1 once the model is loaded and warmed up', callback=lambda: int(startup.ready))
+metrics.gauge('tumor_process_resident_memory_bytes', 'Resident memory of the server process',
+              callback=metrics.process_rss_bytes)
+metrics.gauge('tumor_worker_resident_memory_bytes', 'Resident memory of each inference worker process', ['worker'],
+              callback=lambda: {(str(worker_id),): metrics.process_rss_bytes(pid) for worker_id, pid
+                                in (worker_pool.worker_pids().items() if worker_pool else [])})
+
+@app.before_request
+def start_request_metrics():
+    g.request_started_at = time.perf_counter()
+    g.metrics_endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    HTTP_IN_FLIGHT.inc(endpoint=g.metrics_endpoint)
+
+@app.after_request
+def record_response_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    endpoint = g.pop('metrics_endpoint', None)
+    if endpoint is None:
+        return
+    HTTP_IN_FLIGHT.dec(endpoint=endpoint)
+    HTTP_REQUEST_SECONDS.observe(time.perf_counter() - g.request_started_at, endpoint=endpoint)
+    HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=g.pop('metrics_status', 500))
+
+@app.route('/metrics', methods=['GET'])
+def metrics_api():
+    """Request, stage, queue and memory metrics in the Prometheus text format"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+def requires_model(view):
+    """Answer inference requests with 503 until startup has finished"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not startup.ready:
+            return (jsonify({'error': 'Model is not ready', 'startup': startup.to_dict()}),
+                    503, {'Retry-After': '5'})
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness: the process is serving requests and startup hasn't failed"""
+    if startup.state == 'failed':
+        return jsonify({'status': 'failed', 'error': startup.error}), 503
+    return jsonify({'status': 'ok', 'state': startup.state})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """Readiness: the model is loaded and warmed up"""
+    return jsonify(startup.to_dict()), 200 if startup.ready else 503
 
 @app.route('/api/analyze', methods=['POST'])
+@requires_model
 def analyze_image_api():
     print("\n===== STARTING BRAIN TUMOR DETECTION =====")
     if 'image' not in request.files:
@@ -191,21 +677,27 @@ def analyze_image_api():
     
     print(f"Image received: {file.filename}")
     
-    # Ensure filename has a valid extension
-    safe_filename = ensure_file_extension(file.filename)
-    print(f"Using filename with extension: {safe_filename}")
+    profile = request.form.get('profile')
+    try:
+        profile = resolve_profile(profile)
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        return jsonify({'error': str(e)}), 400
+    print(f"Using inference profile: {profile}")
     
-    # Save the uploaded file temporarily
-    temp_dir = tempfile.mkdtemp()
-    temp_file_path = os.path.join(temp_dir, safe_filename)
-    file.save(temp_file_path)
-    print(f"Saved to temporary file: {temp_file_path}")
+    # Read the upload straight from the request stream
+    image_bytes = file.read()
+    # Parsing the multipart body happened on first access to request.files
+    observe_stage('upload_receive', time.perf_counter() - g.request_started_at)
+    print(f"Read {len(image_bytes)} bytes from upload")
     
     try:
         # Process the image
         print("\n[STARTING AI ANALYSIS]")
         print("Loading image into model...")
-        result, processed_image_path = process_image(temp_file_path)
+        result, processed_image_bytes = process_image_bytes(
+            image_bytes, profile=profile, segmentation=parse_flag(request.form.get('segmentation')),
+            trace=pick_trace())
         
         print("\n[DETECTION RESULTS]")
         print(f"Tumor detected: {result['hasTumor']}")
@@ -214,18 +706,16 @@ def analyze_image_api():
             print(f"Tumor type: {result['tumorType']}")
             print(f"Tumor size: {result['tumorSize']}")
             print(f"Tumor location: {result['tumorLocation']}")
-        print(f"Processed image saved to: {processed_image_path}")
+        if not result['cacheHit']:
+            print(f"Batch size: {result['inference']['batchSize']}, "
+                  f"queue depth: {result['inference']['queueDepth']}")
         
         # Generate unique ID for identification purposes only (not for auto-saving)
         image_id = str(uuid.uuid4())
         user_id = request.form.get('userId', 'anonymous')
         
-        # Variables to store URLs if Firebase upload is successful
-        original_url = None
-        processed_url = None
-        
         # Only attempt Firebase operations for file uploads if Firebase is initialized
-        if bucket is not None:
+        if upload_manager is not None:
             try:
                 print("\n[UPLOADING TO FIREBASE]")
                 # Create user-specific storage paths
@@ -238,23 +728,14 @@ def analyze_image_api():
                     original_path = f"images/original/{image_id}.jpg"
                     processed_path = f"images/processed/{image_id}.jpg"
                 
-                # Upload original image
+                # Upload both images in the background; the final URLs are
+                # served by /api/uploads/<job_id>
                 print(f"Uploading original image to path: {original_path}")
-                original_blob = bucket.blob(original_path)
-                original_blob.upload_from_filename(temp_file_path)
-                # Make the blob publicly accessible
-                original_blob.make_public()
-                original_url = original_blob.public_url
-                print(f"Original image URL: {original_url}")
-                
-                # Upload processed image
                 print(f"Uploading processed image to path: {processed_path}")
-                processed_blob = bucket.blob(processed_path)
-                processed_blob.upload_from_filename(processed_image_path)
-                # Make the blob publicly accessible
-                processed_blob.make_public()
-                processed_url = processed_blob.public_url
-                print(f"Processed image URL: {processed_url}")
+                start_uploads(result, [
+                    ('original', original_path, image_bytes, file.mimetype or 'image/jpeg'),
+                    ('processed', processed_path, processed_image_bytes, 'image/jpeg'),
+                ])
                 
                 # REMOVED: Auto-saving scan data to Firestore
                 # Now scans will only be saved when user explicitly clicks "Save to Account"
@@ -263,42 +744,310 @@ def analyze_image_api():
                 print(f"Firebase storage error: {firebase_error}")
                 # Continue without Firebase storage
         
-        # Always read the processed image as base64 to return directly to client
-        # This ensures the app works even without Firebase
+        # Serve the processed image from /api/images so the app works even
+        # without Firebase; base64 is only inlined when asked for
         print("\n[PREPARING RESPONSE]")
-        print("Converting processed image to base64...")
-        with open(processed_image_path, "rb") as img_file:
-            processed_image_b64 = base64.b64encode(img_file.read()).decode('utf-8')
+        attach_processed_image(result, processed_image_bytes, request.host_url,
+                               inline=parse_flag(request.form.get('includeImageData')))
         
         # Add data to result
         result['imageId'] = image_id
-        if original_url:
-            result['originalImageUrl'] = original_url
-        if processed_url:
-            result['processedImageUrl'] = processed_url
-        # Always include the processed image data
-        result['processedImageData'] = f"data:image/jpeg;base64,{processed_image_b64}"
-        
-        # Clean up temp files
-        print("\n[CLEANUP]")
-        os.remove(temp_file_path)
-        os.remove(processed_image_path)
-        os.rmdir(temp_dir)
-        print("Temporary files cleaned up")
         
         print("\n===== BRAIN TUMOR DETECTION COMPLETE =====")
-        return jsonify(result)
+        with stage('json'):
+            response = jsonify(result)
+        return response
         
     except Exception as e:
         print(f"ERROR during image processing: {e}")
-        # Clean up temp files in case of error
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
-        if os.path.exists(temp_dir):
-            os.rmdir(temp_dir)
-            
         return jsonify({'error': str(e)}), 500
 
+# Batch analysis: at most BATCH_MAX_IN_FLIGHT images per request are read and
+# queued at once (by default enough to fill every batcher slot), and files
+# larger than BATCH_MAX_FILE_MB are reported instead of analyzed
+BATCH_MAX_IN_FLIGHT = int(os.environ.get('BATCH_MAX_IN_FLIGHT',
+                                         str(INFERENCE_MAX_BATCH_SIZE * max(1, INFERENCE_WORKERS))))
+BATCH_MAX_FILE_MB = float(os.environ.get('BATCH_MAX_FILE_MB', '50'))
+
+@app.route('/api/analyze-batch', methods=['POST'])
+@requires_model
+def analyze_batch_api():
+    """
+    Analyze many images in one request
+
+    Takes either several 'images' files or one zip 'archive', and streams
+    back one NDJSON line per image, in submission order, tagged with its
+    index and filename. Processed images are served by /api/images and
+    only inlined as base64 when includeImageData is set.
+    """
+    profile = request.form.get('profile')
+    try:
+        profile = resolve_profile(profile)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    segmentation = parse_flag(request.form.get('segmentation'))
+    include_image_data = parse_flag(request.form.get('includeImageData'))
+    host_url = request.host_url
+    max_bytes = int(BATCH_MAX_FILE_MB * 1024 * 1024)
+
+    if 'archive' in request.files:
+        archive = request.files['archive']
+        spooled = spool_upload(archive.stream)
+        if not zipfile.is_zipfile(spooled):
+            spooled.close()
+            return jsonify({'error': 'Archive is not a valid zip file'}), 400
+        items = iter_archive_images(spooled, max_bytes)
+        print(f"Batch analysis of archive {archive.filename} with profile {profile}")
+    else:
+        files = [file for file in request.files.getlist('images') if file.filename]
+        if not files:
+            return jsonify({'error': 'No images provided'}), 400
+        items = iter_uploaded_images([(file.filename, spool_upload(file.stream)) for file in files],
+                                     max_bytes)
+        print(f"Batch analysis of {len(files)} images with profile {profile}")
+
+    def analyze(image_bytes):
+        result, processed_image_bytes = process_image_bytes(
+            image_bytes, profile=profile, segmentation=segmentation)
+        attach_processed_image(result, processed_image_bytes, host_url, inline=include_image_data)
+        return result
+
+    return Response(stream_with_context(stream_ndjson(items, analyze, BATCH_MAX_IN_FLIGHT)),
+                    mimetype='application/x-ndjson')
+
+# Image IDs are content hashes, so a URL's bytes never change
+IMAGE_MAX_AGE = 365 * 24 * 3600
+
+@app.route('/api/images/<image_id>', methods=['GET'])
+def get_image_api(image_id):
+    """
+    Serve a processed image from the local image store
+
+    Supports ETag/Last-Modified conditional requests and byte ranges. The
+    file is handed to the WSGI server's file wrapper (sendfile under e.g.
+    gunicorn) or to the front web server when USE_X_SENDFILE is set.
+    """
+    path = image_store.path(image_id)
+    if path is None:
+        return jsonify({'error': 'Image not found'}), 404
+    response = send_file(path, conditional=True, etag=os.path.splitext(image_id)[0],
+                         max_age=IMAGE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/api/uploads/<job_id>', methods=['GET'])
+def upload_status_api(job_id):
+    """Status and final URLs of a background upload job"""
+    status = upload_manager.status(job_id) if upload_manager is not None else None
+    if status is None:
+        return jsonify({'error': 'Upload job not found'}), 404
+    return jsonify(status)
+
+@app.route('/api/cloud/stats', methods=['GET'])
+def cloud_stats_api():
+    """Connection pool, deadline and circuit breaker settings and state of the Firebase clients"""
+    return jsonify(cloud_client.shared().stats())
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats_api():
+    """Hit/miss/eviction counters and sizes of the result cache, the sample caches and scan history"""
+    return jsonify({**result_cache.stats(),
+                    'samples': {'blobs': sample_blobs.stats(), 'metadata': sample_metadata.stats(),
+                                'gallery': sample_gallery.stats(),
+                                'index': sample_index.pages.stats() if sample_index is not None else None},
+                    'history': scan_repository.stats() if scan_repository is not None else None})
+
+# Sample scans: Firestore sample metadata is cached for SAMPLE_METADATA_TTL
+# seconds and downloaded sample images are kept on disk, keyed by storage path
+# and blob generation, up to SAMPLE_CACHE_MAX_MB
+SAMPLE_CACHE_DIR = os.environ.get('SAMPLE_CACHE_DIR', DEFAULT_SAMPLE_CACHE_DIR)
+SAMPLE_CACHE_MAX_MB = float(os.environ.get('SAMPLE_CACHE_MAX_MB', '256'))
+SAMPLE_METADATA_TTL = float(os.environ.get('SAMPLE_METADATA_TTL', '60'))
+sample_blobs = BlobCache(SAMPLE_CACHE_DIR, max_bytes=int(SAMPLE_CACHE_MAX_MB * 1024 * 1024))
+sample_metadata = TTLCache(ttl=SAMPLE_METADATA_TTL)
+# Pages of the sample index (see sample_index.py) are reused for SAMPLE_INDEX_TTL seconds
+SAMPLE_INDEX_TTL = float(os.environ.get('SAMPLE_INDEX_TTL', '30'))
+# Results precomputed by scripts/precompute_samples.py
+GALLERY_DIR = os.environ.get('GALLERY_DIR', DEFAULT_GALLERY_DIR)
+sample_gallery = SampleGallery(GALLERY_DIR)
+
+def storage_path_from_url(image_url):
+    """Extract the storage path from a Firebase Storage download URL"""
+    url_parts = image_url.split('?')[0].split('/')
+    storage_path = '/'.join(url_parts[url_parts.index('o')+1:]) if 'o' in url_parts else None
+    # URL-decode the storage path (convert %2F to / etc.)
+    return urllib.parse.unquote(storage_path) if storage_path else None
+
+def get_sample(user_id, sample_id):
+    """
+    Look up a user's sample, from the metadata cache when possible
+
+    Returns:
+        dict or None: imageUrl, storagePath and generation of the sample's
+            image, or None if the sample or its image doesn't exist
+
+    Raises:
+        ValueError: If the sample doesn't say where its image is
+    """
+    key = (user_id, sample_id)
+    sample = sample_metadata.get(key)
+    if sample is not None:
+        return sample
+
+    sample_ref = db.collection('users').document(user_id).collection('samples').document(sample_id)
+    sample_doc = cloud_client.call('firestore.read', sample_ref.get)
+    if not sample_doc.exists:
+        return None
+    sample_data = sample_doc.to_dict()
+
+    image_url = sample_data.get('imageUrl')
+    if not image_url:
+        raise ValueError('Sample has no image URL')
+    storage_path = sample_data.get('storagePath')
+    if not storage_path:
+        print("WARNING: No storage path in sample data, extracting from URL")
+        storage_path = storage_path_from_url(image_url)
+    if not storage_path:
+        raise ValueError('Cannot determine sample storage path')
+
+    # The generation changes whenever the object is replaced
+    blob = cloud_client.call('storage.metadata', bucket.get_blob, storage_path)
+    if blob is None:
+        return None
+    sample = {'imageUrl': image_url, 'storagePath': storage_path,
+              'generation': blob.generation or blob.etag}
+    sample_metadata.put(key, sample)
+    return sample
+
+def download_sample(sample):
+    """The bytes of a sample's image, from the disk cache when possible"""
+    image_bytes = sample_blobs.get(sample['storagePath'], sample['generation'])
+    if image_bytes is not None:
+        print(f"Sample image cache hit ({len(image_bytes)} bytes)")
+        return image_bytes
+
+    generation = sample['generation'] if isinstance(sample['generation'], int) else None
+    blob = bucket.blob(sample['storagePath'], generation=generation)
+    with stage('sample_download'):
+        image_bytes = cloud_client.call('storage.download', blob.download_as_bytes)
+    print(f"Downloaded {len(image_bytes)} bytes")
+    sample_blobs.put(sample['storagePath'], sample['generation'], image_bytes)
+    return image_bytes
+
+@app.route('/api/samples', methods=['GET'])
+def list_samples_api():
+    """
+    One page of sample images from the sample index
+    
+    Query parameters:
+    - userId: list this user's samples instead of the shared ones
+    - limit: page size (default 20, at most 100)
+    - cursor: nextCursor of the previous page
+    - extension: only samples with this file extension
+    - prefix: only samples whose file name starts with this
+    """
+    if sample_index is None:
+        return jsonify({'error': 'Firebase not available'}), 500
+    
+    try:
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    
+    try:
+        samples, next_cursor = sample_index.list(
+            owner=request.args.get('userId') or SHARED_OWNER, limit=limit,
+            cursor=request.args.get('cursor'), extension=request.args.get('extension'),
+            name_prefix=request.args.get('prefix'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except CloudUnavailable:
+        return jsonify({'error': 'Firebase is temporarily unavailable'}), 503
+    except Exception as e:
+        print(f"Error listing samples: {e}")
+        return jsonify({'error': str(e)}), 500
+    
+    return jsonify({'samples': samples, 'nextCursor': next_cursor})
+
+# Saved scans are committed together every SCAN_WRITE_FLUSH_INTERVAL seconds,
+# and history pages are reused for HISTORY_CACHE_TTL seconds until the user
+# saves another scan (see scan_repository.py)
+SCAN_WRITE_FLUSH_INTERVAL = float(os.environ.get('SCAN_WRITE_FLUSH_INTERVAL', '1'))
+HISTORY_CACHE_TTL = float(os.environ.get('HISTORY_CACHE_TTL', '15'))
+
+def authenticated_user_id():
+    """
+    The uid of the signed-in Firebase user who sent the request
+
+    The client sends its Firebase ID token as `Authorization: Bearer <token>`.
+
+    Returns:
+        str: The verified uid, or None if the header is missing or the token
+            is invalid, expired or revoked
+
+    Raises:
+        CloudUnavailable: If Google's token signing keys can't be fetched
+    """
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token.strip():
+        return None
+
+    from firebase_admin import auth
+    try:
+        return auth.verify_id_token(token.strip())['uid']
+    except (ValueError, auth.InvalidIdTokenError) as e:
+        print(f"Rejected ID token: {e}")
+        return None
+    except auth.CertificateFetchError as e:
+        raise CloudUnavailable(f"Can't fetch the token signing keys: {e}") from e
+
+@app.route('/api/history', methods=['GET'])
+def scan_history_api():
+    """
+    One page of the signed-in user's saved scans, newest first
+    
+    Requires an `Authorization: Bearer <Firebase ID token>` header; the scans
+    listed are those of the token's user.
+    
+    Query parameters:
+    - userId: optional, must match the token's user
+    - limit: page size (default 20, at most 100)
+    - cursor: nextCursor of the previous page
+    
+    Only the fields a history list shows are returned (see LIST_FIELDS in
+    scan_repository.py).
+    """
+    if scan_repository is None:
+        return jsonify({'error': 'Firebase not available'}), 500
+    
+    # The Admin SDK bypasses the security rules, so the caller must prove who they are
+    try:
+        user_id = authenticated_user_id()
+    except CloudUnavailable:
+        return jsonify({'error': 'Firebase is temporarily unavailable'}), 503
+    if user_id is None:
+        return jsonify({'error': 'A valid Firebase ID token is required'}), 401
+    if request.args.get('userId') not in (None, user_id):
+        return jsonify({'error': "Can't list another user's scans"}), 403
+    
+    try:
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    
+    try:
+        scans, next_cursor = scan_repository.history(user_id, limit=limit, cursor=request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except CloudUnavailable:
+        return jsonify({'error': 'Firebase is temporarily unavailable'}), 503
+    except Exception as e:
+        print(f"Error reading scan history: {e}")
+        return jsonify({'error': str(e)}), 500
+    
+    return jsonify({'scans': scans, 'nextCursor': next_cursor})
+
 @app.route('/api/sample-images/<sample_id>', methods=['GET'])
 def get_sample_image(sample_id):
     # This route would serve sample images from a predefined set
@@ -306,12 +1055,16 @@ def get_sample_image(sample_id):
     return jsonify({'message': f'Sample image {sample_id} would be returned here'})
 
 @app.route('/api/scan-sample', methods=['POST'])
+@requires_model
 def scan_sample_image_api():
     """
     Endpoint to scan a sample image from a user's collection
     Required parameters:
     - userId: the user ID
     - sampleId: the sample image ID
+    Optional parameters:
+    - profile: inference profile name (accurate, balanced, fast)
+    - segmentation: 'true' to compute and outline the tumor mask
     """
     print("\n===== STARTING SAMPLE IMAGE SCAN =====")
     
@@ -321,6 +1074,12 @@ def scan_sample_image_api():
     if not user_id or not sample_id:
         print("ERROR: Missing userId or sampleId parameter")
         return jsonify({'error': 'Missing required parameters'}), 400
+    
+    try:
+        profile = resolve_profile(request.form.get('profile'))
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        return jsonify({'error': str(e)}), 400
         
     print(f"Scanning sample image: {sample_id} for user: {user_id}")
     
@@ -329,60 +1088,49 @@ def scan_sample_image_api():
         return jsonify({'error': 'Firebase not available'}), 500
         
     try:
-        # Get the sample image metadata from Firestore
-        sample_ref = db.collection('users').document(user_id).collection('samples').document(sample_id)
-        sample_doc = sample_ref.get()
+        # Get the sample image metadata from Firestore (or the metadata cache)
+        try:
+            sample = get_sample(user_id, sample_id)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        if not sample_doc.exists:
+        if sample is None:
             print(f"ERROR: Sample {sample_id} not found for user {user_id}")
             return jsonify({'error': 'Sample not found'}), 404
-            
-        sample_data = sample_doc.to_dict()
         
-        # Get the image URL from the sample data
-        image_url = sample_data.get('imageUrl')
-        if not image_url:
-            return jsonify({'error': 'Sample has no image URL'}), 400
-            
+        image_url = sample['imageUrl']
         print(f"Sample image URL: {image_url}")
+        print(f"Sample storage path: {sample['storagePath']} (generation {sample['generation']})")
         
-        # Get the storage path
-        storage_path = sample_data.get('storagePath')
-        if not storage_path:
-            print("WARNING: No storage path in sample data, extracting from URL")
-            # Try to extract path from URL if not available
-            url_parts = image_url.split('?')[0].split('/')
-            storage_path = '/'.join(url_parts[url_parts.index('o')+1:]) if 'o' in url_parts else None
-            
-            # URL-decode the storage path (convert %2F to / etc.)
-            if storage_path:
-                storage_path = urllib.parse.unquote(storage_path)
-                print(f"Decoded storage path: {storage_path}")
-            
-        if not storage_path:
-            return jsonify({'error': 'Cannot determine sample storage path'}), 400
-            
-        print(f"Sample storage path: {storage_path}")
-        
-        # Download the sample image to a temporary file
-        temp_dir = tempfile.mkdtemp()
-        filename = os.path.basename(storage_path)
-        temp_file_path = os.path.join(temp_dir, filename)
+        # Answer from the precomputed gallery unless the sample or the model
+        # changed since it was computed (or the request is being profiled)
+        segmentation = parse_flag(request.form.get('segmentation'))
+        trace = pick_trace()
+        precomputed = None if trace else sample_gallery.get(
+            sample['storagePath'], sample['generation'], model_fingerprint,
+            detection_settings(profile, segmentation))
         
-        # Ensure the filename has an extension
-        if not any(temp_file_path.lower().endswith(ext) for ext in ['.jpg', '.jpeg', '.png', '.bmp']):
-            temp_file_path += '.jpg'
+        if precomputed is not None:
+            print("Using the precomputed result from the sample gallery")
+            result, processed_image_bytes = precomputed
+            result.update(cacheHit=True, galleryHit=True, profile=profile)
+        else:
+            # Download the sample image into memory (or read it from the disk cache)
+            print("Downloading sample image...")
+            try:
+                image_bytes = download_sample(sample)
+            except CloudUnavailable:
+                raise
+            except Exception:
+                # The cached generation may be gone, look it up again next time
+                sample_metadata.invalidate((user_id, sample_id))
+                raise
             
-        print(f"Downloading sample to: {temp_file_path}")
-        
-        # Download the file from storage
-        blob = bucket.blob(storage_path)
-        blob.download_to_filename(temp_file_path)
-        
-        # Process the image
-        print("\n[STARTING AI ANALYSIS]")
-        print("Loading image into model...")
-        result, processed_image_path = process_image(temp_file_path)
+            # Process the image
+            print("\n[STARTING AI ANALYSIS]")
+            print("Loading image into model...")
+            result, processed_image_bytes = process_image_bytes(
+                image_bytes, profile=profile, segmentation=segmentation, trace=trace)
         
         print("\n[DETECTION RESULTS]")
         print(f"Tumor detected: {result['hasTumor']}")
@@ -391,58 +1139,117 @@ def scan_sample_image_api():
             print(f"Tumor type: {result['tumorType']}")
             print(f"Tumor size: {result['tumorSize']}")
             print(f"Tumor location: {result['tumorLocation']}")
-        print(f"Processed image saved to: {processed_image_path}")
+        if not result['cacheHit']:
+            print(f"Batch size: {result['inference']['batchSize']}, "
+                  f"queue depth: {result['inference']['queueDepth']}")
         
         # Generate unique ID for this scan
         scan_id = str(uuid.uuid4())
         
-        # Upload processed image to Firebase Storage
+        # Upload processed image to Firebase Storage in the background
         processed_path = f"users/{user_id}/images/processed/{scan_id}.jpg"
         print(f"Uploading processed image to path: {processed_path}")
-        processed_blob = bucket.blob(processed_path)
-        processed_blob.upload_from_filename(processed_image_path)
-        processed_blob.make_public()
-        processed_url = processed_blob.public_url
+        start_uploads(result, [('processed', processed_path, processed_image_bytes, 'image/jpeg')])
         
         # REMOVED: Auto-saving scan data to Firestore for sample scans
         # Now sample scans will only be saved when user explicitly clicks "Save to Account"
         # This makes behavior consistent with regular scans
         
-        # Read processed image as base64
         print("\n[PREPARING RESPONSE]")
-        print("Converting processed image to base64...")
-        with open(processed_image_path, "rb") as img_file:
-            processed_image_b64 = base64.b64encode(img_file.read()).decode('utf-8')
+        attach_processed_image(result, processed_image_bytes, request.host_url,
+                               inline=parse_flag(request.form.get('includeImageData')))
         
         # Add data to result
         result['imageId'] = scan_id
         result['originalImageUrl'] = image_url
-        result['processedImageUrl'] = processed_url
-        result['processedImageData'] = f"data:image/jpeg;base64,{processed_image_b64}"
         result['fromSample'] = True
         result['sampleId'] = sample_id
         
-        # Clean up temp files
-        print("\n[CLEANUP]")
-        os.remove(temp_file_path)
-        os.remove(processed_image_path)
-        os.rmdir(temp_dir)
-        print("Temporary files cleaned up")
-        
         print("\n===== SAMPLE IMAGE SCAN COMPLETE =====")
-        return jsonify(result)
+        with stage('json'):
+            response = jsonify(result)
+        return response
         
+    except CloudUnavailable as e:
+        print(f"ERROR during sample image processing: {e}")
+        return jsonify({'error': 'Firebase is temporarily unavailable'}), 503
     except Exception as e:
         print(f"ERROR during sample image processing: {e}")
-        # Clean up temp files in case of error
-        if 'temp_dir' in locals() and os.path.exists(temp_dir):
-            if 'temp_file_path' in locals() and os.path.exists(temp_file_path):
-                os.remove(temp_file_path)
-            if 'processed_image_path' in locals() and os.path.exists(processed_image_path):
-                os.remove(processed_image_path)
-            os.rmdir(temp_dir)
-            
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/admin/traces', methods=['GET'])
+def list_traces_api():
+    """Captured profiler traces, newest first"""
+    if not is_admin():
+        return jsonify({'error': 'Forbidden'}), 403
+    traces = trace_store.list()
+    for trace in traces:
+        trace['url'] = f"/api/admin/traces/{trace['traceId']}"
+    return jsonify({'traces': traces})
+
+@app.route('/api/admin/traces/<trace_id>', methods=['GET'])
+def get_trace_api(trace_id):
+    """
+    Download a profiler trace
+
+    Returns the Chrome trace JSON, or with ?format=summary the table of the
+    most expensive operators.
+    """
+    if not is_admin():
+        return jsonify({'error': 'Forbidden'}), 403
+    summary = request.args.get('format') == 'summary'
+    path = trace_store.path(trace_id, summary=summary)
+    if path is None:
+        return jsonify({'error': 'Trace not found'}), 404
+    if summary:
+        return send_file(path, mimetype='text/plain')
+    return send_file(path, mimetype='application/json', as_attachment=True,
+                     download_name=f"trace-{trace_id}.json")
+
+@app.route('/api/workers/stats', methods=['GET'])
+def worker_stats_api():
+    """State of the inference worker processes"""
+    if worker_pool is None:
+        return jsonify({'workers': 0, 'mode': 'in-process', 'threads': thread_settings})
+    return jsonify({**worker_pool.stats(), 'mode': 'pre-fork'})
+
+def start_server():
+    """
+    Run the startup sequence: Firebase, model loading and warm-up
+
+    Normally it all runs in a background thread while the server already
+    answers /healthz and /readyz. With INFERENCE_WORKERS the model is loaded
+    and the workers are forked right here instead, before the server starts
+    any request threads; only Firebase and the warm-up run in the background.
+    """
+    def initialize(load_model):
+        with startup.phase('firebase'):
+            init_firebase()
+        if load_model:
+            load_inference()
+        if INFERENCE_CALIBRATE_THREADS and worker_pool is None:
+            with startup.phase('calibrate threads'):
+                calibrate_inference_threads()
+        if WARMUP_IMAGE_SIZES:
+            with startup.phase('warm-up'):
+                warm_up()
+
+    if INFERENCE_WORKERS > 0:
+        try:
+            load_inference()
+        except Exception as e:
+            print(f"Error loading the model: {e}")
+            startup.mark_failed(e)
+            return
+        startup.run_in_background(lambda: initialize(load_model=False))
+    else:
+        startup.run_in_background(lambda: initialize(load_model=True))
+
+start_server()
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5001) 
\ No newline at end of file
+    if INFERENCE_WORKERS > 0:
+        # The debug reloader would re-import this module and fork a second pool
+        app.run(debug=False, host='0.0.0.0', port=5001, threaded=True)
+    else:
+        app.run(debug=True, host='0.0.0.0', port=5001)
@@ -0,0 +1,137 @@
+"""
+Helpers for /api/analyze-batch
+
+Images come either from a multipart upload with many files or from a zip
+archive. They are read one at a time and pushed through the analysis with a
+bounded number in flight, so memory stays flat however large the archive is.
+One NDJSON line is produced per image, in submission order, as soon as it and
+every image before it are done.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import stage
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+
+class SkippedImage(Exception):
+    """An archive member or upload that can't be analyzed"""
+
+
+def spool_upload(stream):
+    """
+    Copy an uploaded file to a temporary file owned by the caller
+
+    Flask closes the request's files as soon as the view returns, before a
+    streamed response body is generated, so uploads have to be moved out of
+    the request first. The copy is chunked and lives on disk.
+    """
+    spooled = tempfile.TemporaryFile()
+    shutil.copyfileobj(stream, spooled)
+    spooled.seek(0)
+    return spooled
+
+
+def iter_uploaded_images(files, max_bytes):
+    """
+    Yield (filename, read) pairs for uploaded files
+
+    Args:
+        files (list): (filename, file object) pairs, closed once read
+        max_bytes (int): Larger files are skipped
+
+    read() returns the file's bytes or raises SkippedImage.
+    """
+    try:
+        for filename, file in files:
+            def read(file=file):
+                with file:
+                    data = file.read(max_bytes + 1)
+                if len(data) > max_bytes:
+                    raise SkippedImage(f"File is larger than {max_bytes} bytes")
+                return data
+            yield filename, read
+    finally:
+        for _, file in files:
+            file.close()
+
+
+def iter_archive_images(stream, max_bytes):
+    """
+    Yield (filename, read) pairs for the images in a zip archive
+
+    Members are decompressed one at a time when read() is called. Directories
+    and non-image files are skipped, and oversized members are reported
+    instead of being decompressed. The stream is closed at the end.
+    """
+    with stream, zipfile.ZipFile(stream) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or not info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            if os.path.basename(info.filename).startswith('.'):
+                continue
+
+            def read(info=info):
+                if info.file_size > max_bytes:
+                    raise SkippedImage(f"File is larger than {max_bytes} bytes")
+                with archive.open(info) as member:
+                    data = member.read(max_bytes + 1)
+                if len(data) > max_bytes:
+                    raise SkippedImage(f"File is larger than {max_bytes} bytes")
+                return data
+            yield info.filename, read
+
+
+def stream_ndjson(items, analyze, max_in_flight):
+    """
+    Analyze items concurrently and yield one JSON line per item in order
+
+    Args:
+        items: Iterable of (filename, read) pairs
+        analyze (callable): Takes image bytes, returns a JSON-serializable dict
+        max_in_flight (int): Maximum number of images read but not yet
+            written out
+
+    Yields:
+        str: One JSON document followed by a newline per item
+    """
+    def line(index, filename, future=None, error=None):
+        if future is not None:
+            try:
+                payload = future.result()
+            except Exception as e:
+                payload = {'error': str(e)}
+        else:
+            payload = {'error': error}
+        with stage('json'):
+            return json.dumps({'index': index, 'filename': filename, **payload}) + '\n'
+
+    def head_ready(pending):
+        future = pending[0][2]
+        return future is None or future.done()
+
+    max_in_flight = max(1, int(max_in_flight))
+    with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='analyze-batch') as executor:
+        pending = deque()
+        for index, (filename, read) in enumerate(items):
+            # Read in this thread: zip members can't be read concurrently
+            try:
+                data = read()
+                pending.append((index, filename, executor.submit(analyze, data), None))
+            except Exception as e:
+                pending.append((index, filename, None, str(e)))
+
+            # Write out everything that is finished, and block on the oldest
+            # item whenever the in-flight window is full
+            while pending and (len(pending) >= max_in_flight or head_ready(pending)):
+                yield line(*pending.popleft())
+
+        while pending:
+            yield line(*pending.popleft())
@@ -0,0 +1,138 @@
+"""
+Dynamic micro-batching for tumor detection inference
+
+Single-image requests coming from the API routes are queued and collected for
+a short window, then run through the model as one list-of-tensors forward pass.
+The predictions are handed back to the waiting request threads.
+"""
+
+import queue
+import threading
+import time
+
+
+class _PendingRequest:
+    """A single image waiting to be run through the model"""
+
+    def __init__(self, image_tensor, with_masks, queue_depth):
+        self.image_tensor = image_tensor
+        self.with_masks = with_masks
+        self.queue_depth = queue_depth
+        self.enqueued_at = time.perf_counter()
+        self.done = threading.Event()
+        self.prediction = None
+        self.error = None
+        self.info = {}
+
+
+class InferenceBatcher:
+    """
+    Collects inference requests and runs them through the model in batches
+
+    A batch is dispatched as soon as `max_batch_size` requests are waiting or
+    `max_wait_ms` milliseconds have passed since the first request of the
+    batch arrived, whichever comes first. Up to `concurrency` batches can be
+    in flight at once, e.g. one per inference worker process.
+    """
+
+    def __init__(self, forward, max_batch_size=4, max_wait_ms=10.0, concurrency=1):
+        """
+        Args:
+            forward (callable): Takes a list of CHW image tensors and a list
+                of per-image mask flags, and returns a list of prediction
+                dicts in the same order
+            max_batch_size (int): Maximum number of images per forward pass
+            max_wait_ms (float): Maximum time to hold a request while waiting
+                for the batch to fill up
+            concurrency (int): Number of batches that may run at the same time
+        """
+        self.forward = forward
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._threads = []
+        for index in range(max(1, int(concurrency))):
+            thread = threading.Thread(target=self._run, name=f'inference-batcher-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, image_tensor, with_masks=False):
+        """
+        Queue an image for inference and wait for its prediction
+
+        Args:
+            image_tensor (Tensor): CHW float image tensor
+            with_masks (bool): Whether this image needs segmentation masks
+
+        Returns:
+            tuple: (prediction (dict), info (dict)) where info holds the batch
+                size, queue depth and timings for this request
+        """
+        with self._lock:
+            queue_depth = self._pending
+            self._pending += 1
+
+        pending = _PendingRequest(image_tensor, with_masks, queue_depth)
+        self._queue.put(pending)
+        pending.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+        return pending.prediction, pending.info
+
+    def queue_depth(self):
+        """Number of requests currently queued or running"""
+        with self._lock:
+            return self._pending
+
+    def _collect_batch(self):
+        """Block for the first request, then gather more until the window closes"""
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            started_at = time.perf_counter()
+
+            try:
+                predictions = list(self.forward([item.image_tensor for item in batch],
+                                                [item.with_masks for item in batch]))
+                if len(predictions) != len(batch):
+                    # zip() would leave the unmatched requests waiting forever
+                    raise RuntimeError(f"Model returned {len(predictions)} predictions "
+                                       f"for a batch of {len(batch)} images")
+                error = None
+            except Exception as e:
+                print(f"Batched inference error: {e}")
+                predictions = [None] * len(batch)
+                error = e
+
+            finished_at = time.perf_counter()
+            with self._lock:
+                self._pending -= len(batch)
+
+            for item, prediction in zip(batch, predictions):
+                item.prediction = prediction
+                item.error = error
+                item.info = {
+                    'batchSize': len(batch),
+                    'queueDepth': item.queue_depth,
+                    'queueWaitMs': round((started_at - item.enqueued_at) * 1000.0, 2),
+                    'inferenceMs': round((finished_at - started_at) * 1000.0, 2),
+                }
+                item.done.set()
@@ -0,0 +1,200 @@
+"""
+Memory-mapped loading of model checkpoints
+
+torch.load normally reads and unpickles the whole checkpoint into freshly
+allocated memory, in every process that loads it. load_weights instead maps
+the file (a zip-format .pth via torch.load(mmap=True), or a .safetensors
+file) and assigns the mapped tensors to a model built on the meta device.
+Nothing is copied or randomly initialized: the weights are paged in from the
+page cache on first use, and every process that maps the same file shares
+those pages.
+
+weights_fingerprint hashes the tensors rather than the file, so a .pth and
+the .safetensors converted from it have the same fingerprint.
+"""
+
+import hashlib
+import importlib.util
+import json
+import os
+
+import torch
+
+SAFETENSORS_EXTENSION = '.safetensors'
+
+
+def safetensors_path(model_path):
+    """The .safetensors file next to a .pth checkpoint"""
+    return f"{os.path.splitext(model_path)[0]}{SAFETENSORS_EXTENSION}"
+
+
+def resolve_checkpoint(model_path):
+    """
+    Pick the file to load for a checkpoint path
+
+    A converted .safetensors next to the .pth is preferred when the
+    safetensors package is installed.
+    """
+    if model_path.endswith(SAFETENSORS_EXTENSION):
+        return model_path
+    candidate = safetensors_path(model_path)
+    if os.path.exists(candidate):
+        if importlib.util.find_spec('safetensors') is not None:
+            return candidate
+        print(f"Found {candidate} but the safetensors package is not installed, using {model_path}")
+    return model_path
+
+
+def load_state_dict(path, mmap=True):
+    """
+    Load a state dict from a .pth or .safetensors file
+
+    Args:
+        path (str): Checkpoint path
+        mmap (bool): Map the file instead of reading it into memory
+
+    Returns:
+        dict: Parameter name -> CPU tensor
+    """
+    if path.endswith(SAFETENSORS_EXTENSION):
+        from safetensors.torch import load_file
+
+        # safetensors always maps the file
+        return load_file(path, device='cpu')
+
+    if mmap:
+        try:
+            return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+        except RuntimeError as e:
+            # Files written with the legacy (non-zip) serialization can't be
+            # mapped; convert_checkpoint.py rewrites them
+            print(f"Could not memory-map {path} ({e}), loading it into memory instead")
+    return torch.load(path, map_location='cpu', weights_only=True)
+
+
+def build_maskrcnn(num_classes=2, **kwargs):
+    """
+    The tumor model's architecture without any weights
+
+    maskrcnn_resnet50_fpn trains from an ImageNet backbone, which gives the
+    ResNet body FrozenBatchNorm2d layers and three trainable stages. Calling
+    it with the default weights_backbone would download and load those
+    ImageNet weights only for the checkpoint to replace them, so the same
+    architecture is assembled here from its parts instead.
+
+    Args:
+        num_classes (int): Classes including the background
+        **kwargs: MaskRCNN options, e.g. an inference profile's settings
+    """
+    from torchvision.models import resnet50
+    from torchvision.models.detection.backbone_utils import _resnet_fpn_extractor
+    from torchvision.models.detection.mask_rcnn import MaskRCNN
+    from torchvision.ops.misc import FrozenBatchNorm2d
+
+    backbone = resnet50(weights=None, norm_layer=FrozenBatchNorm2d)
+    backbone = _resnet_fpn_extractor(backbone, trainable_layers=3)
+    return MaskRCNN(backbone, num_classes=num_classes, **kwargs)
+
+
+def build_on_meta(builder, **kwargs):
+    """
+    Build a model without allocating or initializing its weights
+
+    The parameters are placeholders until load_weights assigns real tensors.
+    """
+    with torch.device('meta'):
+        return builder(**kwargs)
+
+
+def load_weights(model, model_path, mmap=True):
+    """
+    Load a checkpoint into a model, preferring a memory-mapped .safetensors
+
+    The checkpoint's tensors replace the model's parameters instead of being
+    copied into them, so a model built with build_on_meta ends up backed by
+    the mapped file.
+
+    Returns:
+        The model
+    """
+    path = resolve_checkpoint(model_path)
+    state_dict = load_state_dict(path, mmap=mmap)
+    model.load_state_dict(state_dict, assign=True)
+    print(f"Model weights loaded from {path}" + (" (memory-mapped)" if mmap else ""))
+    return model
+
+
+def state_dict_fingerprint(state_dict):
+    """SHA-256 over the names, dtypes, shapes and bytes of a state dict's tensors"""
+    digest = hashlib.sha256()
+    for name in sorted(state_dict):
+        tensor = state_dict[name].detach().cpu().contiguous()
+        digest.update(f"{name}|{tensor.dtype}|{tuple(tensor.shape)}|".encode('utf-8'))
+        # Reinterpret as bytes so every dtype (including bfloat16) hashes
+        digest.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+def weights_fingerprint(model_path):
+    """
+    SHA-256 fingerprint of a checkpoint's weights
+
+    The result is cached in a "<checkpoint>.sha256" file next to it,
+    keyed by the file's size and modification time, so only the first
+    start after the weights change pays for hashing.
+
+    Returns:
+        str: Hex digest, or 'unknown' if the checkpoint cannot be read
+    """
+    path = resolve_checkpoint(model_path)
+    cache_path = f"{path}.sha256"
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        print(f"Warning: Could not fingerprint {path}: {e}")
+        return 'unknown'
+    key = {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    try:
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+        if cached.get('size') == key['size'] and cached.get('mtime') == key['mtime']:
+            return cached['sha256']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    try:
+        fingerprint = state_dict_fingerprint(load_state_dict(path))
+    except Exception as e:
+        print(f"Warning: Could not fingerprint {path}: {e}")
+        return 'unknown'
+
+    try:
+        with open(cache_path, 'w') as f:
+            json.dump({**key, 'sha256': fingerprint}, f)
+    except OSError:
+        # Read-only model directory: hash again next time
+        pass
+    return fingerprint
+
+
+def convert_checkpoint(input_path, output_path):
+    """
+    Rewrite a .pth checkpoint as .safetensors, or as a zip-format .pth that
+    torch.load can memory-map
+
+    Returns:
+        str: Fingerprint of the converted weights
+    """
+    state_dict = load_state_dict(input_path, mmap=False)
+    # Tensors sharing storage can't be saved by safetensors and would be
+    # saved whole by torch.save, so give every tensor its own
+    state_dict = {name: tensor.detach().clone().contiguous() for name, tensor in state_dict.items()}
+
+    if output_path.endswith(SAFETENSORS_EXTENSION):
+        from safetensors.torch import save_file
+
+        save_file(state_dict, output_path)
+    else:
+        torch.save(state_dict, output_path)
+    return state_dict_fingerprint(state_dict)
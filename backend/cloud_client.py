@@ -0,0 +1,316 @@
+"""
+Shared access layer for Firebase Storage and Firestore
+
+The server and FirebaseService used to call storage.bucket() and
+firestore.client() with the SDK defaults: ten pooled HTTP connections, no
+request timeouts and the SDK's own retries, so a stalled upload could hold a
+request thread indefinitely and a Firebase outage slowed every scan.
+
+One CloudClient per process now owns the clients. Storage goes through an
+HTTP connection pool of pool_size connections. Every call made with call()
+gets a deadline for its operation type (OPERATION_DEADLINES, across all
+attempts), transient errors are retried with jittered exponential backoff,
+and each attempt's latency is recorded in
+tumor_cloud_operation_duration_seconds. After failure_threshold consecutive
+transient failures the circuit breaker opens: calls fail at once with
+CloudUnavailable and callers fall back to local-only behaviour (local image
+store, cached samples, queued writes). After reset_timeout seconds one call
+is let through as a probe, and the breaker closes again if it succeeds.
+"""
+
+import random
+import threading
+import time
+
+import metrics
+
+DEFAULT_POOL_SIZE = 32
+# Seconds an operation may take in total, retries included
+OPERATION_DEADLINES = {
+    'storage.download': 30.0,
+    'storage.upload': 60.0,
+    'storage.metadata': 10.0,
+    'storage.list': 30.0,
+    'firestore.read': 10.0,
+    'firestore.query': 15.0,
+    'firestore.write': 15.0,
+}
+DEFAULT_DEADLINE = 30.0
+
+OPERATION_SECONDS = metrics.histogram('tumor_cloud_operation_duration_seconds',
+                                      'Firebase Storage and Firestore calls by operation and outcome',
+                                      ['operation', 'outcome'])
+OPERATION_RETRIES = metrics.counter('tumor_cloud_retries_total',
+                                    'Retries of Firebase calls after transient errors', ['operation'])
+OPERATION_REJECTED = metrics.counter('tumor_cloud_rejected_total',
+                                     'Firebase calls refused while the circuit breaker was open', ['operation'])
+
+
+class CloudUnavailable(Exception):
+    """Raised instead of calling Firebase while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """
+    Opens after consecutive failures, lets one probe through after a cooldown
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        """
+        Args:
+            failure_threshold (int): Consecutive failures that open the breaker
+            reset_timeout (float): Seconds the breaker stays open before a probe
+        """
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._counters = {'opened': 0, 'rejected': 0}
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    @property
+    def available(self):
+        """Whether a call would be let through, without claiming the probe"""
+        with self._lock:
+            if self._state == self.OPEN:
+                return time.monotonic() - self._opened_at >= self.reset_timeout
+            return not (self._state == self.HALF_OPEN and self._probing)
+
+    def allow(self):
+        """Whether to make a call; claims the probe when the cooldown is over"""
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+                self._probing = False
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self._counters['rejected'] += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                print("Firebase is reachable again, leaving local-only mode")
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._state == self.HALF_OPEN or (self._state == self.CLOSED
+                                                 and self._failures >= self.failure_threshold):
+                if self._state == self.CLOSED:
+                    print(f"Firebase failed {self._failures} times in a row, switching to local-only mode")
+                    self._counters['opened'] += 1
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, 'state': self._state, 'consecutiveFailures': self._failures,
+                    'failureThreshold': self.failure_threshold, 'resetTimeoutSeconds': self.reset_timeout}
+
+
+def is_transient(error):
+    """Whether an error from Storage or Firestore is worth retrying (and means Firebase is struggling)"""
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    try:
+        import requests
+        from google.api_core import exceptions
+    except ImportError:
+        return False
+    return isinstance(error, (
+        exceptions.TooManyRequests, exceptions.InternalServerError, exceptions.BadGateway,
+        exceptions.ServiceUnavailable, exceptions.GatewayTimeout, exceptions.DeadlineExceeded,
+        requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+        requests.exceptions.ChunkedEncodingError,
+    ))
+
+
+class CloudClient:
+    """
+    Firebase clients with pooled connections, deadlines, retries and a circuit breaker
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, max_attempts=3, base_delay=0.2, max_delay=5.0,
+                 deadlines=None, failure_threshold=5, reset_timeout=30.0):
+        """
+        Args:
+            pool_size (int): HTTP connections kept open to Cloud Storage
+            max_attempts (int): Attempts per call on transient errors
+            base_delay (float): First retry delay in seconds, doubled each retry
+            max_delay (float): Longest retry delay in seconds
+            deadlines (dict, optional): Overrides of OPERATION_DEADLINES
+            failure_threshold (int): Consecutive failures that open the circuit breaker
+            reset_timeout (float): Seconds the circuit breaker stays open before a probe
+        """
+        self.pool_size = pool_size
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadlines = {**OPERATION_DEADLINES, **(deadlines or {})}
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+        self._lock = threading.Lock()
+        self.app = None
+        self.db = None
+        self.storage_client = None
+        self._buckets = {}
+
+    def configure(self, pool_size=None, max_attempts=None, deadlines=None, failure_threshold=None,
+                  reset_timeout=None):
+        """Change the settings; the pool size only applies before connect()"""
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if max_attempts is not None:
+            self.max_attempts = max(1, int(max_attempts))
+        if deadlines:
+            self.deadlines.update(deadlines)
+        if failure_threshold is not None:
+            self.breaker.failure_threshold = max(1, int(failure_threshold))
+        if reset_timeout is not None:
+            self.breaker.reset_timeout = reset_timeout
+        return self
+
+    def connect(self, cred_path=None, bucket_name=None):
+        """
+        Initialize Firebase (unless already initialized) and the shared clients
+
+        Args:
+            cred_path (str, optional): Service account file, needed if Firebase
+                isn't initialized yet
+            bucket_name (str, optional): Default Storage bucket of a new Firebase app
+
+        Returns:
+            tuple: (Firestore client, default Storage bucket or None)
+        """
+        import firebase_admin
+        import requests
+        from firebase_admin import credentials, firestore
+        from google.auth.transport.requests import AuthorizedSession
+        from google.cloud import storage
+
+        with self._lock:
+            if self.db is None:
+                try:
+                    self.app = firebase_admin.get_app()
+                except ValueError:
+                    options = {'storageBucket': bucket_name} if bucket_name else None
+                    self.app = firebase_admin.initialize_app(credentials.Certificate(cred_path), options)
+
+                google_credentials = self.app.credential.get_credential()
+                session = AuthorizedSession(google_credentials)
+                # Retries are ours: the adapter must not retry on its own
+                adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size,
+                                                        pool_maxsize=self.pool_size, max_retries=0)
+                session.mount('https://', adapter)
+                self.storage_client = storage.Client(project=self.app.project_id,
+                                                     credentials=google_credentials, _http=session)
+                self.db = firestore.client(self.app)
+                print(f"Firebase clients ready ({self.pool_size} pooled Storage connections)")
+        return self.db, self.bucket(bucket_name)
+
+    def bucket(self, name=None):
+        """A Storage bucket on the pooled client, the Firebase app's default without a name"""
+        name = name or (self.app.options.get('storageBucket') if self.app is not None else None)
+        if not name or self.storage_client is None:
+            return None
+        with self._lock:
+            if name not in self._buckets:
+                self._buckets[name] = self.storage_client.bucket(name)
+            return self._buckets[name]
+
+    @property
+    def available(self):
+        """False while the circuit breaker is open: callers should stay local-only"""
+        return self.breaker.available
+
+    def call(self, operation, fn, *args, max_attempts=None, **kwargs):
+        """
+        Call a Storage or Firestore method with a deadline, retries and the circuit breaker
+
+        fn is called with timeout (the seconds left of the operation's
+        deadline) and retry=None (the SDK's own retries are disabled) on top
+        of args and kwargs.
+
+        Args:
+            operation (str): Operation type, e.g. 'storage.upload' (see OPERATION_DEADLINES)
+            fn (callable): SDK method accepting timeout and retry keywords
+            max_attempts (int, optional): Attempts for this call, e.g. 1 when
+                the caller retries on its own
+
+        Raises:
+            CloudUnavailable: If the circuit breaker is open
+        """
+        attempts = max(1, int(max_attempts or self.max_attempts))
+        deadline = time.monotonic() + self.deadlines.get(operation, DEFAULT_DEADLINE)
+        for attempt in range(1, attempts + 1):
+            if not self.breaker.allow():
+                OPERATION_REJECTED.inc(operation=operation)
+                raise CloudUnavailable(f"Firebase is unavailable, skipped {operation}")
+
+            started_at = time.perf_counter()
+            try:
+                result = fn(*args, timeout=max(deadline - time.monotonic(), 0.1), retry=None, **kwargs)
+            except Exception as e:
+                OPERATION_SECONDS.observe(time.perf_counter() - started_at, operation=operation, outcome='error')
+                if not is_transient(e):
+                    # Firebase answered (not found, forbidden, ...): it is up
+                    self.breaker.record_success()
+                    raise
+                self.breaker.record_failure()
+                delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+                if attempt == attempts or time.monotonic() + delay >= deadline:
+                    raise
+                OPERATION_RETRIES.inc(operation=operation)
+                print(f"{operation} failed (attempt {attempt}/{attempts}), retrying in {delay:.2f}s: {e}")
+                time.sleep(delay)
+                continue
+
+            OPERATION_SECONDS.observe(time.perf_counter() - started_at, operation=operation, outcome='ok')
+            self.breaker.record_success()
+            return result
+
+    def stats(self):
+        return {'poolSize': self.pool_size, 'maxAttempts': self.max_attempts, 'deadlines': dict(self.deadlines),
+                'connected': self.db is not None, 'breaker': self.breaker.stats()}
+
+
+# The process's shared client
+_shared = CloudClient()
+
+metrics.gauge('tumor_cloud_available', '0 while the Firebase circuit breaker is open',
+              callback=lambda: int(_shared.available))
+
+
+def shared():
+    return _shared
+
+
+def configure(**settings):
+    """Configure the shared client, see CloudClient.configure"""
+    return _shared.configure(**settings)
+
+
+def call(operation, fn, *args, **kwargs):
+    """CloudClient.call on the shared client"""
+    return _shared.call(operation, fn, *args, **kwargs)
+
+
+def available():
+    return _shared.available
@@ -0,0 +1,149 @@
+"""
+CPU thread budgets for inference processes
+
+By default every process running torch starts one intra-op thread per core
+it can see. With several server processes or inference workers on one box
+they oversubscribe the CPU and spend their time context switching. plan_threads
+splits the CPUs this process may actually use (its affinity mask, capped by a
+cgroup CPU quota) between the processes that run forward passes, and can
+give each of them a disjoint set of cores. apply_threads is called in each
+of those processes before its first forward pass.
+
+calibrate_threads optionally times a forward pass at a few thread counts at
+startup and keeps the fastest.
+"""
+
+import math
+import os
+import time
+
+
+def available_cpus():
+    """IDs of the CPUs this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def cgroup_cpu_limit():
+    """
+    CPU quota of this process's cgroup in cores (e.g. a container's --cpus)
+
+    Returns:
+        float or None: None when there is no quota
+    """
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open('/sys/fs/cgroup/cpu.max', 'r') as f:
+            quota, period = f.read().split()[:2]
+        return None if quota == 'max' else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', 'r') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us', 'r') as f:
+            period = int(f.read())
+        return quota / period if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def cpu_budget():
+    """Number of cores this process can keep busy"""
+    cpus = len(available_cpus())
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, max(1, math.floor(limit)))
+    return cpus
+
+
+def plan_threads(processes, threads=None, interop_threads=None, pin=False):
+    """
+    Thread settings for each process running forward passes
+
+    Args:
+        processes (int): Processes sharing this machine's CPU budget
+        threads (int, optional): Intra-op threads per process; by default
+            the budget divided by the number of processes
+        interop_threads (int, optional): Inter-op threads per process. The
+            Mask R-CNN forward pass is a chain of ops with little to run in
+            parallel, so this defaults to 1.
+        pin (bool): Give each process its own cores
+
+    Returns:
+        list: One dict per process with intraOpThreads, interOpThreads and
+            cpus (list of CPU IDs to pin to, or None)
+    """
+    processes = max(1, int(processes))
+    cpus = available_cpus()
+    share = threads or max(1, cpu_budget() // processes)
+    if pin and share * processes > len(cpus):
+        print(f"Not pinning: {processes} processes x {share} threads need more than {len(cpus)} CPUs")
+        pin = False
+
+    return [{
+        'intraOpThreads': share,
+        'interOpThreads': interop_threads or 1,
+        'cpus': cpus[index * share:(index + 1) * share] if pin else None,
+    } for index in range(processes)]
+
+
+def apply_threads(plan):
+    """
+    Apply one process's thread settings
+
+    Must run before the process's first forward pass: torch fixes the
+    inter-op pool size once it has started, and only threads started after
+    pinning inherit the CPU set.
+    """
+    import torch
+
+    if plan.get('cpus') and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, plan['cpus'])
+    torch.set_num_threads(plan['intraOpThreads'])
+    try:
+        torch.set_num_interop_threads(plan['interOpThreads'])
+    except RuntimeError as e:
+        # Already set, or inter-op work already ran in this process
+        print(f"Could not set inter-op threads: {e}")
+
+
+def calibration_candidates(threads):
+    """Thread counts to try around a planned intra-op count"""
+    return sorted({threads, max(1, threads // 2), max(1, threads // 4), 1}, reverse=True)
+
+
+def calibrate_threads(forward, candidates, repeats=3):
+    """
+    Time forward() at each intra-op thread count and keep the fastest
+
+    Args:
+        forward (callable): A representative forward pass, called with no arguments
+        candidates (list): Intra-op thread counts to try
+        repeats (int): Timed calls per candidate, the best one counts
+
+    Returns:
+        tuple: (best thread count, dict of thread count -> seconds)
+    """
+    import torch
+
+    if len(candidates) == 1:
+        torch.set_num_threads(candidates[0])
+        return candidates[0], {}
+
+    timings = {}
+    with torch.no_grad():
+        for threads in candidates:
+            torch.set_num_threads(threads)
+            forward()
+            best = float('inf')
+            for _ in range(repeats):
+                start = time.perf_counter()
+                forward()
+                best = min(best, time.perf_counter() - start)
+            timings[threads] = round(best, 4)
+
+    fastest = min(timings, key=timings.get)
+    torch.set_num_threads(fastest)
+    return fastest, timings
@@ -0,0 +1,96 @@
+"""
+Staged Mask R-CNN forward pass with optional, thresholded mask computation
+
+torchvision's Mask R-CNN always runs the mask head for every detection (up to
+100 per image) and pastes each mask back to full image resolution, even though
+the analysis only reads boxes and scores. detect() runs the same stages
+(transform, backbone, RPN, box head) and only runs the mask head for images
+that asked for segmentation, and only for detections above a score threshold.
+Each stage is timed into the tumor_stage_duration_seconds metric.
+"""
+
+from collections import OrderedDict
+
+import torch
+from torchvision.models.detection.roi_heads import maskrcnn_inference
+
+from metrics import stage
+
+
+def _mask_flags(with_masks, num_images):
+    if with_masks is None or isinstance(with_masks, bool):
+        return [bool(with_masks)] * num_images
+    flags = [bool(flag) for flag in with_masks]
+    if len(flags) != num_images:
+        raise ValueError(f"Got {len(flags)} mask flags for {num_images} images")
+    return flags
+
+
+def detect(model, images, with_masks=None, mask_score_thresh=0.0):
+    """
+    Run detection with masks computed only where needed
+
+    Args:
+        model: A torchvision Mask R-CNN model in eval mode
+        images (list): CHW float image tensors
+        with_masks (bool or list, optional): Whether to compute masks, either
+            for all images or per image. Defaults to boxes only.
+        mask_score_thresh (float): For images with masks, detections at or
+            below this score are dropped before the mask head runs
+
+    Returns:
+        list: One prediction dict per image with 'boxes', 'labels' and
+            'scores', plus 'masks' (N, 1, H, W) for images that asked for them
+    """
+    flags = _mask_flags(with_masks, len(images))
+    original_image_sizes = [tuple(image.shape[-2:]) for image in images]
+    roi_heads = model.roi_heads
+
+    with torch.no_grad():
+        with stage('transform'):
+            image_list, _ = model.transform(list(images))
+        with stage('backbone'):
+            features = model.backbone(image_list.tensors)
+        if isinstance(features, torch.Tensor):
+            features = OrderedDict([('0', features)])
+        with stage('rpn'):
+            proposals, _ = model.rpn(image_list, features)
+
+        # Box head only
+        with stage('roi_heads'):
+            box_features = roi_heads.box_roi_pool(features, proposals, image_list.image_sizes)
+            box_features = roi_heads.box_head(box_features)
+            class_logits, box_regression = roi_heads.box_predictor(box_features)
+            boxes, scores, labels = roi_heads.postprocess_detections(
+                class_logits, box_regression, proposals, image_list.image_sizes)
+        detections = [{'boxes': b, 'labels': l, 'scores': s} for b, s, l in zip(boxes, scores, labels)]
+
+        if any(flags) and roi_heads.has_mask():
+            with stage('mask_head'):
+                _add_masks(roi_heads, features, image_list, detections, flags, mask_score_thresh)
+
+        # Rescale boxes (and paste masks) back to the original image sizes
+        with stage('rescale'):
+            return model.transform.postprocess(detections, image_list.image_sizes, original_image_sizes)
+
+
+def _add_masks(roi_heads, features, image_list, detections, flags, mask_score_thresh):
+    """Run the mask head for the flagged images' detections above the threshold"""
+    # Keep only the detections that survive the threshold in images
+    # that want masks, and run the mask head on just those
+    for flag, detection in zip(flags, detections):
+        if flag:
+            keep = detection['scores'] > mask_score_thresh
+            for key in ('boxes', 'labels', 'scores'):
+                detection[key] = detection[key][keep]
+
+    mask_indices = [i for i, flag in enumerate(flags) if flag]
+    mask_features = roi_heads.mask_roi_pool(
+        OrderedDict((name, feature[mask_indices]) for name, feature in features.items()),
+        [detections[i]['boxes'] for i in mask_indices],
+        [image_list.image_sizes[i] for i in mask_indices])
+    mask_features = roi_heads.mask_head(mask_features)
+    mask_logits = roi_heads.mask_predictor(mask_features)
+    masks_probs = maskrcnn_inference(mask_logits, [detections[i]['labels'] for i in mask_indices])
+    for i, mask_prob in zip(mask_indices, masks_probs):
+        detections[i]['masks'] = mask_prob
@@ -0,0 +1,204 @@
+"""
+Vectorized post-processing of detections into findings
+
+All detections above the confidence threshold are measured at once: no
+work is done per detection in Python, so a scan with several lesions costs
+about the same as one with a single lesion. A detection that overlaps a
+finding's (higher-scoring) detection by more than MERGE_IOU_THRESH is merged
+into that finding, boxes and masks unioned; any other detection starts a
+finding of its own. Each finding's extents, area and
+centroid come from its mask when segmentation was computed, and from its box
+otherwise. The region is looked up from the centroid in a precomputed grid.
+"""
+
+import functools
+
+import torch
+from torchvision.ops import box_iou, nms
+
+# Approximate scale of the training slices: 100 px is about 2.5 cm
+CM_PER_PIXEL = 2.5 / 100.0
+
+# Tumor type by largest extent: under 2 cm, under 3 cm, 3 cm and over
+TYPE_SIZE_BOUNDS_CM = (2.0, 3.0)
+TUMOR_TYPES = ('Meningioma', 'Glioma', 'Pituitary')
+
+REGIONS = (
+    'Frontal Lobe',
+    'Temporal Lobe (Left)',
+    'Temporal Lobe (Right)',
+    'Occipital Lobe (Left)',
+    'Occipital Lobe (Right)',
+)
+# Cells per side of the region grid; the region bounds (0.33, 0.66 and 0.5
+# of the image) fall on cell edges
+REGION_GRID_SIZE = 100
+
+MERGE_IOU_THRESH = 0.5
+
+
+@functools.lru_cache(maxsize=None)
+def region_grid(size=REGION_GRID_SIZE):
+    """
+    Index into REGIONS for each cell of a size x size grid laid over the image
+
+    The top third is frontal, the middle third temporal and the bottom third
+    occipital, the lower two split into left and right halves.
+    """
+    ys = (torch.arange(size, dtype=torch.float64) / size).unsqueeze(1)
+    xs = (torch.arange(size, dtype=torch.float64) / size).unsqueeze(0)
+    right = (xs >= 0.5).long()
+    return torch.where(ys < 0.33, torch.zeros_like(right), torch.where(ys < 0.66, 1 + right, 3 + right))
+
+
+def locate(centroids, image_size):
+    """
+    Region index of each (x, y) centroid
+
+    Args:
+        centroids (Tensor): (N, 2) pixel coordinates
+        image_size (tuple): (height, width) of the image
+
+    Returns:
+        Tensor: (N,) indices into REGIONS
+    """
+    grid = region_grid()
+    cells = grid.shape[0]
+    height, width = image_size
+    rows = (centroids[:, 1] * cells / height).long().clamp(0, cells - 1)
+    columns = (centroids[:, 0] * cells / width).long().clamp(0, cells - 1)
+    return grid[rows, columns]
+
+
+def merge_overlaps(boxes, iou_thresh=MERGE_IOU_THRESH):
+    """
+    Group detections into findings
+
+    A detection starts a finding unless it overlaps a higher-scoring
+    detection that started one (greedy non-maximum suppression), so every
+    detection belongs to exactly one finding: the one it overlaps most.
+
+    Args:
+        boxes (Tensor): (N, 4) boxes sorted by descending score
+        iou_thresh (float): Overlap above which two detections are merged
+
+    Returns:
+        tuple: (keep (N,) bool mask of detections that start a finding,
+            owner (N,) index into the kept detections of the finding each
+            detection belongs to)
+    """
+    # nms only needs the order of the scores, which is the order of the boxes
+    ranks = torch.arange(len(boxes), 0, -1, dtype=boxes.dtype)
+    keep = torch.zeros(len(boxes), dtype=torch.bool)
+    keep[nms(boxes, ranks, iou_thresh)] = True
+    # A kept detection overlaps itself fully; every other one overlaps a kept one above iou_thresh
+    owner = box_iou(boxes, boxes[keep]).argmax(dim=1)
+    return keep, owner
+
+
+def _mask_measurements(masks):
+    """
+    Area, centroid and extents of (K, H, W) boolean masks
+
+    Returns:
+        tuple: (area (K,), centroids (K, 2), extents (K, 4) as x1, y1, x2, y2
+            with x2/y2 exclusive)
+    """
+    _, height, width = masks.shape
+    row_counts = masks.sum(dim=2).double()
+    column_counts = masks.sum(dim=1).double()
+    area = row_counts.sum(dim=1)
+    safe_area = area.clamp(min=1)
+    centroids = torch.stack([
+        (column_counts * torch.arange(width, dtype=torch.float64)).sum(dim=1) / safe_area + 0.5,
+        (row_counts * torch.arange(height, dtype=torch.float64)).sum(dim=1) / safe_area + 0.5,
+    ], dim=1)
+
+    rows, columns = row_counts > 0, column_counts > 0
+    extents = torch.stack([
+        columns.double().argmax(dim=1),
+        rows.double().argmax(dim=1),
+        width - columns.flip(1).double().argmax(dim=1),
+        height - rows.flip(1).double().argmax(dim=1),
+    ], dim=1).double()
+    return area, centroids, extents
+
+
+def summarize_detections(boxes, scores, image_size, conf_thresh, masks=None,
+                         merge_iou_thresh=MERGE_IOU_THRESH):
+    """
+    Turn a prediction's detections into findings
+
+    Args:
+        boxes (Tensor): (N, 4) boxes in image pixels
+        scores (Tensor): (N,) detection scores
+        image_size (tuple): (height, width) of the image
+        conf_thresh (float): Minimum score of a detection
+        masks (Tensor, optional): (N, 1, H, W) mask probabilities
+        merge_iou_thresh (float): Overlap above which detections are merged
+
+    Returns:
+        tuple: (findings (list of dicts, highest confidence first),
+            union of the findings' masks as an (H, W) bool Tensor or None)
+    """
+    valid = scores > conf_thresh
+    if not bool(valid.any()):
+        return [], None
+
+    scores, order = scores[valid].sort(descending=True)
+    index = valid.nonzero()[:, 0][order]
+    boxes = boxes[index].double()
+    keep, owner = merge_overlaps(boxes, merge_iou_thresh)
+    num_findings = int(keep.sum())
+
+    # Union of each finding's boxes
+    union = torch.stack([
+        torch.full((num_findings,), float('inf'), dtype=torch.float64).scatter_reduce(
+            0, owner, boxes[:, 0], 'amin'),
+        torch.full((num_findings,), float('inf'), dtype=torch.float64).scatter_reduce(
+            0, owner, boxes[:, 1], 'amin'),
+        torch.full((num_findings,), float('-inf'), dtype=torch.float64).scatter_reduce(
+            0, owner, boxes[:, 2], 'amax'),
+        torch.full((num_findings,), float('-inf'), dtype=torch.float64).scatter_reduce(
+            0, owner, boxes[:, 3], 'amax'),
+    ], dim=1)
+    extents = union
+    centroids = torch.stack([(union[:, 0] + union[:, 2]) / 2, (union[:, 1] + union[:, 3]) / 2], dim=1)
+
+    area = union_mask = None
+    if masks is not None and len(masks) == len(valid):
+        # Usually every detection is a finding in score order, and no copy is needed
+        in_order = len(index) == len(masks) and bool((index == torch.arange(len(masks))).all())
+        finding_masks = (masks[:, 0] if in_order else masks[index, 0]) > 0.5
+        if len(owner) > num_findings:
+            # Union the masks of merged detections
+            finding_masks = torch.zeros((num_findings,) + finding_masks.shape[1:], dtype=torch.int16).index_add_(
+                0, owner, finding_masks.to(torch.int16)) > 0
+        area, mask_centroids, mask_extents = _mask_measurements(finding_masks)
+        # Fall back to the box of findings whose mask came out empty
+        has_mask = (area > 0).unsqueeze(1)
+        centroids = torch.where(has_mask, mask_centroids, centroids)
+        extents = torch.where(has_mask, mask_extents, extents)
+        union_mask = finding_masks.any(dim=0)
+
+    size_px = extents[:, 2:] - extents[:, :2]
+    size_cm = size_px.max(dim=1).values * CM_PER_PIXEL
+    types = torch.bucketize(size_cm, torch.tensor(TYPE_SIZE_BOUNDS_CM, dtype=torch.float64), right=True)
+    regions = locate(centroids, image_size)
+    counts = torch.bincount(owner, minlength=num_findings)
+
+    columns = {
+        'confidence': scores[keep].tolist(),
+        'box': union.round(decimals=1).tolist(),
+        'centroid': centroids.round(decimals=1).tolist(),
+        'widthPx': size_px[:, 0].round(decimals=1).tolist(),
+        'heightPx': size_px[:, 1].round(decimals=1).tolist(),
+        'sizeCm': size_cm.round(decimals=2).tolist(),
+        'tumorType': [TUMOR_TYPES[index] for index in types.tolist()],
+        'tumorLocation': [REGIONS[index] for index in regions.tolist()],
+        'detections': counts.tolist(),
+    }
+    if area is not None:
+        columns['maskAreaPx'] = area.long().tolist()
+    findings = [dict(zip(columns, values)) for values in zip(*columns.values())]
+    return findings, union_mask
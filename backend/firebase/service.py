@@ -1,13 +1,22 @@
 import os
+import sys
 import uuid
 import time
 import tempfile
 import json
+import atexit
 import firebase_admin
-from firebase_admin import credentials, storage, firestore
+from firebase_admin import credentials, firestore
 from datetime import datetime
 from google.cloud import storage as gcs
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from image_store import DEFAULT_IMAGE_STORE_DIR, ImageStore
+from sample_index import SHARED_OWNER, SampleIndex, entry_for_blob
+import cloud_client
+import firestore_chunks
+from scan_repository import ScanRepository
+
 class FirebaseService:
     """
     Handles interactions with Firebase Storage for uploading/downloading images
@@ -20,6 +29,9 @@ class FirebaseService:
         self.bucket = None
         self.db = None
         self.fallback_mode = False
+        self.image_store = None
+        self.sample_index = None
+        self.scan_repository = None
         
         try:
             # Check if app is already initialized
@@ -70,15 +82,14 @@ class FirebaseService:
                     )
                     print("Firebase initialized successfully with service account")
                     
-                    # Test connection to Firebase services
+                    # Test connection to Firebase services, through the shared pooled clients
                     try:
-                        self.bucket = storage.bucket()
-                        self.db = firestore.client()
+                        self.db, self.bucket = cloud_client.shared().connect()
                         
                         # Test if the bucket actually exists
                         try:
                             # This will raise an exception if the bucket doesn't exist
-                            self.bucket.exists()
+                            cloud_client.call('storage.metadata', self.bucket.exists)
                             print("Connected to Firebase Storage bucket successfully")
                         except Exception as bucket_error:
                             print(f"Error accessing Firebase Storage bucket: {bucket_error}")
@@ -96,11 +107,11 @@ class FirebaseService:
                                     credentials.Certificate(service_account_path),
                                     app_options
                                 )
-                                self.bucket = storage.bucket()
+                                self.bucket = cloud_client.shared().bucket(app_options['storageBucket'])
                                 
                                 # Try to create the bucket if it doesn't exist
                                 try:
-                                    if not self.bucket.exists():
+                                    if not cloud_client.call('storage.metadata', self.bucket.exists):
                                         print("Bucket doesn't exist. Attempting to create it...")
                                         # Create storage client with the same credentials
                                         storage_client = gcs.Client.from_service_account_json(service_account_path)
@@ -111,10 +122,10 @@ class FirebaseService:
                                         print(f"Created bucket: {app_options['storageBucket']}")
                                         
                                         # Update our bucket reference
-                                        self.bucket = storage.bucket()
+                                        self.bucket = cloud_client.shared().bucket(app_options['storageBucket'])
                                         
                                     # Test if bucket now exists
-                                    self.bucket.exists()
+                                    cloud_client.call('storage.metadata', self.bucket.exists)
                                     print("Connected to Firebase Storage bucket successfully")
                                     self.fallback_mode = False
                                 except Exception as create_error:
@@ -144,8 +155,7 @@ class FirebaseService:
                 
                 # Get the storage bucket and firestore client
                 try:
-                    self.bucket = storage.bucket()
-                    self.db = firestore.client()
+                    self.db, self.bucket = cloud_client.shared().connect()
                     self.initialized = True
                 except Exception as service_error:
                     print(f"Error accessing Firebase services: {service_error}")
@@ -157,6 +167,35 @@ class FirebaseService:
             print("Firebase will not be available. Using local storage fallback.")
             self.fallback_mode = True
     
+    def store_locally(self, file_path):
+        """
+        Copy an image into the local image store served by /api/images
+        
+        Args:
+            file_path (str): Path to the local file
+            
+        Returns:
+            tuple: (image_id (str), url (str))
+        """
+        if self.image_store is None:
+            self.image_store = ImageStore(os.environ.get('IMAGE_STORE_DIR', DEFAULT_IMAGE_STORE_DIR))
+        image_id = self.image_store.put_file(file_path)
+        return image_id, f"/api/images/{image_id}"
+    
+    def get_sample_index(self):
+        """The Firestore sample index, created on first use"""
+        if self.sample_index is None:
+            self.sample_index = SampleIndex(self.db)
+        return self.sample_index
+    
+    def get_scan_repository(self):
+        """The scan result repository, created on first use"""
+        if self.scan_repository is None:
+            self.scan_repository = ScanRepository(self.db)
+            # Commit the scans still queued when the process exits
+            atexit.register(self.scan_repository.close)
+        return self.scan_repository
+    
     def upload_image(self, file_path, user_id=None, folder="uploads"):
         """
         Upload an image to Firebase Storage
@@ -170,9 +209,9 @@ class FirebaseService:
             tuple: (success (bool), storage_path (str), download_url (str), error_message (str))
         """
         if self.fallback_mode:
-            # In fallback mode, just return the local path
-            local_relative_path = os.path.basename(file_path)
-            return True, local_relative_path, f"/api/images/{local_relative_path}", ""
+            # In fallback mode, serve the image from the local image store
+            image_id, local_url = self.store_locally(file_path)
+            return True, image_id, local_url, ""
             
         if not self.initialized:
             return False, "", "", "Firebase not initialized"
@@ -191,10 +230,10 @@ class FirebaseService:
             
             # Upload the file
             blob = self.bucket.blob(storage_path)
-            blob.upload_from_filename(file_path)
+            cloud_client.call('storage.upload', blob.upload_from_filename, file_path)
             
             # Make the blob publicly accessible (optional)
-            blob.make_public()
+            cloud_client.call('storage.metadata', blob.make_public)
             
             # Get the public URL
             download_url = blob.public_url
@@ -202,13 +241,20 @@ class FirebaseService:
             print(f"Uploaded file to Firebase Storage: {storage_path}")
             print(f"Download URL: {download_url}")
             
+            # Keep the sample index up to date
+            if folder == "samples":
+                try:
+                    self.get_sample_index().upsert([entry_for_blob(blob)])
+                except Exception as index_error:
+                    print(f"Error indexing sample {storage_path}: {index_error}")
+            
             return True, storage_path, download_url, ""
             
         except Exception as e:
             print(f"Error uploading file to Firebase Storage: {e}")
-            # Fall back to local path in case of error
-            local_relative_path = os.path.basename(file_path)
-            return True, local_relative_path, f"/api/images/{local_relative_path}", str(e)
+            # Fall back to the local image store in case of error
+            image_id, local_url = self.store_locally(file_path)
+            return True, image_id, local_url, str(e)
     
     def download_image(self, storage_path, local_path=None):
         """
@@ -257,7 +303,7 @@ class FirebaseService:
             
             # Download the file
             blob = self.bucket.blob(storage_path)
-            blob.download_to_filename(local_path)
+            cloud_client.call('storage.download', blob.download_to_filename, local_path)
             
             print(f"Downloaded file from Firebase Storage: {storage_path} to {local_path}")
             
@@ -281,12 +327,40 @@ class FirebaseService:
             
             return False, "", str(e)
     
-    def get_sample_images(self, limit=10):
+    def list_samples(self, user_id=None, limit=20, cursor=None, extension=None, name_prefix=None):
         """
-        Get a list of sample images from Firebase Storage
+        Get one page of sample images from the sample index
         
         Args:
+            user_id (str, optional): List this user's samples instead of the shared ones
             limit (int): Maximum number of samples to return
+            cursor (str, optional): Cursor returned with the previous page
+            extension (str, optional): Only samples with this file extension
+            name_prefix (str, optional): Only samples whose name starts with this
+            
+        Returns:
+            tuple: (samples (list of sample image metadata), next_cursor (str or None))
+        """
+        entries, next_cursor = self.get_sample_index().list(
+            owner=user_id or SHARED_OWNER, limit=limit, cursor=cursor,
+            extension=extension, name_prefix=name_prefix)
+        samples = [{
+            "name": entry["name"],
+            "url": entry["url"],
+            "storage_path": entry["storagePath"],
+            "size": entry["size"]
+        } for entry in entries]
+        return samples, next_cursor
+    
+    def get_sample_images(self, limit=10, cursor=None, extension=None, name_prefix=None):
+        """
+        Get a list of sample images from the sample index
+        
+        Args:
+            limit (int): Maximum number of samples to return
+            cursor (str, optional): Cursor of the page to return (see list_samples)
+            extension (str, optional): Only samples with this file extension
+            name_prefix (str, optional): Only samples whose name starts with this
             
         Returns:
             list: List of sample image metadata
@@ -299,40 +373,11 @@ class FirebaseService:
             return self._get_local_sample_images(limit)
         
         try:
-            # List files in the samples directory
-            samples = []
-            blobs = self.bucket.list_blobs(prefix="samples/")
-            
-            for blob in blobs:
-                # Skip directory markers
-                if blob.name.endswith('/'):
-                    continue
-                
-                # Skip if not an image
-                if not blob.name.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.bmp')):
-                    continue
-                
-                # Make public if not already
-                try:
-                    if not blob.public_url:
-                        blob.make_public()
-                except:
-                    blob.make_public()
-                
-                # Add to samples
-                samples.append({
-                    "name": os.path.basename(blob.name),
-                    "url": blob.public_url,
-                    "storage_path": blob.name,
-                    "size": blob.size
-                })
-                
-                # Stop if we have enough samples
-                if len(samples) >= limit:
-                    break
+            samples, _ = self.list_samples(limit=limit, cursor=cursor, extension=extension,
+                                           name_prefix=name_prefix)
             
-            # If we got no samples from Firebase, fall back to local
-            if not samples:
+            # If the index has no samples at all, fall back to local
+            if not samples and cursor is None and extension is None and name_prefix is None:
                 return self._get_local_sample_images(limit)
                 
             return samples
@@ -367,6 +412,9 @@ class FirebaseService:
         """
         Save scan result to Firestore
         
+        The result is queued and committed with other results within a
+        second (see scan_repository.py); the document ID is final.
+        
         Args:
             user_id (str): User ID
             result_data (dict): Scan result data
@@ -385,28 +433,27 @@ class FirebaseService:
             return False, "", "User ID is required"
         
         try:
-            # Add timestamp
-            result_data["timestamp"] = firestore.SERVER_TIMESTAMP
-            
-            # Save to Firestore
-            doc_ref = self.db.collection('users').document(user_id).collection('scans').document()
-            doc_ref.set(result_data)
+            # Queue for the next batched write, timestamped by the server
+            doc_id = self.get_scan_repository().add(user_id, result_data)
             
-            print(f"Saved scan result to Firestore for user {user_id}, doc_id: {doc_ref.id}")
+            print(f"Queued scan result for Firestore for user {user_id}, doc_id: {doc_id}")
             
-            return True, doc_ref.id, ""
+            return True, doc_id, ""
             
         except Exception as e:
             print(f"Error saving scan result to Firestore: {e}")
             return False, "", str(e)
     
-    def get_user_samples(self, user_id, limit=20):
+    def get_user_samples(self, user_id, limit=20, cursor=None, extension=None, name_prefix=None):
         """
         Get samples uploaded by a specific user
         
         Args:
             user_id (str): User ID
             limit (int): Maximum number of samples to return
+            cursor (str, optional): Cursor of the page to return (see list_samples)
+            extension (str, optional): Only samples with this file extension
+            name_prefix (str, optional): Only samples whose name starts with this
             
         Returns:
             list: List of user sample image metadata
@@ -415,46 +462,28 @@ class FirebaseService:
             return []
         
         try:
-            samples = []
-            blobs = self.bucket.list_blobs(prefix=f"users/{user_id}/samples/")
-            
-            for blob in blobs:
-                if blob.name.endswith('/'):
-                    continue
-                
-                if not blob.name.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.bmp')):
-                    continue
-                
-                try:
-                    if not blob.public_url:
-                        blob.make_public()
-                except:
-                    blob.make_public()
-                
-                samples.append({
-                    "name": os.path.basename(blob.name),
-                    "url": blob.public_url,
-                    "storage_path": blob.name,
-                    "size": blob.size
-                })
-                
-                if len(samples) >= limit:
-                    break
-            
+            samples, _ = self.list_samples(user_id=user_id, limit=limit, cursor=cursor,
+                                           extension=extension, name_prefix=name_prefix)
             return samples
             
         except Exception as e:
             print(f"Error getting user samples: {e}")
             return []
     
-    def save_image_to_firestore(self, file_path, user_id=None, folder="uploads"):
+    def save_image_to_firestore(self, file_path, user_id=None, folder="uploads", compression=None):
         """
         Save image directly to Firestore as a fallback when Storage is not available
         
+        The image is stored as binary chunks, so it may be larger than a
+        Firestore document (see firestore_chunks.py).
+        
         Args:
             file_path (str): Path to the local file
             user_id (str, optional): User ID for organizing files
             folder (str): Folder in Firestore (default: "uploads")
+            compression (str, optional): 'auto', 'none', 'deflate' or 'zstd'
+                (default: FIRESTORE_IMAGE_COMPRESSION, or 'auto' to compress
+                only formats that aren't compressed already)
             
         Returns:
             tuple: (success (bool), doc_id (str), error_message (str))
@@ -463,35 +492,28 @@ class FirebaseService:
             return False, "", "Firebase not properly initialized"
         
         try:
-            # Read file as binary
-            with open(file_path, 'rb') as f:
-                binary_data = f.read()
-                
-            # Convert to base64 for storage (much smaller than raw binary)
-            import base64
-            encoded_data = base64.b64encode(binary_data).decode('utf-8')
-            
             # Generate a unique ID
             doc_id = str(uuid.uuid4())
             
-            # Create document data
-            data = {
-                "name": os.path.basename(file_path),
-                "type": folder,
-                "created_at": firestore.SERVER_TIMESTAMP,
-                "data": encoded_data
-            }
-            
             # Set the path based on user_id
             if user_id:
                 doc_ref = self.db.collection('users').document(user_id).collection('images').document(doc_id)
             else:
                 doc_ref = self.db.collection('images').document(doc_id)
-                
-            # Save to Firestore
-            doc_ref.set(data)
             
-            print(f"Saved image to Firestore, doc_id: {doc_id}")
+            # Save the chunks and then the image document
+            fields = firestore_chunks.write_image(
+                self.db, doc_ref, file_path,
+                metadata={
+                    "name": os.path.basename(file_path),
+                    "type": folder,
+                    "created_at": firestore.SERVER_TIMESTAMP
+                },
+                compression=compression or os.environ.get('FIRESTORE_IMAGE_COMPRESSION', 'auto')
+            )
+            
+            print(f"Saved image to Firestore, doc_id: {doc_id} ({fields['size']} bytes stored as "
+                  f"{fields['storedSize']} in {fields['chunkCount']} {fields['encoding']} chunks)")
             
             return True, doc_id, ""
         except Exception as e:
@@ -521,7 +543,7 @@ class FirebaseService:
                 doc_ref = self.db.collection('images').document(doc_id)
                 
             # Get the document
-            doc = doc_ref.get()
+            doc = cloud_client.call('firestore.read', doc_ref.get)
             
             if not doc.exists:
                 return False, "", "Image not found in Firestore"
@@ -529,10 +551,6 @@ class FirebaseService:
             # Get the data
             data = doc.to_dict()
             
-            # Decode the base64 data
-            import base64
-            binary_data = base64.b64decode(data['data'])
-            
             # Create a temporary file if local_path is not provided
             if not local_path:
                 # Create temp dir if it doesn't exist
@@ -545,9 +563,8 @@ class FirebaseService:
             # Create directory if it doesn't exist
             os.makedirs(os.path.dirname(local_path), exist_ok=True)
             
-            # Write the file
-            with open(local_path, 'wb') as f:
-                f.write(binary_data)
+            # Stream the chunks into the file
+            firestore_chunks.read_image_to_file(doc_ref, data, local_path)
                 
             print(f"Retrieved image from Firestore, saved to {local_path}")
             
@@ -0,0 +1,247 @@
+"""
+Images stored as chunked binary documents in Firestore
+
+The Firestore fallback used to put a whole image into one document as a
+base64 string: a third larger than the file, read and decoded all at once,
+and impossible past Firestore's 1 MiB document limit. Here the image's bytes
+(compressed with zstd or deflate unless the format is already compressed)
+are split into CHUNK_SIZE Blob fields in a "chunks" subcollection of the
+image document. The file is read, compressed and written a chunk at a time,
+in batched writes, and read back in order a few chunks per query into a
+decompressor, so memory stays bounded and cost follows the stored bytes.
+Each write and each page of chunks goes through cloud_client, with a
+deadline, retries and the circuit breaker.
+
+The image document is written last, after all of its chunks, so readers
+never see a partial image. Documents in the old single-field format are
+still read.
+"""
+
+import base64
+import hashlib
+import os
+import zlib
+
+import cloud_client
+
+try:
+    import zstandard
+except ImportError:  # Optional: deflate is used instead
+    zstandard = None
+
+FORMAT = 'chunked-v1'
+CHUNKS_COLLECTION = 'chunks'
+# Stored bytes per chunk document, under the 1 MiB document limit
+CHUNK_SIZE = 960 * 1024
+# Bytes per batched write, under the 10 MiB request limit (and 500 writes)
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+MAX_BATCH_WRITES = 500
+# Formats whose bytes don't compress any further
+COMPRESSED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.zip', '.gz', '.zst')
+ENCODINGS = ('identity', 'deflate', 'zstd')
+# Chunks fetched per query when reading, about 8 MiB
+CHUNKS_PER_READ = 8
+
+
+def default_encoding():
+    return 'zstd' if zstandard is not None else 'deflate'
+
+
+def choose_encoding(filename, compression='auto'):
+    """
+    Encoding to store a file with
+
+    Args:
+        filename (str): The file's name, whose extension tells whether it is already compressed
+        compression (str): 'auto', 'none', 'deflate' or 'zstd'
+
+    Returns:
+        str: One of ENCODINGS
+    """
+    if compression == 'none':
+        return 'identity'
+    if compression == 'auto':
+        if filename.lower().endswith(COMPRESSED_EXTENSIONS):
+            return 'identity'
+        return default_encoding()
+    if compression == 'zstd' and zstandard is None:
+        print("zstandard is not installed, compressing with deflate")
+        return 'deflate'
+    if compression not in ENCODINGS:
+        raise ValueError(f"Unknown compression: {compression}")
+    return compression
+
+
+def _compressor(encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    if encoding == 'deflate':
+        return zlib.compressobj(6)
+    return None
+
+
+def _decompressor(encoding):
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('Image is zstd-compressed but zstandard is not installed')
+        return zstandard.ZstdDecompressor().decompressobj()
+    if encoding == 'deflate':
+        return zlib.decompressobj()
+    return None
+
+
+def _stored_chunks(f, encoding):
+    """
+    Read a file a piece at a time, yielding ('raw', bytes read) for each piece
+    and ('chunk', bytes to store) for every CHUNK_SIZE bytes of encoded output
+    """
+    compressor = _compressor(encoding)
+    pending = bytearray()
+    for data in iter(lambda: f.read(CHUNK_SIZE), b''):
+        yield ('raw', data)
+        pending += compressor.compress(data) if compressor is not None else data
+        while len(pending) >= CHUNK_SIZE:
+            yield ('chunk', bytes(pending[:CHUNK_SIZE]))
+            del pending[:CHUNK_SIZE]
+    if compressor is not None:
+        pending += compressor.flush()
+    while pending:
+        yield ('chunk', bytes(pending[:CHUNK_SIZE]))
+        del pending[:CHUNK_SIZE]
+
+
+def write_image(db, doc_ref, file_path, metadata=None, compression='auto'):
+    """
+    Store a file as a chunked image document
+
+    Args:
+        db: Firestore client, for batched writes
+        doc_ref: Reference of the image document to create
+        file_path (str): Path to the local file
+        metadata (dict, optional): Extra fields of the image document
+        compression (str): 'auto', 'none', 'deflate' or 'zstd' (see choose_encoding)
+
+    Returns:
+        dict: The image document's fields
+    """
+    encoding = choose_encoding(file_path, compression)
+    chunks_ref = doc_ref.collection(CHUNKS_COLLECTION)
+    digest = hashlib.sha256()
+    size = stored_size = chunk_count = 0
+
+    batch, batch_bytes, batch_writes = db.batch(), 0, 0
+    try:
+        with open(file_path, 'rb') as f:
+            for kind, data in _stored_chunks(f, encoding):
+                if kind == 'raw':
+                    digest.update(data)
+                    size += len(data)
+                    continue
+                if batch_writes and (batch_bytes + len(data) > MAX_BATCH_BYTES
+                                     or batch_writes >= MAX_BATCH_WRITES):
+                    cloud_client.call('firestore.write', batch.commit)
+                    batch, batch_bytes, batch_writes = db.batch(), 0, 0
+                batch.set(chunks_ref.document(f"{chunk_count:06d}"), {'index': chunk_count, 'data': data})
+                batch_bytes += len(data)
+                batch_writes += 1
+                stored_size += len(data)
+                chunk_count += 1
+
+        fields = dict(metadata or {})
+        fields.update({
+            'format': FORMAT,
+            'encoding': encoding,
+            'size': size,
+            'storedSize': stored_size,
+            'chunkCount': chunk_count,
+            'sha256': digest.hexdigest(),
+        })
+        # The image document goes in the last batch, so it appears with its last chunk
+        batch.set(doc_ref, fields)
+        cloud_client.call('firestore.write', batch.commit)
+    except Exception:
+        _delete_chunks(db, chunks_ref, chunk_count)
+        raise
+    return fields
+
+
+def _delete_chunks(db, chunks_ref, chunk_count):
+    """Best-effort removal of the chunks written by a failed write_image"""
+    try:
+        for start in range(0, chunk_count, MAX_BATCH_WRITES):
+            batch = db.batch()
+            for index in range(start, min(start + MAX_BATCH_WRITES, chunk_count)):
+                batch.delete(chunks_ref.document(f"{index:06d}"))
+            cloud_client.call('firestore.write', batch.commit)
+    except Exception as e:
+        print(f"Error removing the chunks of a failed image write: {e}")
+
+
+def iter_image(doc_ref, fields):
+    """
+    Yield an image's bytes as they are streamed from its chunks
+
+    Args:
+        doc_ref: Reference of the image document
+        fields (dict): The image document's fields
+
+    Raises:
+        ValueError: If the image is incomplete or doesn't match its checksum
+    """
+    if fields.get('format') != FORMAT:
+        # Single-field base64 documents written before the chunked format
+        yield base64.b64decode(fields['data'])
+        return
+
+    decompressor = _decompressor(fields.get('encoding', 'identity'))
+    digest = hashlib.sha256()
+    size = expected_index = 0
+    chunks = doc_ref.collection(CHUNKS_COLLECTION).order_by('index')
+    while True:
+        # Pages rather than one stream, so each read has a deadline and can be retried
+        query = chunks.start_after({'index': expected_index - 1}) if expected_index else chunks
+        query = query.limit(CHUNKS_PER_READ)
+        page = cloud_client.call('firestore.query', lambda timeout, retry: [
+            snapshot.to_dict() for snapshot in query.stream(timeout=timeout, retry=retry)])
+        for chunk in page:
+            if chunk['index'] != expected_index:
+                raise ValueError(f"Image is missing chunk {expected_index}")
+            expected_index += 1
+            data = decompressor.decompress(chunk['data']) if decompressor is not None else chunk['data']
+            if data:
+                digest.update(data)
+                size += len(data)
+                yield data
+        if len(page) < CHUNKS_PER_READ:
+            break
+    if decompressor is not None and hasattr(decompressor, 'flush'):
+        data = decompressor.flush()
+        if data:
+            digest.update(data)
+            size += len(data)
+            yield data
+
+    if expected_index != fields['chunkCount'] or size != fields['size'] or digest.hexdigest() != fields['sha256']:
+        raise ValueError('Image data is incomplete or corrupt')
+
+
+def read_image_to_file(doc_ref, fields, local_path):
+    """
+    Stream an image into local_path, removing the partial file on failure
+
+    Returns:
+        int: Bytes written
+    """
+    written = 0
+    temp_path = f"{local_path}.part"
+    try:
+        with open(temp_path, 'wb') as f:
+            for data in iter_image(doc_ref, fields):
+                f.write(data)
+                written += len(data)
+        os.replace(temp_path, local_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return written
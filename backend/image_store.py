@@ -0,0 +1,160 @@
+"""
+Local store for processed scan images served by /api/images/<image_id>
+
+Images are content-addressed: the ID is the SHA-256 of the encoded bytes plus
+the file extension, so the same overlay is stored once and the ID doubles as
+a strong ETag that never changes. The store is bounded by bytes and evicts
+the least recently stored or served images first.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+DEFAULT_IMAGE_STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'image_store')
+
+# Hex digest (or any plain file name) plus an extension, never a path
+IMAGE_ID_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_-]*\.[A-Za-z0-9]+$')
+
+
+class ImageStore:
+    """
+    Byte-bounded, content-addressed directory of images
+    """
+
+    def __init__(self, directory=DEFAULT_IMAGE_STORE_DIR, max_bytes=512 * 1024 * 1024):
+        """
+        Args:
+            directory (str): Where the images are kept
+            max_bytes (int): Size budget, oldest images are removed beyond it
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # image_id -> size, least recently used first
+        self._bytes = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_index()
+
+    def put(self, data, extension='.jpg'):
+        """
+        Store encoded image bytes
+
+        Returns:
+            str: The image ID
+        """
+        image_id = f"{hashlib.sha256(data).hexdigest()}{extension}"
+        with self._lock:
+            if image_id in self._index:
+                self._index.move_to_end(image_id)
+                return image_id
+
+        path = os.path.join(self.directory, image_id)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        self._add(image_id, len(data))
+        return image_id
+
+    def put_file(self, file_path):
+        """
+        Copy an image file into the store
+
+        Returns:
+            str: The image ID, keeping the file's extension
+        """
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        extension = os.path.splitext(file_path)[1].lower() or '.jpg'
+        image_id = f"{digest.hexdigest()}{extension}"
+
+        path = os.path.join(self.directory, image_id)
+        if not os.path.exists(path):
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            shutil.copyfile(file_path, temp_path)
+            os.replace(temp_path, path)
+        self._add(image_id, os.path.getsize(path))
+        return image_id
+
+    def path(self, image_id):
+        """
+        Path of a stored image, or None if the ID is unknown or invalid
+
+        Looking an image up marks it as recently used. Images written by
+        another process sharing the directory are picked up on first lookup.
+        """
+        if not IMAGE_ID_PATTERN.match(image_id or ''):
+            return None
+        path = os.path.join(self.directory, image_id)
+        with self._lock:
+            if image_id in self._index:
+                self._index.move_to_end(image_id)
+                return path
+
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        self._add(image_id, size)
+        return path
+
+    def stats(self):
+        """Number of images and bytes in the store"""
+        with self._lock:
+            return {'entries': len(self._index), 'bytes': self._bytes, 'maxBytes': self.max_bytes}
+
+    def _add(self, image_id, size):
+        evicted = []
+        with self._lock:
+            old_size = self._index.pop(image_id, None)
+            if old_size is not None:
+                self._bytes -= old_size
+            self._index[image_id] = size
+            self._bytes += size
+
+            while self._bytes > self.max_bytes and len(self._index) > 1:
+                evicted_id, evicted_size = self._index.popitem(last=False)
+                self._bytes -= evicted_size
+                evicted.append(evicted_id)
+
+        for evicted_id in evicted:
+            try:
+                os.remove(os.path.join(self.directory, evicted_id))
+            except OSError:
+                pass
+
+    def _load_index(self):
+        """Rebuild the LRU index from the directory, oldest files first"""
+        entries = []
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename.endswith('.tmp'):
+                # Left over from an interrupted write (recent ones may still
+                # be in progress in another process)
+                try:
+                    if time.time() - os.path.getmtime(path) > 3600:
+                        os.remove(path)
+                except OSError:
+                    pass
+                continue
+            if not IMAGE_ID_PATTERN.match(filename):
+                continue
+            try:
+                entries.append((os.path.getmtime(path), filename, os.path.getsize(path)))
+            except OSError:
+                continue
+
+        for _, image_id, size in sorted(entries):
+            self._index[image_id] = size
+            self._bytes += size
+        print(f"Image store: {len(self._index)} images ({self._bytes} bytes) in {self.directory}")
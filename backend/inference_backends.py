@@ -0,0 +1,294 @@
+"""
+Pluggable CPU inference backends for the tumor detection model
+
+Every backend is a callable taking a list of CHW float image tensors and
+returning one prediction dict per image with torch tensors under 'boxes',
+'labels', 'scores' and 'masks', the same contract as the eager torchvision
+model. That keeps analyze_image and the batching/worker layers unchanged
+whichever backend is selected.
+
+Backends that run a torchvision model also take `with_masks` and
+`mask_score_thresh` to skip the mask head (see detection.detect). Exported
+backends accept and ignore them, their graphs always compute masks.
+
+Backends:
+    eager        The torchvision model as loaded from maskrcnn_tumor.pth
+    torchscript  A model exported with torch.jit.script
+    compile      The eager model wrapped with torch.compile
+    int8         The int8 quantized model built by scripts/quantize_model.py
+    onnx         An exported ONNX graph run by ONNX Runtime on the CPU
+                 execution provider (requires the onnxruntime package)
+"""
+
+import copy
+import inspect
+import os
+
+import numpy as np
+import torch
+
+from detection import detect
+
+BACKENDS = ('eager', 'torchscript', 'compile', 'onnx', 'int8')
+
+ONNX_OUTPUT_NAMES = ['boxes', 'labels', 'scores', 'masks']
+
+
+def default_artifact_path(model_path, backend_name):
+    """Where the exported artifact for a backend lives next to the .pth weights"""
+    base = os.path.splitext(model_path)[0]
+    if backend_name == 'torchscript':
+        return f"{base}.torchscript.pt"
+    if backend_name == 'onnx':
+        return f"{base}.onnx"
+    if backend_name == 'int8':
+        return f"{base}.int8.pth"
+    return None
+
+
+class EagerBackend:
+    """Runs the torchvision model directly"""
+
+    name = 'eager'
+
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, image_tensors, with_masks=True, mask_score_thresh=None):
+        if with_masks is True and mask_score_thresh is None:
+            with torch.no_grad():
+                return self.model(list(image_tensors))
+        return detect(self.model, image_tensors, with_masks=with_masks,
+                      mask_score_thresh=mask_score_thresh or 0.0)
+
+    def share_memory(self):
+        self.model.share_memory()
+        return self
+
+
+class CompiledBackend(EagerBackend):
+    """Runs the model through torch.compile"""
+
+    name = 'compile'
+
+    def __init__(self, model, mode=None):
+        super().__init__(model)
+        self.compiled = torch.compile(model, mode=mode, dynamic=True)
+
+        # The staged path (detect) calls submodules directly, so it gets a
+        # view of the model with a compiled backbone
+        self.staged = copy.copy(model)
+        self.staged._modules = copy.copy(model._modules)
+        self.staged.backbone = torch.compile(model.backbone, mode=mode, dynamic=True)
+
+    def __call__(self, image_tensors, with_masks=True, mask_score_thresh=None):
+        if with_masks is True and mask_score_thresh is None:
+            with torch.no_grad():
+                return self.compiled(list(image_tensors))
+        return detect(self.staged, image_tensors, with_masks=with_masks,
+                      mask_score_thresh=mask_score_thresh or 0.0)
+
+
+class QuantizedBackend(EagerBackend):
+    """Runs the int8 quantized model (see quantization.load_quantized_model)"""
+
+    name = 'int8'
+
+
+class TorchScriptBackend:
+    """Runs a model exported with export_torchscript"""
+
+    name = 'torchscript'
+
+    def __init__(self, artifact_path):
+        self.artifact_path = artifact_path
+        self.module = torch.jit.load(artifact_path, map_location='cpu')
+        self.module.eval()
+
+    def __call__(self, image_tensors, with_masks=True, mask_score_thresh=None):
+        with torch.no_grad():
+            output = self.module(list(image_tensors))
+        # Scripted detection models always return a (losses, detections) tuple
+        if isinstance(output, tuple):
+            output = output[1]
+        return output
+
+    def share_memory(self):
+        self.module.share_memory()
+        return self
+
+
+class OnnxRuntimeBackend:
+    """
+    Runs an exported ONNX graph with ONNX Runtime
+
+    The exported graph takes a single image, so a batch is run image by image
+    in one session. The session is created lazily so that forked inference
+    workers each build their own instead of inheriting the parent's. Unless
+    intra_op_threads is given it uses as many threads as torch is set to
+    (see cpu_threads.py).
+    """
+
+    name = 'onnx'
+
+    def __init__(self, artifact_path, intra_op_threads=0):
+        if not os.path.exists(artifact_path):
+            raise FileNotFoundError(f"ONNX model not found at {artifact_path}")
+        self.artifact_path = artifact_path
+        self.intra_op_threads = intra_op_threads
+        self._session = None
+        self._session_key = None
+
+    def _get_session(self):
+        threads = self.intra_op_threads or torch.get_num_threads()
+        if self._session is None or self._session_key != (os.getpid(), threads):
+            import onnxruntime as ort
+
+            options = ort.SessionOptions()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            options.intra_op_num_threads = threads
+            self._session = ort.InferenceSession(self.artifact_path, options,
+                                                 providers=['CPUExecutionProvider'])
+            self._session_key = (os.getpid(), threads)
+        return self._session
+
+    def __call__(self, image_tensors, with_masks=True, mask_score_thresh=None):
+        session = self._get_session()
+        input_name = session.get_inputs()[0].name
+        predictions = []
+        for image_tensor in image_tensors:
+            outputs = session.run(ONNX_OUTPUT_NAMES, {input_name: image_tensor.cpu().numpy()})
+            predictions.append({name: torch.from_numpy(np.asarray(value))
+                                for name, value in zip(ONNX_OUTPUT_NAMES, outputs)})
+        return predictions
+
+    def share_memory(self):
+        return self
+
+
+def create_backend(name, model=None, artifact_path=None):
+    """
+    Create an inference backend by name
+
+    Args:
+        name (str): One of BACKENDS
+        model: The loaded eager model (required for 'eager' and 'compile')
+        artifact_path (str, optional): Exported model for 'torchscript',
+            'onnx' or 'int8'
+
+    Returns:
+        A backend callable
+    """
+    if name == 'eager':
+        return EagerBackend(model)
+    if name == 'compile':
+        return CompiledBackend(model, mode=os.environ.get('INFERENCE_COMPILE_MODE') or None)
+    if name == 'torchscript':
+        return TorchScriptBackend(artifact_path)
+    if name == 'onnx':
+        return OnnxRuntimeBackend(artifact_path)
+    if name == 'int8':
+        from quantization import load_quantized_model
+
+        return QuantizedBackend(load_quantized_model(artifact_path))
+    raise ValueError(f"Unknown inference backend '{name}', expected one of {', '.join(BACKENDS)}")
+
+
+def create_profile_backends(name, model=None, artifact_path=None, profiles=(), default_profile=None):
+    """
+    Create one backend per inference profile
+
+    Backends that run a torchvision model (eager, compile, int8) get a view
+    of that model per profile, all sharing the same weights. Exported
+    backends (torchscript, onnx) have their profile baked in at export time
+    and only serve default_profile.
+
+    Returns:
+        dict: Profile name -> backend callable
+    """
+    from profiles import profile_model
+
+    base = create_backend(name, model, artifact_path)
+    if not isinstance(base, EagerBackend):
+        return {default_profile: base}
+
+    backends = {}
+    for profile in profiles:
+        view = profile_model(base.model, profile)
+        if name == 'compile':
+            backends[profile] = CompiledBackend(view, mode=os.environ.get('INFERENCE_COMPILE_MODE') or None)
+        else:
+            backends[profile] = type(base)(view)
+    return backends
+
+
+def export_torchscript(model, output_path):
+    """Script the eager model and save it for the 'torchscript' backend"""
+    scripted = torch.jit.script(model.eval())
+    scripted.save(output_path)
+    return output_path
+
+
+def export_onnx(model, output_path, sample_size=(512, 512), opset_version=17):
+    """Export the eager model to ONNX for the 'onnx' backend"""
+    sample = torch.rand(3, *sample_size)
+    export_kwargs = {}
+    # Newer torch defaults to the dynamo exporter, which cannot trace the
+    # torchvision detection models
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        export_kwargs['dynamo'] = False
+    torch.onnx.export(
+        model.eval(),
+        ([sample],),
+        output_path,
+        opset_version=opset_version,
+        input_names=['image'],
+        output_names=ONNX_OUTPUT_NAMES,
+        dynamic_axes={
+            'image': [1, 2],
+            'boxes': [0],
+            'labels': [0],
+            'scores': [0],
+            'masks': [0, 2, 3],
+        },
+        **export_kwargs,
+    )
+    return output_path
+
+
+def compare_predictions(reference, candidate, conf_thresh=0.5, box_atol=1.0, score_atol=1e-3):
+    """
+    Check that two predictions agree on the detections above a threshold
+
+    Args:
+        reference (dict): Prediction from the eager model
+        candidate (dict): Prediction from the backend under test
+        conf_thresh (float): Only detections scoring above this are compared
+        box_atol (float): Allowed box coordinate difference in pixels
+        score_atol (float): Allowed score difference
+
+    Returns:
+        tuple: (match (bool), details (dict))
+    """
+    ref_scores = reference['scores'].detach().cpu().numpy()
+    cand_scores = candidate['scores'].detach().cpu().numpy()
+    ref_keep = ref_scores > conf_thresh
+    cand_keep = cand_scores > conf_thresh
+
+    details = {
+        'referenceDetections': int(ref_keep.sum()),
+        'candidateDetections': int(cand_keep.sum()),
+        'maxBoxDiff': 0.0,
+        'maxScoreDiff': 0.0,
+    }
+    if details['referenceDetections'] != details['candidateDetections']:
+        return False, details
+    if not ref_keep.any():
+        return True, details
+
+    ref_boxes = reference['boxes'].detach().cpu().numpy()[ref_keep]
+    cand_boxes = candidate['boxes'].detach().cpu().numpy()[cand_keep]
+    details['maxBoxDiff'] = float(np.abs(ref_boxes - cand_boxes).max())
+    details['maxScoreDiff'] = float(np.abs(ref_scores[ref_keep] - cand_scores[cand_keep]).max())
+    match = details['maxBoxDiff'] <= box_atol and details['maxScoreDiff'] <= score_atol
+    return match, details
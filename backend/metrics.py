@@ -0,0 +1,295 @@
+"""
+Low-overhead request and stage metrics in the Prometheus text format
+
+Histograms, counters and gauges are kept in process and rendered by
+render() for /metrics. Recording a value is a perf_counter call and a short
+critical section, cheap enough to wrap every stage of every request.
+
+Stage timings are recorded with stage(), e.g. `with stage('decode'): ...`,
+into the tumor_stage_duration_seconds histogram. Inference worker processes
+can't update the server's histograms directly, so they buffer their
+observations (see start_buffering) and send them back with each result to be
+replayed in the server by record_observations.
+"""
+
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds, from sub-millisecond decode/encode up to slow CPU forward passes
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    """A value that only goes up"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in values]
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, or is read from a callback at render time"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        """
+        Args:
+            callback (callable, optional): Returns the value, or a dict of
+                label value tuples -> value for labelled gauges
+        """
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self._values = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def _samples(self):
+        if self.callback is not None:
+            try:
+                value = self.callback()
+            except Exception as e:
+                print(f"Metrics: could not read {self.name}: {e}")
+                return []
+            values = value.items() if isinstance(value, dict) else [((), value)]
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(values) if value is not None]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        self._observe(self._key(labels), value)
+
+    def _observe(self, key, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 3)
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the block takes"""
+        key = self._key(labels)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._observe(key, time.perf_counter() - start)
+
+    def _samples(self):
+        with self._lock:
+            series = sorted((key, list(values)) for key, values in self._series.items())
+        lines = []
+        for key, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values):
+                cumulative += count
+                lines.append(f"{self.name}_bucket"
+                             f"{_format_labels(self.labelnames, key, ('le', _format_value(float(bound))))}"
+                             f" {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(values[-2])}")
+            lines.append(f"{self.name}_count{labels} {values[-1]}")
+        return lines
+
+
+class Registry:
+    """The set of metrics rendered by /metrics"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=(), callback=None):
+    return REGISTRY.register(Gauge(name, documentation, labelnames, callback))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def render():
+    return REGISTRY.render()
+
+
+STAGE_SECONDS = histogram('tumor_stage_duration_seconds',
+                          'Time spent in each stage of analyzing an image', ['stage'])
+
+# Observations buffered by an inference worker process, see start_buffering
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def start_buffering():
+    """
+    Buffer stage observations instead of recording them
+
+    Called in inference worker processes, whose own histograms are never
+    rendered; take_observations hands the buffer to the server process.
+    """
+    global _buffer
+    _buffer = []
+
+
+def take_observations():
+    """Return and clear the buffered (stage, seconds) observations"""
+    global _buffer
+    if _buffer is None:
+        return []
+    with _buffer_lock:
+        observations, _buffer = _buffer, []
+    return observations
+
+
+def record_observations(observations):
+    """Record stage observations sent by an inference worker"""
+    for name, seconds in observations:
+        STAGE_SECONDS.observe(seconds, stage=name)
+
+
+def observe_stage(name, seconds):
+    """Record one stage duration"""
+    if _buffer is not None:
+        with _buffer_lock:
+            _buffer.append((name, seconds))
+    else:
+        STAGE_SECONDS.observe(seconds, stage=name)
+
+
+@contextmanager
+def stage(name):
+    """Time a block as one stage of the analysis"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+def process_rss_bytes(pid=None):
+    """Resident set size of a process (this one by default), or None if unknown"""
+    try:
+        with open(f"/proc/{pid or 'self'}/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    if pid is None:
+        try:
+            import resource
+
+            # Peak rather than current RSS, in KiB on Linux and bytes on macOS
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxrss if os.uname().sysname == 'Darwin' else maxrss * 1024
+        except (ImportError, AttributeError):
+            pass
+    return None
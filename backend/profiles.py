@@ -0,0 +1,99 @@
+"""
+Named inference profiles for the tumor detection model
+
+A profile sets the input resolution, the number of RPN proposals kept before
+and after NMS, and the box score threshold and detection count of the ROI
+heads. "accurate" is torchvision's default Mask R-CNN configuration. The
+others are sized for Br35H-style MRI slices (~256-512 px), where analyze_image
+only ever reports the best box above the confidence threshold.
+"""
+
+import copy
+
+INFERENCE_PROFILES = {
+    'accurate': {
+        'min_size': 800,
+        'max_size': 1333,
+        'rpn_pre_nms_top_n_test': 1000,
+        'rpn_post_nms_top_n_test': 1000,
+        'box_score_thresh': 0.05,
+        'box_detections_per_img': 100,
+    },
+    'balanced': {
+        'min_size': 512,
+        'max_size': 853,
+        'rpn_pre_nms_top_n_test': 500,
+        'rpn_post_nms_top_n_test': 300,
+        'box_score_thresh': 0.3,
+        'box_detections_per_img': 20,
+    },
+    'fast': {
+        'min_size': 384,
+        'max_size': 640,
+        'rpn_pre_nms_top_n_test': 200,
+        'rpn_post_nms_top_n_test': 100,
+        'box_score_thresh': 0.5,
+        'box_detections_per_img': 5,
+    },
+}
+
+DEFAULT_PROFILE = 'accurate'
+
+
+def get_profile(name):
+    """
+    Look up a profile's settings by name
+
+    Raises:
+        ValueError: If the profile does not exist
+    """
+    name = name or DEFAULT_PROFILE
+    if name not in INFERENCE_PROFILES:
+        raise ValueError(f"Unknown inference profile '{name}', "
+                         f"expected one of {', '.join(INFERENCE_PROFILES)}")
+    return dict(INFERENCE_PROFILES[name])
+
+
+def profile_model(model, name):
+    """
+    Make a view of a loaded model that runs with a profile's settings
+
+    The returned model shares every parameter and buffer with the original,
+    only the transform and the RPN/ROI head settings differ, so one set of
+    weights can serve all profiles at once.
+
+    Args:
+        model: A loaded torchvision Mask R-CNN model
+        name (str): Profile name
+
+    Returns:
+        The profiled model
+    """
+    from torchvision.models.detection.transform import GeneralizedRCNNTransform
+
+    settings = get_profile(name)
+
+    view = copy.copy(model)
+    view._modules = copy.copy(model._modules)
+
+    view.transform = GeneralizedRCNNTransform(
+        settings['min_size'], settings['max_size'],
+        model.transform.image_mean, model.transform.image_std,
+        size_divisible=model.transform.size_divisible,
+        fixed_size=model.transform.fixed_size,
+    )
+    # A fresh module starts in training mode, where the transform skips
+    # rescaling detections back to the input image size
+    view.transform.train(model.transform.training)
+
+    rpn = copy.copy(model.rpn)
+    rpn._pre_nms_top_n = dict(model.rpn._pre_nms_top_n, testing=settings['rpn_pre_nms_top_n_test'])
+    rpn._post_nms_top_n = dict(model.rpn._post_nms_top_n, testing=settings['rpn_post_nms_top_n_test'])
+    view.rpn = rpn
+
+    roi_heads = copy.copy(model.roi_heads)
+    roi_heads.score_thresh = settings['box_score_thresh']
+    roi_heads.detections_per_img = settings['box_detections_per_img']
+    view.roi_heads = roi_heads
+
+    return view
@@ -0,0 +1,105 @@
+"""
+On-demand torch profiler captures of single inference requests
+
+A request picked for profiling (by header or by sampling, see app.py) skips
+the batching queue and its forward pass runs under torch.profiler with CPU
+activities, input shapes and memory recorded. The Chrome trace (open it in
+chrome://tracing or Perfetto) and a text table of the most expensive
+operators are written to a TraceStore, which keeps only the newest traces.
+
+Nothing here is touched by requests that are not profiled.
+"""
+
+import os
+import re
+import threading
+import time
+import uuid
+
+DEFAULT_TRACE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'traces')
+
+TRACE_ID_PATTERN = re.compile(r'^[0-9]+-[0-9a-f]{8}$')
+
+
+def run_profiled(forward, trace_path):
+    """
+    Call forward() under torch.profiler and write the trace
+
+    Args:
+        forward (callable): The forward pass to profile, called with no arguments
+        trace_path (str): Where to write the Chrome trace (.json); the
+            operator summary goes next to it as .txt
+
+    Returns:
+        Whatever forward() returns
+    """
+    from torch.profiler import ProfilerActivity, profile
+
+    with profile(activities=[ProfilerActivity.CPU], record_shapes=True, profile_memory=True) as prof:
+        output = forward()
+
+    prof.export_chrome_trace(trace_path)
+    summary = prof.key_averages(group_by_input_shape=True).table(sort_by='self_cpu_time_total', row_limit=30)
+    with open(f"{os.path.splitext(trace_path)[0]}.txt", 'w') as f:
+        f.write(summary)
+    return output
+
+
+class TraceStore:
+    """
+    Directory of captured traces that keeps the newest `max_traces`
+    """
+
+    def __init__(self, directory=DEFAULT_TRACE_DIR, max_traces=20):
+        self.directory = directory
+        self.max_traces = max(1, int(max_traces))
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def new_trace(self):
+        """
+        Reserve a trace ID and make room for it
+
+        Returns:
+            tuple: (trace_id (str), trace_path (str))
+        """
+        trace_id = f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}"
+        with self._lock:
+            traces = self.list()
+            for trace in traces[self.max_traces - 1:]:
+                for path in self._paths(trace['traceId']):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+        return trace_id, self._paths(trace_id)[0]
+
+    def list(self):
+        """Captured traces, newest first"""
+        traces = []
+        for filename in os.listdir(self.directory):
+            trace_id, extension = os.path.splitext(filename)
+            if extension != '.json' or not TRACE_ID_PATTERN.match(trace_id):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, filename))
+            except OSError:
+                continue
+            traces.append({
+                'traceId': trace_id,
+                'createdAt': int(trace_id.split('-')[0]) / 1000.0,
+                'sizeBytes': stat.st_size,
+            })
+        traces.sort(key=lambda trace: trace['traceId'], reverse=True)
+        return traces
+
+    def path(self, trace_id, summary=False):
+        """Path of a trace (or its operator summary), or None if it doesn't exist"""
+        if not TRACE_ID_PATTERN.match(trace_id or ''):
+            return None
+        path = self._paths(trace_id)[1 if summary else 0]
+        return path if os.path.exists(path) else None
+
+    def _paths(self, trace_id):
+        base = os.path.join(self.directory, trace_id)
+        return f"{base}.json", f"{base}.txt"
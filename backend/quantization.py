@@ -0,0 +1,132 @@
+"""
+Int8 quantized variant of the tumor detection model
+
+The ResNet-50 body of the backbone is statically quantized with FX graph mode
+quantization, calibrated on real MRI slices. The linear layers of the box head
+are dynamically quantized. The FPN, RPN and mask head stay in fp32.
+
+Only the int8 state dict is saved. Loading rebuilds the quantized graph from
+the exact fp32 architecture that was calibrated (FrozenBatchNorm2d backbone,
+see checkpoints.build_maskrcnn) and then loads the saved weights, scales and
+zero points into it.
+"""
+
+import copy
+
+import torch
+from torch import nn
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from torchvision.ops.misc import FrozenBatchNorm2d
+
+from checkpoints import build_maskrcnn
+
+QUANTIZATION_BACKEND = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'fbgemm'
+
+
+def _fold_frozen_bn(conv, bn):
+    """Fold a FrozenBatchNorm2d into the preceding convolution"""
+    scale = bn.weight * torch.rsqrt(bn.running_var + bn.eps)
+    conv.weight.data.mul_(scale.reshape(-1, 1, 1, 1))
+    bias = bn.bias - bn.running_mean * scale
+    if conv.bias is None:
+        conv.bias = nn.Parameter(bias.detach().clone())
+    else:
+        conv.bias.data.mul_(scale).add_(bias)
+
+
+def fold_batch_norms(module):
+    """
+    Fold every conv -> FrozenBatchNorm2d pair in a ResNet body in place
+
+    torchvision detection backbones use FrozenBatchNorm2d, which the
+    quantization fuser does not recognise. Folding it into the convolutions
+    leaves plain conv/relu/add graphs that quantize cleanly.
+    """
+    for parent in module.modules():
+        children = dict(parent.named_children())
+        if isinstance(parent, nn.Sequential):
+            names = list(children)
+            for conv_name, bn_name in zip(names, names[1:]):
+                if isinstance(children[conv_name], nn.Conv2d) and isinstance(children[bn_name], FrozenBatchNorm2d):
+                    _fold_frozen_bn(children[conv_name], children[bn_name])
+                    parent._modules[bn_name] = nn.Identity()
+            continue
+
+        for name, child in children.items():
+            if not (isinstance(child, FrozenBatchNorm2d) and name.startswith('bn')):
+                continue
+            conv = children.get('conv' + name[len('bn'):])
+            if isinstance(conv, nn.Conv2d):
+                _fold_frozen_bn(conv, child)
+                setattr(parent, name, nn.Identity())
+    return module
+
+
+def prepare_backbone(model, example_size=(512, 512)):
+    """
+    Replace the backbone body with an observed FX graph ready for calibration
+
+    Returns:
+        The same model, with model.backbone.body prepared for calibration
+    """
+    torch.backends.quantized.engine = QUANTIZATION_BACKEND
+    body = fold_batch_norms(model.backbone.body)
+    example_inputs = (torch.rand(1, 3, *example_size),)
+    model.backbone.body = prepare_fx(body.eval(), get_default_qconfig_mapping(QUANTIZATION_BACKEND),
+                                     example_inputs)
+    return model
+
+
+def convert_model(model):
+    """
+    Convert a calibrated model to int8
+
+    The observed backbone body becomes a quantized graph and the box head's
+    linear layers are dynamically quantized.
+    """
+    model.backbone.body = convert_fx(model.backbone.body)
+    model.roi_heads = quantize_dynamic(model.roi_heads, {nn.Linear}, dtype=torch.qint8)
+    return model.eval()
+
+
+def quantize_model(fp32_model, calibration_tensors):
+    """
+    Build an int8 copy of the fp32 model calibrated on the given images
+
+    Args:
+        fp32_model: The loaded eager model
+        calibration_tensors (list): CHW float image tensors
+
+    Returns:
+        The quantized model (the fp32 model is left untouched)
+    """
+    model = prepare_backbone(copy.deepcopy(fp32_model).eval())
+    with torch.no_grad():
+        for image_tensor in calibration_tensors:
+            model([image_tensor])
+    return convert_model(model)
+
+
+def save_quantized_model(model, output_path):
+    """Save the int8 state dict for load_quantized_model"""
+    torch.save(model.state_dict(), output_path)
+    return output_path
+
+
+def load_quantized_model(int8_path):
+    """
+    Load int8 weights saved by save_quantized_model
+
+    Returns:
+        The quantized model in eval mode
+    """
+    # The graph must be traced from the same architecture as at calibration:
+    # with a plain BatchNorm2d backbone nothing is folded and the quantized
+    # graph's scale and zero point names differ. Conversion needs real
+    # tensors, so the placeholder weights are allocated rather than on meta.
+    model = build_maskrcnn(num_classes=2).eval()
+    model = convert_model(prepare_backbone(model))
+    model.load_state_dict(torch.load(int8_path, map_location=torch.device('cpu')))
+    print(f"Int8 model loaded successfully from {int8_path}")
+    return model.eval()
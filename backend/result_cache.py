@@ -0,0 +1,243 @@
+"""
+Content-addressed cache of tumor detection results
+
+Entries are keyed by a digest of the decoded pixels, the model weights
+fingerprint and the detection settings, so re-submitting the same image skips
+inference entirely. Each entry holds the result dict (serialized as JSON, so
+every lookup gets its own copy of the nested findings) and the encoded
+overlay. There is an in-process LRU tier bounded by bytes and an optional
+on-disk tier that survives restarts.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+
+def file_fingerprint(path, chunk_size=1024 * 1024):
+    """SHA-256 of a file's contents, or 'unknown' if it cannot be read"""
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+    except OSError as e:
+        print(f"Warning: Could not fingerprint {path}: {e}")
+        return 'unknown'
+    return digest.hexdigest()
+
+
+def make_cache_key(image, model_fingerprint, settings=None):
+    """
+    Build a cache key for a decoded image
+
+    Args:
+        image (ndarray): Decoded image array
+        model_fingerprint (str): Fingerprint of the model weights
+        settings (dict, optional): Detection settings that affect the result
+
+    Returns:
+        str: Hex digest identifying the (image, model, settings) combination
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{image.shape}|{image.dtype}|".encode('utf-8'))
+    digest.update(image.tobytes())
+    digest.update(model_fingerprint.encode('utf-8'))
+    digest.update(json.dumps(settings or {}, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Two-tier LRU cache of (result dict, overlay bytes) pairs
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, disk_dir=None, disk_max_bytes=1024 * 1024 * 1024):
+        """
+        Args:
+            max_bytes (int): Memory budget for the in-process tier
+            disk_dir (str, optional): Directory for the on-disk tier. If None,
+                only the in-process tier is used.
+            disk_max_bytes (int): Size budget for the on-disk tier
+        """
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> (result JSON, image_bytes, size)
+        self._memory_bytes = 0
+        self._disk = OrderedDict()  # key -> size on disk
+        self._disk_bytes = 0
+        self._counters = {
+            'hits': 0,
+            'diskHits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'diskEvictions': 0,
+        }
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._load_disk_index()
+
+    def get(self, key):
+        """
+        Look up a cached entry
+
+        Returns:
+            tuple or None: (result (dict), image_bytes (bytes)) on a hit
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self._counters['hits'] += 1
+                return json.loads(entry[0]), entry[1]
+
+            on_disk = key in self._disk
+
+        if on_disk:
+            entry = self._read_disk(key)
+            if entry is not None:
+                with self._lock:
+                    self._counters['hits'] += 1
+                    self._counters['diskHits'] += 1
+                    if key in self._disk:
+                        self._disk.move_to_end(key)
+                    self._put_memory(key, entry[0], entry[1])
+                return json.loads(entry[0]), entry[1]
+
+        with self._lock:
+            self._counters['misses'] += 1
+        return None
+
+    def put(self, key, result, image_bytes):
+        """Store a result dict and its encoded overlay under key"""
+        # Later changes to the caller's result must not reach the cache
+        result_json = json.dumps(result)
+        with self._lock:
+            self._put_memory(key, result_json, image_bytes)
+
+        if self.disk_dir:
+            self._write_disk(key, result_json, image_bytes)
+
+    def stats(self):
+        """Hit/miss/eviction counters and current sizes of both tiers"""
+        with self._lock:
+            lookups = self._counters['hits'] + self._counters['misses']
+            return {
+                **self._counters,
+                'hitRate': round(self._counters['hits'] / lookups, 4) if lookups else 0.0,
+                'entries': len(self._memory),
+                'bytes': self._memory_bytes,
+                'maxBytes': self.max_bytes,
+                'diskEnabled': bool(self.disk_dir),
+                'diskEntries': len(self._disk),
+                'diskBytes': self._disk_bytes,
+                'diskMaxBytes': self.disk_max_bytes if self.disk_dir else 0,
+            }
+
+    def _put_memory(self, key, result_json, image_bytes):
+        """Insert into the memory tier and evict LRU entries; caller holds the lock"""
+        size = len(image_bytes) + len(result_json)
+        if size > self.max_bytes:
+            return
+
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= old[2]
+
+        self._memory[key] = (result_json, image_bytes, size)
+        self._memory_bytes += size
+
+        while self._memory_bytes > self.max_bytes:
+            _, (_, _, evicted_size) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted_size
+            self._counters['evictions'] += 1
+
+    def _disk_paths(self, key):
+        folder = os.path.join(self.disk_dir, key[:2])
+        return os.path.join(folder, f"{key}.json"), os.path.join(folder, f"{key}.jpg")
+
+    def _load_disk_index(self):
+        """Rebuild the on-disk LRU index, oldest files first"""
+        entries = []
+        for folder in os.listdir(self.disk_dir):
+            folder_path = os.path.join(self.disk_dir, folder)
+            if not os.path.isdir(folder_path):
+                continue
+            for filename in os.listdir(folder_path):
+                if not filename.endswith('.json'):
+                    continue
+                key = filename[:-len('.json')]
+                json_path, image_path = self._disk_paths(key)
+                try:
+                    size = os.path.getsize(json_path) + os.path.getsize(image_path)
+                    mtime = os.path.getmtime(json_path)
+                except OSError:
+                    continue
+                entries.append((mtime, key, size))
+
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+        print(f"Result cache: {len(self._disk)} entries ({self._disk_bytes} bytes) on disk in {self.disk_dir}")
+
+    def _read_disk(self, key):
+        json_path, image_path = self._disk_paths(key)
+        try:
+            with open(json_path, 'r') as f:
+                result_json = f.read()
+            json.loads(result_json)
+            with open(image_path, 'rb') as f:
+                image_bytes = f.read()
+        except (OSError, ValueError) as e:
+            print(f"Result cache: dropping unreadable disk entry {key}: {e}")
+            with self._lock:
+                size = self._disk.pop(key, None)
+                if size is not None:
+                    self._disk_bytes -= size
+            return None
+        return result_json, image_bytes
+
+    def _write_disk(self, key, result_json, image_bytes):
+        json_path, image_path = self._disk_paths(key)
+        try:
+            os.makedirs(os.path.dirname(json_path), exist_ok=True)
+            # Write the overlay first and the JSON last so a readable JSON
+            # file always has its overlay next to it
+            for path, data, mode in ((image_path, image_bytes, 'wb'),
+                                     (json_path, result_json, 'w')):
+                temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+                with open(temp_path, mode) as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+            size = os.path.getsize(json_path) + os.path.getsize(image_path)
+        except OSError as e:
+            print(f"Result cache: failed to write disk entry {key}: {e}")
+            return
+
+        evicted = []
+        with self._lock:
+            old_size = self._disk.pop(key, None)
+            if old_size is not None:
+                self._disk_bytes -= old_size
+            self._disk[key] = size
+            self._disk_bytes += size
+
+            while self._disk_bytes > self.disk_max_bytes and len(self._disk) > 1:
+                evicted_key, evicted_size = self._disk.popitem(last=False)
+                self._disk_bytes -= evicted_size
+                self._counters['diskEvictions'] += 1
+                evicted.append(evicted_key)
+
+        for evicted_key in evicted:
+            for path in self._disk_paths(evicted_key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
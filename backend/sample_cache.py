@@ -0,0 +1,189 @@
+"""
+Caches for scanning sample images from Firebase
+
+Scanning a sample used to cost a Firestore read for its metadata and a
+Storage download of the image every time. TTLCache keeps the metadata (and
+the blob generation it points at) in memory for a short while, and BlobCache
+keeps downloaded blobs on disk keyed by storage path and generation, so a
+repeated scan of the same sample needs no network round trip at all. A blob
+that is replaced in Storage gets a new generation and is downloaded again
+once the cached metadata expires.
+"""
+
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+DEFAULT_SAMPLE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample_cache')
+
+
+class TTLCache:
+    """
+    In-memory mapping whose entries expire after ttl seconds
+    """
+
+    def __init__(self, ttl=60.0, max_entries=1024):
+        """
+        Args:
+            ttl (float): Seconds an entry stays valid, 0 disables the cache
+            max_entries (int): Least recently used entries are dropped beyond this
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._counters = {'hits': 0, 'misses': 0, 'expired': 0}
+
+    def get(self, key):
+        """The cached value, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self._counters['hits'] += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+                self._counters['expired'] += 1
+            self._counters['misses'] += 1
+            return None
+
+    def put(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """Drop one entry, or all of them"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, 'entries': len(self._entries), 'ttlSeconds': self.ttl}
+
+
+class BlobCache:
+    """
+    Byte-bounded on-disk LRU cache of downloaded Storage blobs
+    """
+
+    def __init__(self, directory=DEFAULT_SAMPLE_CACHE_DIR, max_bytes=256 * 1024 * 1024):
+        """
+        Args:
+            directory (str): Where the blobs are kept
+            max_bytes (int): Size budget, least recently used blobs are removed beyond it
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # file name -> size, least recently used first
+        self._bytes = 0
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def _filename(storage_path, generation):
+        key = f"{storage_path}#{generation}"
+        return f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.blob"
+
+    def get(self, storage_path, generation):
+        """
+        Cached bytes of one generation of a blob
+
+        Returns:
+            bytes or None
+        """
+        filename = self._filename(storage_path, generation)
+        try:
+            with open(os.path.join(self.directory, filename), 'rb') as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                self._counters['misses'] += 1
+                size = self._index.pop(filename, None)
+                if size is not None:
+                    self._bytes -= size
+            return None
+
+        with self._lock:
+            self._counters['hits'] += 1
+        self._add(filename, len(data))
+        return data
+
+    def put(self, storage_path, generation, data):
+        """Store the bytes of one generation of a blob"""
+        filename = self._filename(storage_path, generation)
+        path = os.path.join(self.directory, filename)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Sample cache: failed to write {storage_path}: {e}")
+            return
+        self._add(filename, len(data))
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, 'entries': len(self._index), 'bytes': self._bytes,
+                    'maxBytes': self.max_bytes}
+
+    def _add(self, filename, size):
+        evicted = []
+        with self._lock:
+            old_size = self._index.pop(filename, None)
+            if old_size is not None:
+                self._bytes -= old_size
+            self._index[filename] = size
+            self._bytes += size
+
+            while self._bytes > self.max_bytes and len(self._index) > 1:
+                evicted_name, evicted_size = self._index.popitem(last=False)
+                self._bytes -= evicted_size
+                self._counters['evictions'] += 1
+                evicted.append(evicted_name)
+
+        for evicted_name in evicted:
+            try:
+                os.remove(os.path.join(self.directory, evicted_name))
+            except OSError:
+                pass
+
+    def _load_index(self):
+        """Rebuild the LRU index from the directory, oldest files first"""
+        entries = []
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename.endswith('.tmp'):
+                try:
+                    if time.time() - os.path.getmtime(path) > 3600:
+                        os.remove(path)
+                except OSError:
+                    pass
+                continue
+            if not filename.endswith('.blob'):
+                continue
+            try:
+                entries.append((os.path.getmtime(path), filename, os.path.getsize(path)))
+            except OSError:
+                continue
+
+        for _, filename, size in sorted(entries):
+            self._index[filename] = size
+            self._bytes += size
+        print(f"Sample cache: {len(self._index)} blobs ({self._bytes} bytes) in {self.directory}")
@@ -0,0 +1,118 @@
+"""
+Precomputed scan results for the sample images
+
+Users pick samples from a small, fixed set, so scripts/precompute_samples.py
+runs the model over every sample ahead of time and stores the result JSON and
+the processed overlay here. Entries are keyed by the sample's storage path
+and blob generation, the model fingerprint and the detection settings, so a
+replaced sample or a new model simply misses and /api/scan-sample falls back
+to live inference.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+DEFAULT_GALLERY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample_gallery')
+
+# Fields that describe one request rather than the image
+PER_REQUEST_FIELDS = ('inference', 'cacheHit', 'profileTrace', 'uploadJobId', 'uploadStatusUrl',
+                      'processedImageId', 'processedImageUrl', 'processedImageData')
+
+
+def gallery_key(storage_path, generation, model_fingerprint, settings):
+    """Hex digest identifying one sample generation analyzed by one model with some settings"""
+    payload = json.dumps([storage_path, str(generation), model_fingerprint, settings], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class SampleGallery:
+    """
+    Directory of precomputed (result, overlay) pairs
+    """
+
+    def __init__(self, directory=DEFAULT_GALLERY_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0}
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return f"{base}.json", f"{base}.jpg"
+
+    def get(self, storage_path, generation, model_fingerprint, settings):
+        """
+        Look up a precomputed result
+
+        Returns:
+            tuple or None: (result (dict), overlay_bytes (bytes))
+        """
+        json_path, image_path = self._paths(gallery_key(storage_path, generation, model_fingerprint, settings))
+        try:
+            with open(json_path, 'r') as f:
+                entry = json.load(f)
+            with open(image_path, 'rb') as f:
+                overlay = f.read()
+        except (OSError, ValueError):
+            with self._lock:
+                self._counters['misses'] += 1
+            return None
+
+        with self._lock:
+            self._counters['hits'] += 1
+        return entry['result'], overlay
+
+    def put(self, storage_path, generation, model_fingerprint, settings, result, overlay):
+        """
+        Store a result and its overlay
+
+        Returns:
+            str: The entry's key
+        """
+        key = gallery_key(storage_path, generation, model_fingerprint, settings)
+        json_path, image_path = self._paths(key)
+        entry = {
+            'storagePath': storage_path,
+            'generation': generation,
+            'modelFingerprint': model_fingerprint,
+            'settings': settings,
+            'result': {name: value for name, value in result.items() if name not in PER_REQUEST_FIELDS},
+        }
+        # Overlay first, JSON last: a readable JSON file always has its overlay
+        for path, data, mode in ((image_path, overlay, 'wb'), (json_path, json.dumps(entry), 'w')):
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(temp_path, mode) as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        return key
+
+    def has(self, storage_path, generation, model_fingerprint, settings):
+        json_path, _ = self._paths(gallery_key(storage_path, generation, model_fingerprint, settings))
+        return os.path.exists(json_path)
+
+    def keys(self):
+        return {filename[:-len('.json')] for filename in os.listdir(self.directory) if filename.endswith('.json')}
+
+    def prune(self, keep):
+        """
+        Remove every entry whose key is not in keep
+
+        Returns:
+            int: Number of entries removed
+        """
+        removed = 0
+        for key in self.keys() - set(keep):
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            removed += 1
+        return removed
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, 'entries': len(self.keys())}
@@ -0,0 +1,219 @@
+"""
+Firestore index of the sample images in Firebase Storage
+
+Listing samples used to walk bucket.list_blobs over the whole samples folder,
+filtering extensions in Python and calling make_public per blob, so a page
+of samples cost time proportional to the bucket. The index keeps one
+Firestore document per sample image, written when the sample is uploaded
+(and backfilled with SampleIndex.rebuild or scripts/upload_samples_to_firebase.py
+--reindex). A page is then one query, filtered and ordered by Firestore,
+with the position encoded in an opaque cursor. Pages are cached in memory
+for a few seconds.
+
+The queries need two composite indexes on the collection:
+(owner, storagePath) and (owner, extension, storagePath).
+"""
+
+import base64
+import hashlib
+import os
+
+import cloud_client
+from sample_cache import TTLCache
+
+INDEX_COLLECTION = 'sampleIndex'
+# Owner of the shared samples under samples/
+SHARED_OWNER = ''
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp')
+MAX_PAGE_SIZE = 100
+# Firestore's limit of writes per batch
+WRITE_BATCH_SIZE = 500
+
+
+def sample_folder(owner=SHARED_OWNER):
+    """Storage folder of an owner's samples"""
+    return f"users/{owner}/samples/" if owner else "samples/"
+
+
+def sample_owner(storage_path):
+    """
+    Owner of the sample at storage_path
+
+    Returns:
+        str or None: A user ID, SHARED_OWNER, or None if the path is not a sample image
+    """
+    if storage_path.endswith('/') or not storage_path.lower().endswith(IMAGE_EXTENSIONS):
+        return None
+    parts = storage_path.split('/')
+    if parts[0] == 'samples' and len(parts) > 1:
+        return SHARED_OWNER
+    if len(parts) > 3 and parts[0] == 'users' and parts[2] == 'samples':
+        return parts[1]
+    return None
+
+
+def encode_cursor(storage_path):
+    return base64.urlsafe_b64encode(storage_path.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Raises:
+        ValueError: If the cursor was not returned by SampleIndex.list
+    """
+    try:
+        return base64.b64decode(cursor.encode('ascii'), altchars=b'-_', validate=True).decode('utf-8')
+    except (UnicodeError, ValueError):
+        raise ValueError('Invalid cursor')
+
+
+def entry_for_blob(blob):
+    """
+    Index entry of an uploaded Storage blob
+
+    Returns:
+        dict or None: None if the blob is not a sample image
+    """
+    owner = sample_owner(blob.name)
+    if owner is None:
+        return None
+    return {
+        'storagePath': blob.name,
+        'name': os.path.basename(blob.name),
+        'owner': owner,
+        'extension': os.path.splitext(blob.name)[1].lower().lstrip('.'),
+        'size': blob.size,
+        'contentType': blob.content_type,
+        'url': blob.public_url,
+        'generation': blob.generation,
+    }
+
+
+class SampleIndex:
+    """
+    Sample entries in a Firestore collection, listed a page at a time
+    """
+
+    def __init__(self, db, collection=INDEX_COLLECTION, cache_ttl=30.0):
+        """
+        Args:
+            db: Firestore client
+            collection (str): Collection holding the entries
+            cache_ttl (float): Seconds a listed page is reused, 0 disables the cache
+        """
+        self.db = db
+        self.collection = collection
+        self.pages = TTLCache(ttl=cache_ttl, max_entries=256)
+
+    def _document(self, storage_path):
+        # Storage paths contain slashes, which document IDs can't
+        document_id = hashlib.sha256(storage_path.encode('utf-8')).hexdigest()
+        return self.db.collection(self.collection).document(document_id)
+
+    def _write(self, operations):
+        """Apply (storage_path, entry or None to delete) pairs in batched writes"""
+        count = 0
+        batch = self.db.batch()
+        for storage_path, entry in operations:
+            if entry is None:
+                batch.delete(self._document(storage_path))
+            else:
+                batch.set(self._document(storage_path), entry)
+            count += 1
+            if count % WRITE_BATCH_SIZE == 0:
+                cloud_client.call('firestore.write', batch.commit)
+                batch = self.db.batch()
+        if count % WRITE_BATCH_SIZE:
+            cloud_client.call('firestore.write', batch.commit)
+        if count:
+            self.pages.invalidate()
+        return count
+
+    def upsert(self, entries):
+        """
+        Add or replace entries (see entry_for_blob)
+
+        Returns:
+            int: Number of entries written
+        """
+        return self._write((entry['storagePath'], entry) for entry in entries if entry is not None)
+
+    def remove(self, storage_paths):
+        """Remove the entries of deleted samples"""
+        return self._write((storage_path, None) for storage_path in storage_paths)
+
+    def list(self, owner=SHARED_OWNER, limit=20, cursor=None, extension=None, name_prefix=None):
+        """
+        One page of an owner's samples, ordered by storage path
+
+        Args:
+            owner (str): User ID, or SHARED_OWNER for the shared samples
+            limit (int): Page size, at most MAX_PAGE_SIZE
+            cursor (str, optional): next_cursor of the previous page
+            extension (str, optional): Only images with this extension (e.g. "png")
+            name_prefix (str, optional): Only images whose file name starts with this
+
+        Returns:
+            tuple: (entries (list of dicts), next_cursor (str or None on the last page))
+
+        Raises:
+            ValueError: If the cursor is invalid
+        """
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        extension = extension.lower().lstrip('.') if extension else None
+        key = (owner, limit, cursor, extension, name_prefix)
+        page = self.pages.get(key)
+        if page is not None:
+            return page
+
+        # Paths starting with start sort below start + U+F8FF
+        start = sample_folder(owner) + (name_prefix or '')
+        query = self.db.collection(self.collection).where('owner', '==', owner)
+        if extension:
+            query = query.where('extension', '==', extension)
+        query = query.where('storagePath', '>=', start).where('storagePath', '<', start + '\uf8ff')
+        query = query.order_by('storagePath')
+        if cursor:
+            query = query.start_after({'storagePath': decode_cursor(cursor)})
+
+        # One extra entry tells whether there is a next page
+        query = query.limit(limit + 1)
+        entries = cloud_client.call('firestore.query', lambda timeout, retry: [
+            snapshot.to_dict() for snapshot in query.stream(timeout=timeout, retry=retry)])
+        next_cursor = encode_cursor(entries[limit - 1]['storagePath']) if len(entries) > limit else None
+        page = (entries[:limit], next_cursor)
+        self.pages.put(key, page)
+        return page
+
+    def sync(self, owner, blobs):
+        """
+        Make an owner's entries match a listing of their sample folder
+
+        Returns:
+            tuple: (entries written, entries removed)
+        """
+        entries = [entry for entry in map(entry_for_blob, blobs)
+                   if entry is not None and entry['owner'] == owner]
+        written = self.upsert(entries)
+
+        current = {entry['storagePath'] for entry in entries}
+        query = self.db.collection(self.collection).where('owner', '==', owner).select(['storagePath'])
+        indexed = cloud_client.call('firestore.query', lambda timeout, retry: {
+            snapshot.get('storagePath') for snapshot in query.stream(timeout=timeout, retry=retry)})
+        return written, self.remove(indexed - current)
+
+    def rebuild(self, bucket, owners=(SHARED_OWNER,)):
+        """
+        Backfill the owners' entries from Storage and drop entries of deleted samples
+
+        Returns:
+            tuple: (entries written, entries removed)
+        """
+        written = removed = 0
+        for owner in owners:
+            blobs = cloud_client.call('storage.list', lambda timeout, retry: list(
+                bucket.list_blobs(prefix=sample_folder(owner), timeout=timeout, retry=retry)))
+            owner_written, owner_removed = self.sync(owner, blobs)
+            written += owner_written
+            removed += owner_removed
+        return written, removed
@@ -0,0 +1,254 @@
+"""
+Scan results in Firestore: batched writes and paginated history reads
+
+Saving a scan used to be one doc_ref.set() round trip per scan, and scan
+history was read by the frontend as whole documents. ScanRepository queues
+saved scans and a background thread commits them together every
+flush_interval seconds: in one WriteBatch when they fit, or through a
+BulkWriter (parallel, rate-limited, retried) when more have piled up.
+
+History pages are queried newest first with a field projection, so list
+views never download heavy fields like findings or inline images, and resume
+from an opaque cursor. Pages are cached per user for a few seconds. Saving a
+scan invalidates its user's pages, and a user's queued scans are committed
+before their history is read. While Firebase is unavailable (see
+cloud_client.py) scans stay queued.
+"""
+
+import base64
+import json
+import threading
+from datetime import datetime
+
+import cloud_client
+from sample_cache import TTLCache
+
+SCANS_COLLECTION = 'scans'
+# Fields returned by history(), everything a history list shows
+LIST_FIELDS = (
+    'name', 'timestamp', 'imageUrl', 'processedImageUrl', 'fromSample', 'sampleId',
+    'result.hasTumor', 'result.confidence', 'result.tumorType', 'result.tumorSize', 'result.tumorLocation',
+)
+MAX_PAGE_SIZE = 100
+# Firestore's limit of writes per batch
+MAX_BATCH_WRITES = 500
+# Commits a queued scan is tried in before it is dropped
+MAX_WRITE_ATTEMPTS = 3
+
+
+def encode_cursor(timestamp, doc_id):
+    payload = json.dumps([timestamp.isoformat() if timestamp is not None else None, doc_id])
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Returns:
+        tuple: (timestamp (datetime), document ID)
+
+    Raises:
+        ValueError: If the cursor was not returned by ScanRepository.history
+    """
+    try:
+        timestamp, doc_id = json.loads(base64.b64decode(cursor.encode('ascii'), altchars=b'-_', validate=True))
+        return datetime.fromisoformat(timestamp), str(doc_id)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Invalid cursor')
+
+
+class ScanRepository:
+    """
+    Users' scan results in users/<id>/scans
+    """
+
+    def __init__(self, db, flush_interval=1.0, cache_ttl=15.0):
+        """
+        Args:
+            db: Firestore client
+            flush_interval (float): Seconds saved scans may wait to be committed together
+            cache_ttl (float): Seconds a history page is reused, 0 disables the cache
+        """
+        self.db = db
+        self.flush_interval = flush_interval
+        self.pages = TTLCache(ttl=cache_ttl, max_entries=1024)
+
+        self._lock = threading.Lock()
+        # Serializes commits, so a flush waits for the one in progress
+        self._flush_lock = threading.Lock()
+        self._pending = []  # (user_id, doc_ref, data, attempts)
+        self._versions = {}  # user_id -> bumped on write, part of the page cache keys
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._counters = {'queued': 0, 'committed': 0, 'batches': 0, 'bulkWrites': 0, 'failed': 0}
+
+    def _scans(self, user_id):
+        return self.db.collection('users').document(user_id).collection(SCANS_COLLECTION)
+
+    def add(self, user_id, data):
+        """
+        Queue a scan result to be saved, stamped with the server time
+
+        Returns:
+            str: ID of the scan's document
+        """
+        from google.cloud.firestore import SERVER_TIMESTAMP
+
+        doc_ref = self._scans(user_id).document()
+        data = dict(data, timestamp=SERVER_TIMESTAMP)
+        with self._lock:
+            self._pending.append((user_id, doc_ref, data, 0))
+            self._counters['queued'] += 1
+            full = len(self._pending) >= MAX_BATCH_WRITES
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._flush_loop, name='scan-writes', daemon=True)
+                self._thread.start()
+        self.invalidate(user_id)
+        if full:
+            self._wakeup.set()
+        return doc_ref.id
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error writing scan results: {e}")
+
+    def flush(self):
+        """
+        Commit every queued scan
+
+        Returns:
+            int: Number of scans committed
+        """
+        if not cloud_client.available():
+            # Keep them queued until Firebase is back
+            return 0
+        with self._flush_lock:
+            with self._lock:
+                writes, self._pending = self._pending, []
+            if not writes:
+                return 0
+
+            if len(writes) <= MAX_BATCH_WRITES:
+                failed = self._commit_batch(writes)
+            else:
+                failed = self._commit_bulk(writes)
+
+            retry = [(user_id, doc_ref, data, attempts + 1) for user_id, doc_ref, data, attempts in failed
+                     if attempts + 1 < MAX_WRITE_ATTEMPTS]
+            with self._lock:
+                self._pending[:0] = retry
+                self._counters['committed'] += len(writes) - len(failed)
+                self._counters['failed'] += len(failed) - len(retry)
+            if len(failed) > len(retry):
+                print(f"Dropped {len(failed) - len(retry)} scan results after {MAX_WRITE_ATTEMPTS} attempts")
+
+            for user_id in {write[0] for write in writes}:
+                self.invalidate(user_id)
+            return len(writes) - len(failed)
+
+    def _commit_batch(self, writes):
+        """Commit writes in one WriteBatch, returning those that failed"""
+        batch = self.db.batch()
+        for _, doc_ref, data, _ in writes:
+            batch.set(doc_ref, data)
+        try:
+            cloud_client.call('firestore.write', batch.commit)
+        except Exception as e:
+            print(f"Error committing {len(writes)} scan results: {e}")
+            return writes
+        with self._lock:
+            self._counters['batches'] += 1
+        return []
+
+    def _commit_bulk(self, writes):
+        """Commit writes through a BulkWriter, returning those that failed"""
+        failed_paths = set()
+
+        def on_error(failure, _writer):
+            # Let the BulkWriter retry a few times before giving up on a write
+            if failure.attempts < MAX_WRITE_ATTEMPTS:
+                return True
+            failed_paths.add(failure.operation.reference.path)
+            return False
+
+        writer = self.db.bulk_writer()
+        writer.on_write_error(on_error)
+        for _, doc_ref, data, _ in writes:
+            writer.set(doc_ref, data)
+        writer.close()
+        with self._lock:
+            self._counters['bulkWrites'] += 1
+        return [write for write in writes if write[1].path in failed_paths]
+
+    def close(self):
+        """Commit the queued scans, e.g. at shutdown"""
+        self.flush()
+
+    def invalidate(self, user_id):
+        """Drop a user's cached history pages"""
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    def history(self, user_id, limit=20, cursor=None):
+        """
+        One page of a user's scans, newest first, with only LIST_FIELDS
+
+        Args:
+            user_id (str): User ID
+            limit (int): Page size, at most MAX_PAGE_SIZE
+            cursor (str, optional): next_cursor of the previous page
+
+        Returns:
+            tuple: (scans (list of dicts with id and LIST_FIELDS, timestamp
+                as an ISO 8601 string), next_cursor (str or None on the last page))
+
+        Raises:
+            ValueError: If the cursor is invalid
+        """
+        from google.cloud.firestore import Query
+
+        with self._lock:
+            has_pending = any(write[0] == user_id for write in self._pending)
+        if has_pending:
+            self.flush()
+
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        with self._lock:
+            key = (user_id, self._versions.get(user_id, 0), limit, cursor)
+        page = self.pages.get(key)
+        if page is not None:
+            return page
+
+        query = (self._scans(user_id).select(list(LIST_FIELDS))
+                 .order_by('timestamp', direction=Query.DESCENDING)
+                 .order_by('__name__', direction=Query.DESCENDING))
+        if cursor:
+            timestamp, doc_id = decode_cursor(cursor)
+            query = query.start_after({'timestamp': timestamp, '__name__': doc_id})
+
+        # One extra scan tells whether there is a next page
+        query = query.limit(limit + 1)
+        snapshots = cloud_client.call('firestore.query', lambda timeout, retry: list(
+            query.stream(timeout=timeout, retry=retry)))
+        next_cursor = None
+        if len(snapshots) > limit:
+            last = snapshots[limit - 1]
+            next_cursor = encode_cursor(last.get('timestamp'), last.id)
+
+        scans = []
+        for snapshot in snapshots[:limit]:
+            scan = snapshot.to_dict()
+            if isinstance(scan.get('timestamp'), datetime):
+                scan['timestamp'] = scan['timestamp'].isoformat()
+            scans.append({'id': snapshot.id, **scan})
+        page = (scans, next_cursor)
+        self.pages.put(key, page)
+        return page
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, 'pending': len(self._pending), 'cache': self.pages.stats()}
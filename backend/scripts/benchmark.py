@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+"""
+Headless inference benchmark for the tumor detection model
+
+Runs a fixed corpus of MRI-like slices (generated from a seed, or loaded from
+--images and resized) at several resolutions through every combination of
+backend, inference profile and thread count. For each combination it
+measures single-image latency (p50/p95/p99), batched throughput per batch
+size, peak RSS and the time spent in each stage of the forward pass. The
+cold start of each backend (imports, model load, first forward) is measured
+in a fresh process.
+
+Results are written as JSON. Pass --baseline to compare against an earlier
+run: latencies, throughputs and cold starts that got worse by more than
+--threshold are reported and make the script exit with status 1.
+
+Usage:
+  python benchmark.py --output bench.json
+  python benchmark.py --backends eager,int8 --threads 1,2,4 --batch-sizes 1,4,8 --output bench.json
+  python benchmark.py --output new.json --baseline old.json --threshold 0.1
+  python benchmark.py --compare new.json --baseline old.json
+"""
+
+import os
+import sys
+import argparse
+import hashlib
+import json
+import platform
+import subprocess
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics
+
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                  'model', 'maskrcnn_tumor.pth')
+
+def parse_list(value, cast=str):
+    return [cast(item.strip()) for item in value.split(',') if item.strip()]
+
+def synthetic_slice(size, rng):
+    """
+    An MRI-like axial slice: a noisy skull ring around brain tissue with a
+    bright lesion at a random position
+
+    Returns:
+        numpy.ndarray: size x size BGR image
+    """
+    import cv2
+    import numpy as np
+
+    image = (rng.random((size, size)) * 25).astype(np.uint8)
+    center = (size // 2, size // 2)
+    axes = (int(size * rng.uniform(0.36, 0.42)), int(size * rng.uniform(0.42, 0.47)))
+    cv2.ellipse(image, center, axes, 0, 0, 360, 170, -1)
+    cv2.ellipse(image, center, (axes[0] - size // 30, axes[1] - size // 30), 0, 0, 360, 95, -1)
+    tissue = (rng.random((size, size)) * 30).astype(np.uint8)
+    image = cv2.add(image, cv2.GaussianBlur(tissue, (0, 0), size / 100.0))
+
+    offset = rng.uniform(-0.4, 0.4, 2) * np.array(axes)
+    lesion = (int(center[0] + offset[0]), int(center[1] + offset[1]))
+    radius = max(2, int(size * rng.uniform(0.04, 0.1)))
+    cv2.circle(image, lesion, radius, int(rng.integers(190, 240)), -1)
+    image = cv2.GaussianBlur(image, (5, 5), 0)
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+def build_corpus(sizes, num_images, seed=0, images_dir=None):
+    """
+    The benchmark images at every size
+
+    Args:
+        sizes (list): Square image sizes in pixels
+        num_images (int): Images per size
+        seed (int): Seed of the synthetic slices
+        images_dir (str, optional): Use these images (resized) instead
+
+    Returns:
+        tuple: (dict of size -> list of CHW float tensors, corpus description)
+    """
+    import cv2
+    import numpy as np
+    from torchvision.transforms import functional as F
+
+    sources = []
+    if images_dir:
+        import glob
+
+        paths = []
+        for ext in ['*.jpg', '*.jpeg', '*.png', '*.bmp', '*.tif', '*.tiff']:
+            paths.extend(glob.glob(os.path.join(images_dir, ext)))
+        for path in sorted(set(paths))[:num_images]:
+            image = cv2.imread(path)
+            if image is None:
+                print(f"Skipping unreadable image: {path}")
+                continue
+            sources.append(image)
+        if not sources:
+            raise ValueError(f"No images found in {images_dir}")
+
+    digest = hashlib.sha256()
+    corpus = {}
+    for size in sizes:
+        rng = np.random.default_rng([seed, size])
+        images = ([cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA) for image in sources]
+                  if sources else [synthetic_slice(size, rng) for _ in range(num_images)])
+        for image in images:
+            digest.update(image.tobytes())
+        corpus[size] = [F.to_tensor(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)) for image in images]
+
+    description = {
+        'source': images_dir or 'synthetic',
+        'seed': None if images_dir else seed,
+        'sizes': sizes,
+        'imagesPerSize': len(next(iter(corpus.values()))),
+        'sha256': digest.hexdigest(),
+    }
+    return corpus, description
+
+class PeakRssSampler:
+    """Poll this process's RSS in a background thread and keep the maximum"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.peak = metrics.process_rss_bytes() or 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def _sample(self):
+        self.peak = max(self.peak, metrics.process_rss_bytes() or 0)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+def percentiles(values_ms):
+    import numpy as np
+
+    return {
+        'meanMs': round(float(np.mean(values_ms)), 3),
+        'p50Ms': round(float(np.percentile(values_ms, 50)), 3),
+        'p95Ms': round(float(np.percentile(values_ms, 95)), 3),
+        'p99Ms': round(float(np.percentile(values_ms, 99)), 3),
+        'samples': len(values_ms),
+    }
+
+def summarize_stages(observations, images):
+    """Mean milliseconds per image spent in each forward stage"""
+    totals = {}
+    for name, seconds in observations:
+        totals[name] = totals.get(name, 0.0) + seconds
+    return {name: round(total * 1000.0 / images, 3) for name, total in sorted(totals.items())}
+
+def measure_latency(backend, images, repeats, warmup, with_masks):
+    """Per-image latency of single-image forward passes"""
+    import torch
+
+    with torch.no_grad():
+        for image in images[:warmup]:
+            backend([image], with_masks=with_masks)
+        metrics.take_observations()
+
+        latencies = []
+        for _ in range(repeats):
+            for image in images:
+                start_time = time.perf_counter()
+                backend([image], with_masks=with_masks)
+                latencies.append((time.perf_counter() - start_time) * 1000.0)
+    stages = summarize_stages(metrics.take_observations(), len(latencies))
+    return percentiles(latencies), stages
+
+def measure_throughput(backend, images, batch_size, batches, warmup, with_masks):
+    """Images per second when the forward pass runs batch_size images at a time"""
+    import torch
+
+    def batch(index):
+        start = index * batch_size
+        return [images[(start + offset) % len(images)] for offset in range(batch_size)]
+
+    with torch.no_grad():
+        for index in range(warmup):
+            backend(batch(index), with_masks=with_masks)
+
+        latencies = []
+        started_at = time.perf_counter()
+        for index in range(batches):
+            start_time = time.perf_counter()
+            backend(batch(index), with_masks=with_masks)
+            latencies.append((time.perf_counter() - start_time) * 1000.0)
+        elapsed = time.perf_counter() - started_at
+    metrics.take_observations()
+
+    return {
+        'imagesPerSecond': round(batches * batch_size / elapsed, 3),
+        'batchLatency': percentiles(latencies),
+    }
+
+def load_backends(name, model_path, profiles):
+    """
+    Load the model and create a backend per profile
+
+    Returns:
+        tuple: (dict of profile -> backend, load seconds), or (None, reason)
+    """
+    from inference_backends import create_profile_backends, default_artifact_path
+    from profiles import DEFAULT_PROFILE
+
+    needs_eager_model = name in ('eager', 'compile')
+    artifact_path = None if needs_eager_model else default_artifact_path(model_path, name)
+    if artifact_path and not os.path.exists(artifact_path):
+        return None, f"{artifact_path} not found, export it first"
+
+    start_time = time.perf_counter()
+    model = None
+    if needs_eager_model:
+        from test_maskrcnn import load_model
+
+        model = load_model(model_path)
+    backends = create_profile_backends(name, model, artifact_path, profiles, DEFAULT_PROFILE)
+    return backends, time.perf_counter() - start_time
+
+def cold_start_child(args):
+    """Time one backend's start from a fresh process, printing JSON"""
+    started_at = time.perf_counter()
+    import torch
+    import torchvision  # noqa: F401
+    import cv2  # noqa: F401
+    import_seconds = time.perf_counter() - started_at
+
+    backends, load_seconds = load_backends(args.backend, args.model_path, [args.profile])
+    if backends is None:
+        print(json.dumps({'error': load_seconds}))
+        return 1
+    backend = next(iter(backends.values()))
+
+    corpus, _ = build_corpus([args.size], 1, seed=args.seed)
+    forward_start = time.perf_counter()
+    with torch.no_grad():
+        backend(corpus[args.size], with_masks=False)
+    first_forward_seconds = time.perf_counter() - forward_start
+
+    print(json.dumps({
+        'importSeconds': round(import_seconds, 3),
+        'loadSeconds': round(load_seconds, 3),
+        'firstForwardSeconds': round(first_forward_seconds, 3),
+        'totalSeconds': round(time.perf_counter() - started_at, 3),
+        'peakRssBytes': metrics.process_rss_bytes(),
+    }))
+    return 0
+
+def measure_cold_start(backend_name, model_path, profile, size, seed):
+    """Run cold_start_child in a new interpreter"""
+    command = [sys.executable, os.path.abspath(__file__), '--cold-start-child',
+               '--backend', backend_name, '--model-path', model_path,
+               '--profile', profile, '--size', str(size), '--seed', str(seed)]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    lines = [line for line in completed.stdout.splitlines() if line.startswith('{')]
+    if completed.returncode != 0 or not lines:
+        return {'error': (completed.stderr.strip().splitlines() or ['unknown error'])[-1]}
+    return json.loads(lines[-1])
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def environment():
+    import torch
+    import torchvision
+
+    return {
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'torchvision': torchvision.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpuCount': os.cpu_count(),
+        'defaultThreads': torch.get_num_threads(),
+        'gitCommit': git_commit(),
+    }
+
+def run_benchmarks(args):
+    import torch
+    from profiles import INFERENCE_PROFILES
+
+    sizes = parse_list(args.sizes, int)
+    thread_counts = parse_list(args.threads, int) if args.threads else [torch.get_num_threads()]
+    batch_sizes = parse_list(args.batch_sizes, int)
+    profiles = parse_list(args.profiles) if args.profiles else list(INFERENCE_PROFILES)
+    backend_names = parse_list(args.backends)
+
+    corpus, corpus_description = build_corpus(sizes, args.num_images, seed=args.seed,
+                                              images_dir=args.images)
+    print(f"Corpus: {corpus_description['imagesPerSize']} images at sizes {sizes} "
+          f"({corpus_description['sha256'][:12]})")
+
+    report = {
+        'version': 1,
+        'createdAt': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': environment(),
+        'settings': {
+            'backends': backend_names,
+            'profiles': profiles,
+            'threads': thread_counts,
+            'batchSizes': batch_sizes,
+            'repeats': args.repeats,
+            'batches': args.batches,
+            'warmup': args.warmup,
+            'segmentation': args.segmentation,
+        },
+        'corpus': corpus_description,
+        'coldStart': {},
+        'results': [],
+        'skipped': [],
+    }
+
+    if not args.skip_cold_start:
+        for backend_name in backend_names:
+            print(f"\nCold start of the {backend_name} backend...")
+            cold_start = measure_cold_start(backend_name, args.model_path, profiles[0], sizes[0], args.seed)
+            report['coldStart'][backend_name] = cold_start
+            print(f"  {json.dumps(cold_start)}")
+
+    # Stage timings of the forward passes are collected per combination
+    metrics.start_buffering()
+    for backend_name in backend_names:
+        print(f"\nLoading the {backend_name} backend...")
+        backends, load_seconds = load_backends(backend_name, args.model_path, profiles)
+        if backends is None:
+            print(f"  Skipped: {load_seconds}")
+            report['skipped'].append({'backend': backend_name, 'reason': load_seconds})
+            continue
+        print(f"  Loaded in {load_seconds:.2f} seconds")
+
+        for profile in profiles:
+            if profile not in backends:
+                reason = f"the {backend_name} backend only serves {', '.join(backends)}"
+                report['skipped'].append({'backend': backend_name, 'profile': profile, 'reason': reason})
+                continue
+            for threads in thread_counts:
+                torch.set_num_threads(threads)
+                for size in sizes:
+                    key = f"{backend_name}/{profile}/threads={threads}/size={size}"
+                    print(f"\n{key}")
+                    with PeakRssSampler() as rss:
+                        latency, stages = measure_latency(backends[profile], corpus[size], args.repeats,
+                                                          args.warmup, args.segmentation)
+                        print(f"  latency p50 {latency['p50Ms']:.1f} ms, p95 {latency['p95Ms']:.1f} ms, "
+                              f"p99 {latency['p99Ms']:.1f} ms")
+                        throughput = {}
+                        for batch_size in batch_sizes:
+                            throughput[str(batch_size)] = measure_throughput(
+                                backends[profile], corpus[size], batch_size, args.batches,
+                                args.warmup, args.segmentation)
+                            print(f"  batch {batch_size}: "
+                                  f"{throughput[str(batch_size)]['imagesPerSecond']:.2f} images/s")
+                    report['results'].append({
+                        'key': key,
+                        'backend': backend_name,
+                        'profile': profile,
+                        'threads': threads,
+                        'imageSize': size,
+                        'latency': latency,
+                        'throughput': throughput,
+                        'stagesMs': stages,
+                        'peakRssBytes': rss.peak,
+                    })
+        del backends
+    return report
+
+def compare_reports(baseline, current, threshold):
+    """
+    Find measurements that got worse by more than threshold (a fraction)
+
+    Returns:
+        list: One dict per regression
+    """
+    regressions = []
+
+    def check(key, metric, old, new, higher_is_better=False):
+        if not old or new is None:
+            return
+        change = (new - old) / old
+        if (-change if higher_is_better else change) > threshold:
+            regressions.append({'key': key, 'metric': metric, 'baseline': old, 'current': new,
+                                'change': round(change, 4)})
+
+    old_results = {result['key']: result for result in baseline.get('results', [])}
+    for result in current.get('results', []):
+        old = old_results.get(result['key'])
+        if old is None:
+            continue
+        for metric in ('p50Ms', 'p95Ms', 'p99Ms'):
+            check(result['key'], f"latency.{metric}", old['latency'].get(metric), result['latency'].get(metric))
+        for batch_size, throughput in result['throughput'].items():
+            old_throughput = old['throughput'].get(batch_size)
+            if old_throughput:
+                check(result['key'], f"throughput.{batch_size}.imagesPerSecond",
+                      old_throughput['imagesPerSecond'], throughput['imagesPerSecond'], higher_is_better=True)
+
+    for backend_name, cold_start in current.get('coldStart', {}).items():
+        old = baseline.get('coldStart', {}).get(backend_name, {})
+        check(f"coldStart/{backend_name}", 'totalSeconds', old.get('totalSeconds'), cold_start.get('totalSeconds'))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark tumor detection inference')
+    parser.add_argument('--model-path', default=DEFAULT_MODEL_PATH, help='Path to maskrcnn_tumor.pth')
+    parser.add_argument('--images', help='Directory of MRI slices to use instead of synthetic ones')
+    parser.add_argument('--num-images', type=int, default=8, help='Images per size in the corpus')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic corpus')
+    parser.add_argument('--sizes', default='256,512', help='Comma-separated image sizes')
+    parser.add_argument('--backends', default='eager', help='Comma-separated inference backends')
+    parser.add_argument('--profiles', help='Comma-separated inference profiles (default: all)')
+    parser.add_argument('--threads', help='Comma-separated torch thread counts (default: torch default)')
+    parser.add_argument('--batch-sizes', default='1,4', help='Comma-separated batch sizes for throughput')
+    parser.add_argument('--repeats', type=int, default=3, help='Passes over the corpus for latency')
+    parser.add_argument('--batches', type=int, default=8, help='Batches timed per batch size')
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed forward passes per measurement')
+    parser.add_argument('--segmentation', action='store_true', help='Compute masks as well')
+    parser.add_argument('--skip-cold-start', action='store_true', help="Don't measure cold starts")
+    parser.add_argument('--output', help='Write the results as JSON to this path')
+    parser.add_argument('--baseline', help='Earlier results to compare against')
+    parser.add_argument('--compare', help='Compare these results with --baseline instead of running')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative slowdown reported as a regression (default 0.1 = 10%%)')
+    # Internal: measure one backend's cold start in this (fresh) process
+    parser.add_argument('--cold-start-child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--backend', default='eager', help=argparse.SUPPRESS)
+    parser.add_argument('--profile', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, default=512, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cold_start_child:
+        return cold_start_child(args)
+
+    if args.compare:
+        if not args.baseline:
+            parser.error('--compare needs --baseline')
+        with open(args.compare, 'r') as f:
+            report = json.load(f)
+    else:
+        report = run_benchmarks(args)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"\nResults written to: {args.output}")
+
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    if baseline.get('corpus', {}).get('sha256') != report.get('corpus', {}).get('sha256'):
+        print("Warning: the baseline was measured on a different corpus")
+    regressions = compare_reports(baseline, report, args.threshold)
+    if not regressions:
+        print(f"\nNo regressions over {args.threshold:.0%} against {args.baseline}")
+        return 0
+    print(f"\n{len(regressions)} regressions over {args.threshold:.0%} against {args.baseline}:")
+    for regression in regressions:
+        print(f"  {regression['key']} {regression['metric']}: {regression['baseline']} -> "
+              f"{regression['current']} ({regression['change']:+.1%})")
+    return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
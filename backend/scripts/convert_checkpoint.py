@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Convert the tumor detection checkpoint to a memory-mappable format
+
+Writes maskrcnn_tumor.safetensors next to the weights (or to --output), which
+load_model then picks up automatically instead of the .pth. With an --output
+ending in .pth the checkpoint is rewritten in torch's zip format instead,
+which torch.load can memory-map without the safetensors package. The
+converted file is checked to hold exactly the same tensors as the original.
+
+Usage:
+  python convert_checkpoint.py
+  python convert_checkpoint.py --output ../model/maskrcnn_tumor.mmap.pth
+"""
+
+import os
+import sys
+import argparse
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from checkpoints import (convert_checkpoint, load_state_dict, safetensors_path,
+                         state_dict_fingerprint, weights_fingerprint)
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert the model checkpoint for memory-mapped loading')
+    parser.add_argument('--model-path', help='Path to maskrcnn_tumor.pth')
+    parser.add_argument('--output', help='Output path (.safetensors or .pth)')
+    args = parser.parse_args()
+
+    model_path = args.model_path or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                 'model', 'maskrcnn_tumor.pth')
+    output_path = args.output or safetensors_path(model_path)
+    if os.path.abspath(output_path) == os.path.abspath(model_path):
+        parser.error('--output must differ from the input checkpoint')
+
+    print(f"Converting {model_path} to {output_path}...")
+    start_time = time.time()
+    fingerprint = convert_checkpoint(model_path, output_path)
+    print(f"Converted in {time.time() - start_time:.2f} seconds "
+          f"({os.path.getsize(model_path)} -> {os.path.getsize(output_path)} bytes)")
+
+    print("Checking the converted weights...")
+    start_time = time.time()
+    converted = state_dict_fingerprint(load_state_dict(output_path))
+    print(f"Loaded and hashed in {time.time() - start_time:.2f} seconds")
+    if converted != fingerprint:
+        print("Converted weights do NOT match the original")
+        return 1
+
+    print(f"Weights fingerprint: {weights_fingerprint(output_path)}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
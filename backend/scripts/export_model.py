@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Export the tumor detection model for the non-eager inference backends
+
+Exports maskrcnn_tumor.pth to TorchScript and/or ONNX next to the weights
+(or to --output) with the settings of one inference profile, which the
+exported model is then fixed to (serve it with the same INFERENCE_PROFILE).
+It then runs a parity check: every exported model must find the
+same detections as the eager model, with boxes and scores within tolerance.
+
+Usage:
+  python export_model.py --format torchscript
+  python export_model.py --format onnx --images path/to/mri_slices
+  python export_model.py --format all --profile fast --box-tolerance 2.0
+"""
+
+import os
+import sys
+import glob
+import argparse
+import time
+
+import cv2
+import numpy as np
+import torch
+from torchvision.transforms import functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from test_maskrcnn import load_model
+from profiles import DEFAULT_PROFILE, INFERENCE_PROFILES
+from inference_backends import (EagerBackend, compare_predictions, create_backend,
+                                default_artifact_path, export_onnx, export_torchscript)
+
+def load_parity_images(images_dir, count):
+    """Load up to `count` images from a directory, or generate MRI-like ones"""
+    tensors = []
+    if images_dir:
+        paths = []
+        for ext in ['*.jpg', '*.jpeg', '*.png', '*.bmp']:
+            paths.extend(glob.glob(os.path.join(images_dir, ext)))
+        for path in sorted(paths)[:count]:
+            image = cv2.imread(path)
+            if image is None:
+                print(f"Skipping unreadable image: {path}")
+                continue
+            tensors.append(F.to_tensor(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)))
+    
+    if not tensors:
+        print("No parity images given, using synthetic slices")
+        rng = np.random.default_rng(0)
+        for size in [256, 384, 512][:count]:
+            image = (rng.random((size, size)) * 40).astype(np.uint8)
+            cv2.circle(image, (size // 2, size // 2), size // 3, 110, -1)
+            cv2.circle(image, (size // 3, size // 3), size // 10, 230, -1)
+            image = cv2.GaussianBlur(image, (5, 5), 0)
+            tensors.append(F.to_tensor(cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)))
+    
+    return tensors
+
+def check_parity(reference, candidate, images, conf_thresh, box_atol, score_atol):
+    """Run both backends over the images and report whether they agree"""
+    all_match = True
+    for index, image in enumerate(images):
+        start_time = time.time()
+        expected = reference([image])[0]
+        reference_time = time.time() - start_time
+        
+        start_time = time.time()
+        actual = candidate([image])[0]
+        candidate_time = time.time() - start_time
+        
+        match, details = compare_predictions(expected, actual, conf_thresh=conf_thresh,
+                                             box_atol=box_atol, score_atol=score_atol)
+        all_match = all_match and match
+        print(f"  image {index} {tuple(image.shape[1:])}: {'OK' if match else 'MISMATCH'} "
+              f"detections {details['referenceDetections']}/{details['candidateDetections']}, "
+              f"max box diff {details['maxBoxDiff']:.4f}, max score diff {details['maxScoreDiff']:.5f}, "
+              f"eager {reference_time * 1000:.0f} ms, {candidate.name} {candidate_time * 1000:.0f} ms")
+    return all_match
+
+def main():
+    """Parse arguments, export the requested formats and check parity"""
+    parser = argparse.ArgumentParser(description='Export the tumor detection model')
+    parser.add_argument('--format', choices=['torchscript', 'onnx', 'all'], default='all',
+                        help='Export format')
+    parser.add_argument('--model-path', type=str, default=None, help='Path to maskrcnn_tumor.pth')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Output path (only valid with a single format)')
+    parser.add_argument('--profile', choices=list(INFERENCE_PROFILES), default=DEFAULT_PROFILE,
+                        help='Inference profile to export with')
+    parser.add_argument('--images', type=str, default=None, help='Directory of images for the parity check')
+    parser.add_argument('--num-images', type=int, default=3, help='Number of parity images')
+    parser.add_argument('--conf-thresh', type=float, default=0.5, help='Score threshold for compared detections')
+    parser.add_argument('--box-tolerance', type=float, default=1.0, help='Allowed box difference in pixels')
+    parser.add_argument('--score-tolerance', type=float, default=1e-3, help='Allowed score difference')
+    parser.add_argument('--skip-check', action='store_true', help='Skip the parity check')
+    args = parser.parse_args()
+    
+    formats = ['torchscript', 'onnx'] if args.format == 'all' else [args.format]
+    if args.output and len(formats) > 1:
+        parser.error('--output requires a single --format')
+    
+    model_path = args.model_path or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                 'model', 'maskrcnn_tumor.pth')
+    
+    print(f"\nLoading eager model with the {args.profile} profile...")
+    model = load_model(model_path, profile=args.profile)
+    reference = EagerBackend(model)
+    images = None if args.skip_check else load_parity_images(args.images, args.num_images)
+    
+    failed = False
+    for fmt in formats:
+        output_path = args.output or default_artifact_path(model_path, fmt)
+        print(f"\nExporting {fmt} model to {output_path}...")
+        start_time = time.time()
+        if fmt == 'torchscript':
+            export_torchscript(model, output_path)
+        else:
+            export_onnx(model, output_path)
+        print(f"Exported in {time.time() - start_time:.2f} seconds")
+        
+        if args.skip_check:
+            continue
+        
+        print(f"Checking {fmt} parity against eager...")
+        candidate = create_backend(fmt, artifact_path=output_path)
+        if check_parity(reference, candidate, images, args.conf_thresh,
+                        args.box_tolerance, args.score_tolerance):
+            print(f"{fmt}: parity check passed")
+        else:
+            print(f"{fmt}: parity check FAILED")
+            failed = True
+    
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Precompute scan results for every sample image
+
+Runs the model over every shared sample image and every user's samples, as
+listed by the sample index (see sample_index.py; backfill it with
+upload_samples_to_firebase.py --reindex), and stores the results in the
+sample gallery (GALLERY_DIR), which /api/scan-sample answers from. Entries are keyed
+by blob generation and model fingerprint, so only new or replaced samples are
+analyzed again, and everything is analyzed again after the model changes.
+
+The server's configuration (model, backend, INFERENCE_PROFILE, ...) is read
+from the same environment variables, so run this with the server's settings.
+
+Usage:
+  python precompute_samples.py
+  python precompute_samples.py --profiles accurate,fast --no-users --prune
+"""
+
+import os
+import sys
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cloud_client
+from sample_index import MAX_PAGE_SIZE, SHARED_OWNER
+
+def list_samples(sample_index, db, include_users=True):
+    """
+    Index entries of the sample images: the shared samples and, optionally, every user's
+
+    Returns:
+        list: Entries with storagePath and generation (see sample_index.entry_for_blob)
+    """
+    owners = [SHARED_OWNER]
+    if include_users:
+        users = db.collection('users')
+        owners.extend(user.id for user in cloud_client.call('firestore.query', lambda timeout, retry: list(
+            users.list_documents(timeout=timeout, retry=retry))))
+
+    samples = []
+    for owner in owners:
+        cursor = None
+        while True:
+            page, cursor = sample_index.list(owner, limit=MAX_PAGE_SIZE, cursor=cursor)
+            samples.extend(page)
+            if cursor is None:
+                break
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute scan results for the sample images')
+    parser.add_argument('--profiles', help='Comma-separated inference profiles (default: INFERENCE_PROFILE)')
+    parser.add_argument('--segmentation', choices=['off', 'on', 'both'], default='both',
+                        help='Precompute without and/or with the tumor mask')
+    parser.add_argument('--no-users', action='store_true', help="Skip the users' own samples")
+    parser.add_argument('--force', action='store_true', help='Analyze samples that are already precomputed')
+    parser.add_argument('--prune', action='store_true', help='Remove gallery entries for old samples and models')
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='Samples analyzed at once (default: enough to fill a batch)')
+    args = parser.parse_args()
+
+    # Importing the app loads the model and Firebase exactly as the server does
+    import app
+    from sample_gallery import gallery_key
+
+    print("Waiting for the model to load...")
+    while not app.startup.wait(timeout=1.0):
+        if app.startup.state == 'failed':
+            print(f"Error: The model did not load ({app.startup.error})")
+            return 1
+    if app.bucket is None or app.db is None or app.sample_index is None:
+        print("Error: Firebase is not available")
+        return 1
+
+    profiles = ([app.resolve_profile(name.strip()) for name in args.profiles.split(',') if name.strip()]
+                if args.profiles else [app.resolve_profile(None)])
+    segmentations = {'off': [False], 'on': [True], 'both': [False, True]}[args.segmentation]
+
+    samples = list_samples(app.sample_index, app.db, include_users=not args.no_users)
+    print(f"Found {len(samples)} sample images, model {app.model_fingerprint[:12]}")
+
+    jobs, keep = [], set()
+    for sample in samples:
+        storage_path, generation = sample['storagePath'], sample['generation']
+        for profile in profiles:
+            for segmentation in segmentations:
+                settings = app.detection_settings(profile, segmentation)
+                keep.add(gallery_key(storage_path, generation, app.model_fingerprint, settings))
+                if args.force or not app.sample_gallery.has(storage_path, generation,
+                                                            app.model_fingerprint, settings):
+                    jobs.append((storage_path, generation, profile, segmentation, settings))
+    print(f"{len(jobs)} results to compute, {len(keep) - len(jobs)} already precomputed")
+
+    def precompute(job):
+        storage_path, generation, profile, segmentation, settings = job
+        try:
+            image_bytes = app.download_sample({'storagePath': storage_path, 'generation': generation})
+            result, processed_image_bytes = app.process_image_bytes(image_bytes, profile=profile,
+                                                                    segmentation=segmentation)
+            app.sample_gallery.put(storage_path, generation, app.model_fingerprint, settings,
+                                   result, processed_image_bytes)
+            return True
+        except Exception as e:
+            print(f"Failed to precompute {storage_path} ({profile}, segmentation={segmentation}): {e}")
+            return False
+
+    concurrency = args.concurrency or app.INFERENCE_MAX_BATCH_SIZE * max(1, app.INFERENCE_WORKERS)
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        succeeded = sum(executor.map(precompute, jobs))
+    print(f"\nPrecomputed {succeeded} of {len(jobs)} results in {time.time() - start_time:.1f} seconds")
+
+    if args.prune:
+        print(f"Pruned {app.sample_gallery.prune(keep)} outdated gallery entries")
+
+    return 0 if succeeded == len(jobs) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Build the int8 quantized tumor detection model
+
+Calibrates static int8 quantization of the backbone on a directory of MRI
+slices, dynamically quantizes the box head's linear layers and saves the
+result as maskrcnn_tumor.int8.pth (served with INFERENCE_BACKEND=int8).
+A report compares latency, weight size and detection agreement against the
+fp32 model on the same images.
+
+Usage:
+  python quantize_model.py --calibration-dir path/to/mri_slices
+  python quantize_model.py --calibration-dir slices/ --eval-dir held_out/ --report int8_report.json
+"""
+
+import os
+import sys
+import glob
+import json
+import argparse
+import time
+
+import cv2
+import numpy as np
+import torch
+from torchvision.transforms import functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from test_maskrcnn import load_model
+from inference_backends import default_artifact_path
+from quantization import load_quantized_model, quantize_model, save_quantized_model
+
+def load_images(images_dir, limit):
+    """Load up to `limit` images from a directory as CHW float tensors"""
+    paths = []
+    for ext in ['*.jpg', '*.jpeg', '*.png', '*.bmp', '*.tif', '*.tiff']:
+        paths.extend(glob.glob(os.path.join(images_dir, ext)))
+        paths.extend(glob.glob(os.path.join(images_dir, ext.upper())))
+    
+    tensors = []
+    for path in sorted(set(paths))[:limit]:
+        image = cv2.imread(path)
+        if image is None:
+            print(f"Skipping unreadable image: {path}")
+            continue
+        tensors.append(F.to_tensor(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)))
+    return tensors
+
+def box_iou(a, b):
+    """IoU of two [x1, y1, x2, y2] boxes"""
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return float(inter / union) if union > 0 else 0.0
+
+def best_detection(pred, conf_thresh):
+    """Best (box, score) above the threshold, as analyze_image reports it"""
+    scores = pred['scores'].cpu().numpy()
+    if not np.any(scores > conf_thresh):
+        return None, 0.0
+    best = int(np.argmax(scores))
+    return pred['boxes'][best].cpu().numpy(), float(scores[best])
+
+def time_model(model, images):
+    """Run the model over every image, returning predictions and per-image latencies"""
+    predictions, latencies = [], []
+    with torch.no_grad():
+        for image in images:
+            start_time = time.perf_counter()
+            predictions.append(model([image])[0])
+            latencies.append((time.perf_counter() - start_time) * 1000.0)
+    return predictions, latencies
+
+def summarize_latency(latencies):
+    return {
+        'meanMs': round(float(np.mean(latencies)), 2),
+        'p50Ms': round(float(np.percentile(latencies, 50)), 2),
+        'p95Ms': round(float(np.percentile(latencies, 95)), 2),
+    }
+
+def check_round_trip(int8_model, reloaded_model, image):
+    """
+    Whether the reloaded artifact predicts exactly what the model that was saved does
+
+    Returns:
+        str or None: What differs, or None if the predictions match
+    """
+    with torch.no_grad():
+        expected = int8_model([image])[0]
+        actual = reloaded_model([image])[0]
+    for name in ('boxes', 'labels', 'scores'):
+        if not torch.equal(expected[name], actual[name]):
+            return f"{name} differ after reloading"
+    return None
+
+def build_report(fp32_model, int8_model, images, conf_thresh, model_path, int8_path):
+    """Compare fp32 and int8 on the same images"""
+    # Warm up both models so the first timed image isn't paying for setup
+    with torch.no_grad():
+        fp32_model([images[0]])
+        int8_model([images[0]])
+    
+    fp32_preds, fp32_latencies = time_model(fp32_model, images)
+    int8_preds, int8_latencies = time_model(int8_model, images)
+    
+    agree, ious, score_diffs = 0, [], []
+    for fp32_pred, int8_pred in zip(fp32_preds, int8_preds):
+        fp32_box, fp32_score = best_detection(fp32_pred, conf_thresh)
+        int8_box, int8_score = best_detection(int8_pred, conf_thresh)
+        if (fp32_box is None) == (int8_box is None):
+            agree += 1
+        if fp32_box is not None and int8_box is not None:
+            ious.append(box_iou(fp32_box, int8_box))
+            score_diffs.append(abs(fp32_score - int8_score))
+    
+    fp32_latency = summarize_latency(fp32_latencies)
+    int8_latency = summarize_latency(int8_latencies)
+    return {
+        'images': len(images),
+        'confThresh': conf_thresh,
+        'latency': {
+            'fp32': fp32_latency,
+            'int8': int8_latency,
+            'speedup': round(fp32_latency['meanMs'] / int8_latency['meanMs'], 3),
+        },
+        'memory': {
+            'fp32WeightBytes': os.path.getsize(model_path),
+            'int8WeightBytes': os.path.getsize(int8_path),
+        },
+        'agreement': {
+            'tumorDecisionAgreement': round(agree / len(images), 4),
+            'bothDetected': len(ious),
+            'meanBestBoxIoU': round(float(np.mean(ious)), 4) if ious else None,
+            'minBestBoxIoU': round(float(np.min(ious)), 4) if ious else None,
+            'maxScoreDiff': round(float(np.max(score_diffs)), 5) if score_diffs else None,
+        },
+    }
+
+def main():
+    """Parse arguments, quantize, save and report"""
+    parser = argparse.ArgumentParser(description='Build the int8 tumor detection model')
+    parser.add_argument('--calibration-dir', type=str, required=True, help='Directory of MRI slices for calibration')
+    parser.add_argument('--num-calibration', type=int, default=100, help='Maximum number of calibration images')
+    parser.add_argument('--eval-dir', type=str, default=None,
+                        help='Directory of images for the fp32 vs int8 report (default: calibration dir)')
+    parser.add_argument('--num-eval', type=int, default=50, help='Maximum number of report images')
+    parser.add_argument('--model-path', type=str, default=None, help='Path to maskrcnn_tumor.pth')
+    parser.add_argument('--output', type=str, default=None, help='Output path for the int8 weights')
+    parser.add_argument('--conf-thresh', type=float, default=0.7, help='Detection threshold used in the report')
+    parser.add_argument('--report', type=str, default=None, help='Write the report as JSON to this path')
+    args = parser.parse_args()
+    
+    model_path = args.model_path or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                 'model', 'maskrcnn_tumor.pth')
+    output_path = args.output or default_artifact_path(model_path, 'int8')
+    
+    calibration_images = load_images(args.calibration_dir, args.num_calibration)
+    if not calibration_images:
+        print(f"Error: No calibration images found in {args.calibration_dir}")
+        return 1
+    
+    print("\nLoading fp32 model...")
+    fp32_model = load_model(model_path)
+    
+    print(f"Calibrating on {len(calibration_images)} images...")
+    start_time = time.time()
+    int8_model = quantize_model(fp32_model, calibration_images)
+    print(f"Quantized in {time.time() - start_time:.2f} seconds")
+    
+    save_quantized_model(int8_model, output_path)
+    print(f"Int8 model saved to: {output_path}")
+    
+    # Report on the reloaded artifact so the numbers match what is served
+    reloaded_model = load_quantized_model(output_path)
+    mismatch = check_round_trip(int8_model, reloaded_model, calibration_images[0])
+    if mismatch:
+        print(f"Error: The saved int8 model does not round-trip: {mismatch}")
+        return 1
+    print("Round trip check passed: the reloaded model matches the calibrated one")
+    int8_model = reloaded_model
+    eval_images = load_images(args.eval_dir, args.num_eval) if args.eval_dir else calibration_images[:args.num_eval]
+    
+    print(f"\nComparing fp32 and int8 on {len(eval_images)} images...")
+    report = build_report(fp32_model, int8_model, eval_images, args.conf_thresh, model_path, output_path)
+    print(json.dumps(report, indent=2))
+    
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to: {args.report}")
+    
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,60 +1,93 @@
 import cv2
-import torch
 import numpy as np
 import os
 from torchvision.transforms import functional as F
-from torchvision.models.detection import maskrcnn_resnet50_fpn
 import argparse
+import sys
 import time
 
-def load_model(model_path=None):
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from checkpoints import build_maskrcnn, build_on_meta, load_weights
+from detection import detect
+from findings import summarize_detections
+from metrics import observe_stage, stage
+from profiles import get_profile
+
+def load_model(model_path=None, profile=None):
     """
     Load the tumor detection model
     
     Args:
         model_path: Path to the model weights. If None, uses the default path.
+        profile: Name of the inference profile (input size, proposal and
+            detection counts). If None, uses the default profile.
     
     Returns:
         The loaded PyTorch model
     """
-    # Load the model
-    model = maskrcnn_resnet50_fpn(num_classes=2)  # 1 class (tumor) + background
+    # Build the model without initializing weights, they all come from the
+    # (memory-mapped) checkpoint
+    model = build_on_meta(build_maskrcnn,
+                          num_classes=2,  # 1 class (tumor) + background
+                          **get_profile(profile))
     
     if model_path is None:
         # Get the path relative to this file's location
         model_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 
                               'model', 'maskrcnn_tumor.pth')
     
-    model.load_state_dict(
-        torch.load(model_path, map_location=torch.device('cpu'))
-    )
+    load_weights(model, model_path)
     model.eval()  # Set the model to evaluation mode
     return model
 
-def analyze_image(model, image_path):
+def analyze_image(model, image_path, predict=None, conf_thresh=0.7, segmentation=False):
     """
-    Analyze an image with the Mask R-CNN model
+    Analyze an image file with the Mask R-CNN model
     
     Args:
         model: The loaded model
         image_path: Path to the image file
+        predict: Optional callable taking a single CHW image tensor and
+            returning its prediction dict (e.g. a batching queue). If None,
+            the model is called directly.
+        conf_thresh: Minimum score for a detection to count as a tumor
+        segmentation: Whether to compute the tumor mask. Without it only
+            the backbone, RPN and box head run.
     
     Returns:
         Tuple containing (results_dict, processed_image)
     """
     print(f"\nAnalyzing image: {image_path}")
-    # Load and preprocess the image
+    # Load the image
     print("Loading image...")
     image = cv2.imread(image_path)
     if image is None:
         print("ERROR: Failed to load image")
         raise ValueError("Failed to load image")
     
+    return analyze_image_array(model, image, predict=predict, conf_thresh=conf_thresh,
+                               segmentation=segmentation)
+
+def analyze_image_array(model, image, predict=None, conf_thresh=0.7, segmentation=False):
+    """
+    Analyze a decoded BGR image with the Mask R-CNN model
+    
+    Args:
+        model: The loaded model
+        image: BGR image array as returned by cv2.imread / cv2.imdecode
+        predict: Optional prediction callable, see analyze_image
+        conf_thresh: Minimum score for a detection to count as a tumor
+        segmentation: Whether to compute the tumor mask, see analyze_image
+    
+    Returns:
+        Tuple containing (results_dict, processed_image)
+    """
     print(f"Image dimensions: {image.shape}")
     print("Converting to RGB and creating tensor...")
-    image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    image_tensor = F.to_tensor(image_rgb)
-    image_tensor = image_tensor.unsqueeze(0)  # Add batch dimension
+    with stage('to_tensor'):
+        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        image_tensor = F.to_tensor(image_rgb)
     
     # Initialize results
     results = {
@@ -67,89 +100,69 @@ def analyze_image(model, image_path):
     
     # Make predictions
     print("Running model inference...")
-    with torch.no_grad():
-        predictions = model(image_tensor)
+    if predict is not None:
+        pred = predict(image_tensor)
+    else:
+        # Masks are only computed when asked for, and only for detections
+        # above the confidence threshold
+        predictions = detect(model, [image_tensor], with_masks=segmentation,
+                             mask_score_thresh=conf_thresh)
 
-    # Get the first prediction
-    pred = predictions[0]
+        # Get the first prediction
+        pred = predictions[0]
     
+    postprocess_start = time.perf_counter()
+
     # Convert image back to BGR for OpenCV operations
     output_image = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2BGR)
 
-    # Visualize only the most confident prediction above a threshold
+    # Measure every detection above the threshold, merging overlapping ones
     print("Processing predictions...")
-    boxes = pred['boxes'].cpu().numpy()
-    scores = pred['scores'].cpu().numpy()
-    
-    print(f"Found {len(boxes)} potential regions")
-    print(f"Confidence scores: {[round(float(s), 2) for s in scores[:5]]}...")
-    
-    conf_thresh = 0.7
-    valid = scores > conf_thresh
-    
-    valid_count = np.sum(valid)
-    print(f"Found {valid_count} regions with confidence above {conf_thresh}")
+    print(f"Found {len(pred['boxes'])} potential regions")
+    print(f"Confidence scores: {[round(float(s), 2) for s in pred['scores'][:5]]}...")
+    findings, findings_mask = summarize_detections(
+        pred['boxes'].cpu(), pred['scores'].cpu(), image.shape[:2], conf_thresh,
+        masks=pred['masks'].cpu() if segmentation and 'masks' in pred else None)
+    print(f"Found {len(findings)} findings with confidence above {conf_thresh}")
 
-    if np.any(valid):
-        best_idx = np.argmax(scores[valid])
-        best_box = boxes[valid][best_idx].astype(int)
+    if findings:
         box_color = (153, 159, 250)  # Light purple color
-        print(f"Best detection box: {best_box}")
-        
-        cv2.rectangle(output_image, (best_box[0], best_box[1]), (best_box[2], best_box[3]), box_color, 2)
-        
-        # Calculate tumor size (approximate)
-        width_px = best_box[2] - best_box[0]
-        height_px = best_box[3] - best_box[1]
-        size_px = max(width_px, height_px)
-        size_cm = (size_px / 100.0) * 2.5  # Approximate conversion to cm
-        print(f"Tumor dimensions: {width_px}x{height_px} pixels, approx {size_cm:.1f} cm")
-        
-        # Determine tumor location based on box center position
-        center_x = (best_box[0] + best_box[2]) / 2
-        center_y = (best_box[1] + best_box[3]) / 2
-        height, width = image.shape[:2]
-        print(f"Tumor center position: x={center_x:.1f}, y={center_y:.1f}")
+        corners = np.array([finding['box'] for finding in findings]).round().astype(np.int32)
+        outlines = corners[:, [[0, 1], [2, 1], [2, 3], [0, 3]]]
+        cv2.polylines(output_image, list(outlines), True, box_color, 2)
         
-        # Simple location determination
-        if center_y < height * 0.33:
-            location = "Frontal Lobe"
-        elif center_y < height * 0.66:
-            if center_x < width * 0.5:
-                location = "Temporal Lobe (Left)"
-            else:
-                location = "Temporal Lobe (Right)"
-        else:
-            if center_x < width * 0.5:
-                location = "Occipital Lobe (Left)"
-            else:
-                location = "Occipital Lobe (Right)"
-        print(f"Determined location: {location}")
+        # Outline the tumor masks if segmentation was requested
+        if findings_mask is not None:
+            contours, _ = cv2.findContours(findings_mask.numpy().astype(np.uint8),
+                                           cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            cv2.drawContours(output_image, contours, -1, box_color, 1)
         
-        # Determine tumor type based on size and appearance (simplified)
-        if size_cm < 2.0:
-            tumor_type = "Meningioma"
-        elif size_cm < 3.0:
-            tumor_type = "Glioma"
-        else:
-            tumor_type = "Pituitary"
-        print(f"Determined tumor type: {tumor_type}")
-            
-        confidence = float(scores[valid][best_idx])
-        print(f"Confidence: {confidence:.4f}")
+        # The top-level fields describe the most confident finding
+        best = findings[0]
+        print(f"Best detection box: {best['box']}")
+        print(f"Tumor dimensions: {best['widthPx']}x{best['heightPx']} pixels, approx {best['sizeCm']:.1f} cm")
+        print(f"Tumor center position: x={best['centroid'][0]:.1f}, y={best['centroid'][1]:.1f}")
+        print(f"Determined location: {best['tumorLocation']}")
+        print(f"Determined tumor type: {best['tumorType']}")
+        print(f"Confidence: {best['confidence']:.4f}")
         
         # Update results
         results = {
             'hasTumor': True,
-            'confidence': confidence,  # Pass the raw confidence value directly
-            'tumorSize': f"{size_cm:.1f} cm",
-            'tumorType': tumor_type,
-            'tumorLocation': location,
+            'confidence': best['confidence'],  # Pass the raw confidence value directly
+            'tumorSize': f"{best['sizeCm']:.1f} cm",
+            'tumorType': best['tumorType'],
+            'tumorLocation': best['tumorLocation'],
+            'findings': findings,
         }
-        print("RESULT: Tumor detected")
+        if 'maskAreaPx' in best:
+            results['segmentation'] = {'maskAreaPx': best['maskAreaPx']}
+            print(f"Tumor mask area: {best['maskAreaPx']} pixels")
+        print(f"RESULT: Tumor detected ({len(findings)} findings)")
     else:
         print("RESULT: No tumor detected with confidence above threshold.")
 
+    observe_stage('postprocess', time.perf_counter() - postprocess_start)
     return results, output_image
 
 def main():
@@ -1,54 +1,321 @@
+#!/usr/bin/env python3
 """
 Upload sample images to Firebase Storage
-This script uploads all sample images from the local directory to Firebase Storage.
+
+Uploads every image under the local samples directory to samples/ in
+Firebase Storage (or to users/<id>/samples/ with --user), keeping the file
+names relative to the directory. The remote folder is listed once and each
+local file's MD5 (or CRC32C, for objects without an MD5) is compared to the
+remote blob, so only new and modified files are uploaded, through a pool of
+--workers threads.
+
+A manifest in the samples directory remembers each file's hashes and the
+uploads that completed. A rerun, including one after an interrupted run,
+only hashes files that changed since and uploads what is left.
+
+Uploaded samples are added to the sample index (see sample_index.py).
+--reindex also indexes the samples already in Storage and drops index
+entries of deleted ones, from the same listing.
+
+Usage:
+  python upload_samples_to_firebase.py
+  python upload_samples_to_firebase.py --source ~/scans --user <uid> --workers 16
+  python upload_samples_to_firebase.py --dry-run
+  python upload_samples_to_firebase.py --reindex
 """
 
 import os
-import glob
-from firebase_service import firebase_service
+import sys
+import argparse
+import base64
+import hashlib
+import json
+import mimetypes
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cloud_client
+from sample_index import SHARED_OWNER, entry_for_blob, sample_folder
+
+try:
+    import google_crc32c
+except ImportError:  # Installed with google-cloud-storage, but only needed for objects without an MD5
+    google_crc32c = None
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp')
+DEFAULT_SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples')
+MANIFEST_NAME = '.upload_manifest.json'
+HASH_CHUNK_SIZE = 1024 * 1024
+# The manifest is written after this many seconds of completed uploads
+MANIFEST_SAVE_INTERVAL = 5.0
+
+def find_images(source_dir):
+    """Paths of the images under source_dir, relative to it with / separators"""
+    images = []
+    for root, dirs, files in os.walk(source_dir):
+        dirs[:] = [name for name in dirs if not name.startswith('.')]
+        for filename in files:
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                relative_path = os.path.relpath(os.path.join(root, filename), source_dir)
+                images.append(relative_path.replace(os.sep, '/'))
+    return sorted(images)
+
+def file_digests(path):
+    """
+    Base64 MD5 and CRC32C of a file, the encoding Cloud Storage reports them in
+
+    Returns:
+        tuple: (md5 (str), crc32c (str or None without google_crc32c))
+    """
+    md5 = hashlib.md5()
+    crc = google_crc32c.Checksum() if google_crc32c is not None else None
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            md5.update(chunk)
+            if crc is not None:
+                crc.update(chunk)
+    return (base64.b64encode(md5.digest()).decode('ascii'),
+            base64.b64encode(crc.digest()).decode('ascii') if crc is not None else None)
+
+class Manifest:
+    """
+    Local record of file hashes and completed uploads, keyed by relative path
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        self.entries = {}
+        try:
+            with open(path, 'r') as f:
+                self.entries = json.load(f).get('files', {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable manifest {path}: {e}")
+
+    def digests(self, relative_path, path):
+        """
+        The file's (md5, crc32c), hashed again only if its size or mtime changed
+
+        Returns:
+            tuple: (md5, crc32c, size)
+        """
+        stat = os.stat(path)
+        with self._lock:
+            entry = self.entries.get(relative_path)
+        if (entry is not None and entry.get('size') == stat.st_size
+                and entry.get('mtimeNs') == stat.st_mtime_ns
+                and (entry.get('crc32c') or google_crc32c is None)):
+            return entry['md5'], entry.get('crc32c'), stat.st_size
+
+        md5, crc32c = file_digests(path)
+        with self._lock:
+            # Hashes changed: any recorded upload was of older contents
+            self.entries[relative_path] = {'size': stat.st_size, 'mtimeNs': stat.st_mtime_ns,
+                                           'md5': md5, 'crc32c': crc32c}
+            self._dirty = True
+        return md5, crc32c, stat.st_size
+
+    def uploaded(self, relative_path):
+        """The recorded upload of the file's current contents, or None"""
+        with self._lock:
+            return self.entries.get(relative_path, {}).get('upload')
+
+    def record_upload(self, relative_path, storage_path, generation):
+        with self._lock:
+            self.entries[relative_path]['upload'] = {'storagePath': storage_path, 'generation': generation}
+            self._dirty = True
+            due = time.monotonic() - self._saved_at >= MANIFEST_SAVE_INTERVAL
+        if due:
+            self.save()
+
+    def save(self):
+        """Write the manifest atomically"""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps({'files': self.entries}, indent=1, sort_keys=True)
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        temp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(data)
+        os.replace(temp_path, self.path)
+
+def remote_blobs(bucket, prefix):
+    """
+    Every blob under prefix, with its checksums, from a single listing
+
+    Returns:
+        dict: blob name -> blob
+    """
+    return cloud_client.call('storage.list', lambda timeout, retry: {
+        blob.name: blob for blob in bucket.list_blobs(prefix=prefix, timeout=timeout, retry=retry)})
 
-def upload_samples():
-    """Upload all samples from the samples directory to Firebase Storage"""
-    if not firebase_service.initialized:
+def same_contents(md5, crc32c, blob):
+    """Whether a local file matches a remote blob; composite objects only have a CRC32C"""
+    if blob.md5_hash:
+        return blob.md5_hash == md5
+    return crc32c is not None and blob.crc32c == crc32c
+
+def upload_file(bucket, path, storage_path, remote_generation, make_public=True, md5=None):
+    """
+    Upload one file, failing instead of overwriting if the blob changed since it was listed
+
+    Args:
+        md5 (str, optional): The file's base64 MD5. If the generation check
+            fails but the blob already has these contents, an earlier attempt
+            whose response was lost went through, and it counts as uploaded.
+
+    Returns:
+        Blob: The uploaded blob
+    """
+    from google.api_core.exceptions import PreconditionFailed
+
+    blob = bucket.blob(storage_path)
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    try:
+        # Generation 0 means the blob must not exist yet. A retry after a lost
+        # response would fail this check, so failed uploads are left to the next run.
+        cloud_client.call('storage.upload', blob.upload_from_filename, path, content_type=content_type,
+                          if_generation_match=remote_generation or 0, max_attempts=1)
+    except PreconditionFailed:
+        if md5 is None:
+            raise
+        cloud_client.call('storage.metadata', blob.reload)
+        if blob.md5_hash != md5:
+            raise
+        print(f"{storage_path} already has the file's contents")
+    if make_public:
+        cloud_client.call('storage.metadata', blob.make_public)
+    return blob
+
+def upload_samples(bucket, source_dir, owner=SHARED_OWNER, workers=8, make_public=True, dry_run=False,
+                   sample_index=None, reindex=False):
+    """
+    Upload the new and modified images under source_dir to an owner's sample folder
+
+    Args:
+        owner (str): User ID, or SHARED_OWNER for samples/
+        sample_index (SampleIndex, optional): Index to add the uploaded samples to
+        reindex (bool): Also make the index match the samples already in the folder
+
+    Returns:
+        bool: Whether every pending file was uploaded
+    """
+    images = find_images(source_dir)
+    print(f"Found {len(images)} sample images in {source_dir}")
+    if not images:
+        return True
+
+    prefix = sample_folder(owner)
+    manifest = Manifest(os.path.join(source_dir, MANIFEST_NAME))
+    start_time = time.time()
+    remote = remote_blobs(bucket, prefix)
+    print(f"Listed {len(remote)} blobs under {prefix} in {time.time() - start_time:.1f} seconds")
+
+    pending, unchanged = [], 0
+    for relative_path in images:
+        storage_path = prefix + relative_path
+        md5, crc32c, size = manifest.digests(relative_path, os.path.join(source_dir, relative_path))
+        remote_blob = remote.get(storage_path)
+        if remote_blob is not None and same_contents(md5, crc32c, remote_blob):
+            unchanged += 1
+            if manifest.uploaded(relative_path) is None:
+                manifest.record_upload(relative_path, storage_path, remote_blob.generation)
+            continue
+        pending.append((relative_path, storage_path, size,
+                        remote_blob.generation if remote_blob is not None else None))
+    manifest.save()
+
+    if reindex and sample_index is not None and not dry_run:
+        # Modified files are indexed again once uploaded
+        indexed, removed = sample_index.sync(owner, remote.values())
+        print(f"Indexed {indexed} samples already in Storage, removed {removed} deleted ones")
+
+    new = sum(1 for *_, generation in pending if generation is None)
+    print(f"{unchanged} unchanged, {new} new, {len(pending) - new} modified")
+    if dry_run:
+        for relative_path, storage_path, size, generation in pending:
+            print(f"Would upload {relative_path} ({size} bytes) to {storage_path}")
+        return True
+    if not pending:
+        return True
+
+    uploaded_blobs = []
+
+    def upload(job):
+        relative_path, storage_path, size, generation = job
+        path = os.path.join(source_dir, relative_path)
+        md5 = manifest.digests(relative_path, path)[0]
+        blob = upload_file(bucket, path, storage_path, generation, make_public=make_public, md5=md5)
+        manifest.record_upload(relative_path, storage_path, blob.generation)
+        uploaded_blobs.append(blob)
+        return size
+
+    uploaded, uploaded_bytes, failed = 0, 0, 0
+    start_time = time.time()
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        futures = {executor.submit(upload, job): job for job in pending}
+        for future in as_completed(futures):
+            relative_path, storage_path = futures[future][:2]
+            try:
+                uploaded_bytes += future.result()
+                uploaded += 1
+                print(f"[{uploaded + failed}/{len(pending)}] Uploaded {relative_path} to {storage_path}")
+            except Exception as e:
+                failed += 1
+                print(f"[{uploaded + failed}/{len(pending)}] Failed to upload {relative_path}: {e}")
+    except KeyboardInterrupt:
+        print("\nInterrupted, waiting for the uploads in flight. Run again to resume.")
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        manifest.save()
+        if sample_index is not None and uploaded_blobs:
+            sample_index.upsert(map(entry_for_blob, uploaded_blobs))
+
+    elapsed = max(time.time() - start_time, 1e-9)
+    print(f"\nSummary: Uploaded {uploaded} of {len(pending)} images "
+          f"({uploaded_bytes / 1e6:.1f} MB) in {elapsed:.1f} seconds")
+    print(f"Throughput: {uploaded / elapsed:.1f} files/s, {uploaded_bytes / 1e6 / elapsed:.2f} MB/s")
+    return failed == 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Upload new and modified sample images to Firebase Storage')
+    parser.add_argument('--source', default=DEFAULT_SAMPLES_DIR, help='Local directory of sample images')
+    parser.add_argument('--user', help="Upload to the user's samples (users/<id>/samples/)")
+    parser.add_argument('--workers', type=int, default=8, help='Concurrent uploads')
+    parser.add_argument('--private', action='store_true', help="Don't make the uploaded blobs public")
+    parser.add_argument('--dry-run', action='store_true', help='Only report what would be uploaded')
+    parser.add_argument('--reindex', action='store_true',
+                        help='Also index the samples already in Storage and drop deleted ones from the index')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.source):
+        print(f"Samples directory not found: {args.source}")
+        return 1
+
+    from firebase.service import firebase_service
+    if not firebase_service.initialized or firebase_service.fallback_mode:
         print("Firebase is not initialized. Make sure service-account.json is available.")
-        return
-    
-    # Get the path to the samples directory
-    samples_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples')
-    
-    if not os.path.exists(samples_dir):
-        print(f"Samples directory not found: {samples_dir}")
-        return
-    
-    # Find all image files
-    image_files = []
-    for ext in ['*.jpg', '*.jpeg', '*.png', '*.gif', '*.bmp']:
-        image_files.extend(glob.glob(os.path.join(samples_dir, ext)))
-        image_files.extend(glob.glob(os.path.join(samples_dir, ext.upper())))
-    
-    print(f"Found {len(image_files)} sample images to upload")
-    
-    # Upload each image
-    success_count = 0
-    for image_file in image_files:
-        filename = os.path.basename(image_file)
-        print(f"Uploading {filename}...")
-        
-        success, storage_path, download_url, error = firebase_service.upload_image(
-            image_file,
-            folder="samples"
-        )
-        
-        if success:
-            print(f"Uploaded {filename} to {storage_path}")
-            print(f"Download URL: {download_url}")
-            success_count += 1
-        else:
-            print(f"Failed to upload {filename}: {error}")
-    
-    print(f"\nSummary: Uploaded {success_count} out of {len(image_files)} images")
+        return 1
 
-if __name__ == '__main__':
     print("Starting sample upload...")
-    upload_samples()
-    print("Upload process completed.") 
\ No newline at end of file
+    succeeded = upload_samples(firebase_service.bucket, args.source, args.user or SHARED_OWNER,
+                               workers=args.workers, make_public=not args.private, dry_run=args.dry_run,
+                               sample_index=firebase_service.get_sample_index(), reindex=args.reindex)
+    print("Upload process completed.")
+    return 0 if succeeded else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
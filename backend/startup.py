@@ -0,0 +1,104 @@
+"""
+Startup sequence bookkeeping for the API server
+
+The server starts accepting connections before the model is loaded. Firebase
+initialization, the heavy imports (torch, torchvision, cv2), model loading and
+the warm-up forward passes run as named phases in the background. Startup
+records how long each phase took and whether the server is ready for
+inference traffic, which /healthz and /readyz report to the load balancer.
+"""
+
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Startup:
+    """
+    Phase timings and readiness of one server process
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.state = 'starting'
+        self.phase_name = None
+        self.error = None
+        self.phases = OrderedDict()  # phase name -> seconds
+        self._t0 = time.perf_counter()
+        self._ready = threading.Event()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    @contextmanager
+    def phase(self, name):
+        """Time a startup phase and log its duration"""
+        self.phase_name = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round(time.perf_counter() - start, 3)
+            print(f"Startup: {name} took {self.phases[name]:.3f}s")
+            self.phase_name = None
+
+    def run_in_background(self, target):
+        """
+        Run the startup sequence in a daemon thread
+
+        target is called with no arguments and marks the server ready when it
+        returns. An exception marks it failed instead.
+        """
+        def run():
+            try:
+                target()
+            except Exception as e:
+                traceback.print_exc()
+                self.mark_failed(e)
+            else:
+                self.mark_ready()
+
+        thread = threading.Thread(target=run, name='startup', daemon=True)
+        thread.start()
+        return thread
+
+    def mark_ready(self):
+        self.state = 'ready'
+        self._ready.set()
+        self.log_summary()
+
+    def mark_failed(self, error):
+        self.state = 'failed'
+        self.error = f"{type(error).__name__}: {error}"
+        self.log_summary()
+
+    def wait(self, timeout=None):
+        """Block until ready, returns whether it is"""
+        return self._ready.wait(timeout)
+
+    def elapsed(self):
+        return round(time.perf_counter() - self._t0, 3)
+
+    def log_summary(self):
+        """Print the per-phase timing breakdown"""
+        total = self.elapsed()
+        print(f"Startup {self.state} after {total:.3f}s")
+        for name, seconds in self.phases.items():
+            share = 100.0 * seconds / total if total else 0.0
+            print(f"  {name:<28} {seconds:8.3f}s  {share:5.1f}%")
+        if self.error:
+            print(f"  error: {self.error}")
+
+    def to_dict(self):
+        return {
+            'state': self.state,
+            'ready': self.ready,
+            'phase': self.phase_name,
+            'error': self.error,
+            'startedAt': self.started_at,
+            'uptimeSeconds': self.elapsed(),
+            'phases': dict(self.phases),
+        }
@@ -0,0 +1,17 @@
+import os
+import sys
+
+# Tests import the backend's flat modules the way app.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import cloud_client
+
+
+@pytest.fixture(autouse=True)
+def fresh_cloud_client(monkeypatch):
+    """A circuit breaker and retry state of its own for every test, without backoff sleeps"""
+    client = cloud_client.CloudClient(base_delay=0.0, max_delay=0.0)
+    monkeypatch.setattr(cloud_client, '_shared', client)
+    return client
@@ -0,0 +1,201 @@
+"""
+In-memory stand-in for the parts of the Firestore client the backend uses
+
+Supports documents and subcollections, where/order_by/start_after/limit/select
+queries, batched writes, a BulkWriter and SERVER_TIMESTAMP (replaced by an
+increasing clock). Methods accept the timeout and retry keywords the real
+client takes.
+"""
+
+import datetime
+import itertools
+import operator
+import uuid
+
+from google.cloud.firestore import SERVER_TIMESTAMP
+
+OPERATORS = {'==': operator.eq, '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+EPOCH = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _field(data, path):
+    for part in path.split('.'):
+        data = data[part]
+    return data
+
+
+class Snapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return None if self._data is None else dict(self._data)
+
+    def get(self, path):
+        return _field(self._data, path)
+
+
+class DocumentReference:
+    def __init__(self, db, path):
+        self.db = db
+        self._path = path
+        self.id = path[-1]
+        self.path = '/'.join(path)
+
+    def collection(self, name):
+        return Query(self.db, self._path + (name,))
+
+    def get(self, **kwargs):
+        self.db.reads += 1
+        return Snapshot(self, self.db.docs.get(self._path))
+
+    def _set(self, data):
+        self.db.docs[self._path] = {name: self.db.now() if value is SERVER_TIMESTAMP else value
+                                    for name, value in data.items()}
+
+    def _delete(self):
+        self.db.docs.pop(self._path, None)
+
+
+class Query:
+    def __init__(self, db, path, filters=(), orders=(), after=None, limit_to=None, fields=None):
+        self.db = db
+        self._path = path
+        self._filters = filters
+        self._orders = orders
+        self._after = after
+        self._limit = limit_to
+        self._fields = fields
+
+    def _with(self, **changes):
+        settings = dict(filters=self._filters, orders=self._orders, after=self._after,
+                        limit_to=self._limit, fields=self._fields)
+        settings.update(changes)
+        return Query(self.db, self._path, **settings)
+
+    def document(self, document_id=None):
+        return DocumentReference(self.db, self._path + (document_id or uuid.uuid4().hex[:20],))
+
+    def where(self, field, op, value):
+        return self._with(filters=self._filters + ((field, op, value),))
+
+    def order_by(self, field, direction='ASCENDING'):
+        return self._with(orders=self._orders + ((field, direction),))
+
+    def start_after(self, values):
+        return self._with(after=values)
+
+    def limit(self, count):
+        return self._with(limit_to=count)
+
+    def select(self, fields):
+        return self._with(fields=list(fields))
+
+    def _sort_key(self, document_id, data):
+        return tuple(document_id if field == '__name__' else _field(data, field) for field, _ in self._orders)
+
+    def stream(self, **kwargs):
+        self.db.queries += 1
+        rows = []
+        for path, data in self.db.docs.items():
+            if path[:-1] != self._path:
+                continue
+            try:
+                if all(OPERATORS[op](_field(data, field), value) for field, op, value in self._filters):
+                    rows.append((path, data))
+            except KeyError:
+                continue
+
+        # Sort by the last order first so earlier orders take precedence
+        for index in reversed(range(len(self._orders))):
+            field, direction = self._orders[index]
+            rows.sort(key=lambda row: self._sort_key(row[0][-1], row[1])[index], reverse=direction == 'DESCENDING')
+        if self._after is not None:
+            after = tuple(self._after[field] for field, _ in self._orders)
+            position = next((i for i, (path, data) in enumerate(rows)
+                             if self._sort_key(path[-1], data) == after), None)
+            if position is None:
+                raise AssertionError('start_after values must match a document in these tests')
+            rows = rows[position + 1:]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+
+        snapshots = []
+        for path, data in rows:
+            if self._fields is not None:
+                projected = {}
+                for field in self._fields:
+                    try:
+                        value = _field(data, field)
+                    except KeyError:
+                        continue
+                    target = projected
+                    parts = field.split('.')
+                    for part in parts[:-1]:
+                        target = target.setdefault(part, {})
+                    target[parts[-1]] = value
+                data = projected
+            snapshots.append(Snapshot(DocumentReference(self.db, path), data))
+        return iter(snapshots)
+
+
+class WriteBatch:
+    def __init__(self, db):
+        self.db = db
+        self._operations = []
+
+    def set(self, reference, data):
+        self._operations.append(lambda: reference._set(data))
+
+    def delete(self, reference):
+        self._operations.append(reference._delete)
+
+    def commit(self, **kwargs):
+        self.db.commits += 1
+        if self.db.failures:
+            self.db.failures -= 1
+            raise self.db.failure_error
+        for operation in self._operations:
+            operation()
+
+
+class BulkWriter:
+    def __init__(self, db):
+        self.db = db
+        self._operations = []
+
+    def on_write_error(self, callback):
+        self._callback = callback
+
+    def set(self, reference, data):
+        self._operations.append(lambda: reference._set(data))
+
+    def close(self):
+        self.db.bulk_writes += 1
+        for operation in self._operations:
+            operation()
+
+
+class FakeFirestore:
+    def __init__(self):
+        self.docs = {}
+        self.reads = self.queries = self.commits = self.bulk_writes = 0
+        # The next `failures` commits raise failure_error
+        self.failures = 0
+        self.failure_error = ConnectionError('Firestore unavailable')
+        self._clock = itertools.count()
+
+    def now(self):
+        return EPOCH + datetime.timedelta(seconds=next(self._clock))
+
+    def collection(self, name):
+        return Query(self, (name,))
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def bulk_writer(self):
+        return BulkWriter(self)
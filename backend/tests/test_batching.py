@@ -0,0 +1,64 @@
+import threading
+
+import pytest
+
+from batching import InferenceBatcher
+
+
+def submit_concurrently(batcher, images):
+    """Submit every image from its own thread, returning results (or errors) in order"""
+    results = [None] * len(images)
+
+    def submit(index):
+        try:
+            results[index] = batcher.submit(images[index])
+        except Exception as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=submit, args=(index,)) for index in range(len(images))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+        assert not thread.is_alive(), 'a request never got a result'
+    return results
+
+
+def test_batches_requests_and_returns_predictions_in_order():
+    batch_sizes = []
+
+    def forward(images, with_masks):
+        batch_sizes.append(len(images))
+        return [{'image': image} for image in images]
+
+    batcher = InferenceBatcher(forward, max_batch_size=4, max_wait_ms=200)
+    results = submit_concurrently(batcher, list(range(4)))
+
+    assert [prediction['image'] for prediction, _ in results] == [0, 1, 2, 3]
+    assert sum(batch_sizes) == 4
+    assert max(batch_sizes) > 1
+    assert all(info['batchSize'] in batch_sizes for _, info in results)
+    assert batcher.queue_depth() == 0
+
+
+def test_forward_error_fails_every_request_in_the_batch():
+    def forward(images, with_masks):
+        raise ValueError('model exploded')
+
+    batcher = InferenceBatcher(forward, max_batch_size=3, max_wait_ms=100)
+    results = submit_concurrently(batcher, [0, 1, 2])
+
+    assert all(isinstance(result, ValueError) for result in results)
+    assert batcher.queue_depth() == 0
+
+
+@pytest.mark.parametrize('returned', [0, 1, 3])
+def test_prediction_count_mismatch_fails_instead_of_hanging(returned):
+    def forward(images, with_masks):
+        return [{}] * returned
+
+    batcher = InferenceBatcher(forward, max_batch_size=2, max_wait_ms=200)
+    results = submit_concurrently(batcher, [0, 1])
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert batcher.queue_depth() == 0
@@ -0,0 +1,40 @@
+import torch
+import torchvision.models._api
+from torch import nn
+from torchvision.ops.misc import FrozenBatchNorm2d
+
+from checkpoints import build_maskrcnn, build_on_meta, load_weights, weights_fingerprint
+
+
+def test_build_maskrcnn_matches_the_trained_architecture_without_downloading(monkeypatch):
+    def no_download(*args, **kwargs):
+        raise AssertionError('backbone weights were downloaded')
+
+    monkeypatch.setattr(torchvision.models._api, 'load_state_dict_from_url', no_download)
+    model = build_on_meta(build_maskrcnn, num_classes=2)
+
+    body_norms = [module for module in model.backbone.body.modules()
+                  if isinstance(module, (nn.BatchNorm2d, FrozenBatchNorm2d))]
+    assert body_norms and all(isinstance(module, FrozenBatchNorm2d) for module in body_norms)
+    # Like a model trained from an ImageNet backbone, only layer2-layer4 are trainable
+    assert not model.backbone.body.conv1.weight.requires_grad
+    assert not any(parameter.requires_grad for parameter in model.backbone.body.layer1.parameters())
+    assert all(parameter.requires_grad for parameter in model.backbone.body.layer4.parameters())
+    assert all(tensor.is_meta for tensor in model.state_dict().values())
+
+
+def test_load_weights_round_trip_and_fingerprint(tmp_path):
+    torch.manual_seed(0)
+    source = build_maskrcnn(num_classes=2).eval()
+    path = str(tmp_path / 'model.pth')
+    torch.save(source.state_dict(), path)
+
+    model = load_weights(build_on_meta(build_maskrcnn, num_classes=2), path).eval()
+    for name, tensor in source.state_dict().items():
+        assert torch.equal(model.state_dict()[name], tensor), name
+
+    fingerprint = weights_fingerprint(path)
+    assert len(fingerprint) == 64
+    # Served from the sidecar cache the second time
+    assert (tmp_path / 'model.pth.sha256').exists()
+    assert weights_fingerprint(path) == fingerprint
@@ -0,0 +1,121 @@
+import time
+
+import pytest
+
+from cloud_client import CircuitBreaker, CloudClient, CloudUnavailable, is_transient
+
+
+def make_client(**settings):
+    settings = {'max_attempts': 3, 'base_delay': 0.0, 'max_delay': 0.0, 'failure_threshold': 3,
+                'reset_timeout': 60.0, **settings}
+    return CloudClient(**settings)
+
+
+class Flaky:
+    """Fails with error the first `failures` calls, then returns 'ok'"""
+
+    def __init__(self, failures, error=ConnectionError('reset')):
+        self.failures = failures
+        self.error = error
+        self.calls = []
+
+    def __call__(self, *args, timeout, retry, **kwargs):
+        self.calls.append({'args': args, 'timeout': timeout, 'retry': retry, **kwargs})
+        if len(self.calls) <= self.failures:
+            raise self.error
+        return 'ok'
+
+
+def test_passes_the_deadline_and_disables_sdk_retries():
+    client = make_client(deadlines={'storage.upload': 42.0})
+    fn = Flaky(0)
+    assert client.call('storage.upload', fn, b'data', content_type='image/png') == 'ok'
+
+    call, = fn.calls
+    assert call['args'] == (b'data',) and call['content_type'] == 'image/png'
+    assert call['retry'] is None
+    assert 41.0 < call['timeout'] <= 42.0
+
+
+def test_retries_transient_errors():
+    client = make_client()
+    fn = Flaky(2)
+    assert client.call('firestore.read', fn) == 'ok'
+    assert len(fn.calls) == 3
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_gives_up_after_max_attempts():
+    client = make_client(failure_threshold=10)
+    fn = Flaky(5)
+    with pytest.raises(ConnectionError):
+        client.call('firestore.read', fn)
+    assert len(fn.calls) == 3
+
+    fn = Flaky(5)
+    with pytest.raises(ConnectionError):
+        client.call('firestore.read', fn, max_attempts=1)
+    assert len(fn.calls) == 1
+
+
+def test_non_transient_errors_are_not_retried_and_keep_the_breaker_closed():
+    client = make_client(failure_threshold=1)
+    fn = Flaky(1, error=KeyError('not found'))
+    with pytest.raises(KeyError):
+        client.call('firestore.read', fn)
+    assert len(fn.calls) == 1
+    assert client.available
+
+
+def test_retries_stop_at_the_deadline():
+    client = make_client(max_attempts=10, base_delay=1.0, max_delay=1.0, failure_threshold=100,
+                         deadlines={'firestore.read': 0.2})
+    fn = Flaky(100)
+    started_at = time.monotonic()
+    with pytest.raises(ConnectionError):
+        client.call('firestore.read', fn)
+    assert len(fn.calls) == 1
+    assert time.monotonic() - started_at < 0.5
+
+
+def test_breaker_opens_rejects_and_recovers_through_a_probe():
+    client = make_client(max_attempts=1, failure_threshold=3, reset_timeout=0.05)
+    for _ in range(3):
+        with pytest.raises(ConnectionError):
+            client.call('storage.download', Flaky(1))
+    assert not client.available
+
+    fn = Flaky(0)
+    with pytest.raises(CloudUnavailable):
+        client.call('storage.download', fn)
+    assert fn.calls == []
+    assert client.breaker.stats()['rejected'] == 1
+
+    time.sleep(0.06)
+    assert client.available
+    assert client.call('storage.download', fn) == 'ok'
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_failed_probe_reopens_the_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+
+    assert breaker.allow()
+    # Only one probe at a time
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    assert breaker.stats()['opened'] == 1
+
+
+def test_transient_errors():
+    from google.api_core import exceptions
+
+    assert is_transient(TimeoutError())
+    assert is_transient(exceptions.ServiceUnavailable('down'))
+    assert is_transient(exceptions.TooManyRequests('slow down'))
+    assert not is_transient(exceptions.NotFound('missing'))
+    assert not is_transient(ValueError())
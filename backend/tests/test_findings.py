@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+import torch
+
+from findings import REGIONS, merge_overlaps, summarize_detections
+
+IMAGE_SIZE = (400, 400)
+
+
+def test_separate_detections_are_separate_findings():
+    boxes = torch.tensor([[10., 10., 50., 50.], [300., 300., 340., 340.]])
+    findings, mask = summarize_detections(boxes, torch.tensor([0.8, 0.95]), IMAGE_SIZE, conf_thresh=0.7)
+
+    assert [finding['confidence'] for finding in findings] == pytest.approx([0.95, 0.8])
+    assert findings[0]['box'] == [300., 300., 340., 340.]
+    assert findings[0]['sizeCm'] == 1.0 and findings[0]['tumorType'] == 'Meningioma'
+    assert findings[1]['tumorLocation'] == REGIONS[0]
+    assert all(finding['detections'] == 1 for finding in findings)
+    assert mask is None
+
+
+def test_below_threshold_detections_are_ignored():
+    boxes = torch.tensor([[10., 10., 50., 50.]])
+    assert summarize_detections(boxes, torch.tensor([0.5]), IMAGE_SIZE, conf_thresh=0.7) == ([], None)
+
+
+def test_overlapping_detections_merge_into_the_best_one():
+    boxes = torch.tensor([[100., 100., 200., 200.], [105., 105., 210., 205.]])
+    findings, _ = summarize_detections(boxes, torch.tensor([0.9, 0.8]), IMAGE_SIZE, conf_thresh=0.7)
+
+    assert len(findings) == 1
+    assert findings[0]['detections'] == 2
+    assert findings[0]['box'] == [100., 100., 210., 205.]
+    assert findings[0]['confidence'] == pytest.approx(0.9)
+
+
+def test_chained_overlaps_keep_every_detection():
+    # A overlaps B and B overlaps C, but C doesn't overlap A
+    a = [0., 0., 100., 100.]
+    b = [30., 0., 130., 100.]
+    c = [60., 0., 160., 100.]
+    boxes = torch.tensor([a, b, c], dtype=torch.float64)
+    keep, owner = merge_overlaps(boxes)
+    assert keep.tolist() == [True, False, True]
+    assert (owner >= 0).all()
+
+    findings, _ = summarize_detections(boxes, torch.tensor([0.95, 0.9, 0.85]), IMAGE_SIZE, conf_thresh=0.7)
+    assert sum(finding['detections'] for finding in findings) == 3
+    assert [finding['confidence'] for finding in findings] == pytest.approx([0.95, 0.85])
+
+
+def test_every_detection_lands_in_a_finding():
+    generator = torch.Generator().manual_seed(0)
+    for _ in range(50):
+        corners = torch.rand((30, 2), generator=generator) * 300
+        sizes = torch.rand((30, 2), generator=generator) * 80 + 10
+        boxes = torch.cat([corners, corners + sizes], dim=1)
+        scores = torch.rand(30, generator=generator)
+
+        findings, _ = summarize_detections(boxes, scores, IMAGE_SIZE, conf_thresh=0.5)
+        assert sum(finding['detections'] for finding in findings) == int((scores > 0.5).sum())
+
+
+def test_measurements_come_from_the_masks():
+    boxes = torch.tensor([[0., 0., 200., 200.]])
+    masks = torch.zeros((1, 1) + IMAGE_SIZE)
+    masks[0, 0, 300:320, 40:80] = 1.0
+    findings, mask = summarize_detections(boxes, torch.tensor([0.9]), IMAGE_SIZE, conf_thresh=0.7, masks=masks)
+
+    assert findings[0]['maskAreaPx'] == 800
+    assert findings[0]['widthPx'] == 40 and findings[0]['heightPx'] == 20
+    assert findings[0]['centroid'] == [60., 310.]
+    # The centroid is in the bottom third, left half
+    assert findings[0]['tumorLocation'] == 'Occipital Lobe (Left)'
+    assert np.array_equal(mask.numpy(), masks[0, 0].numpy() > 0.5)
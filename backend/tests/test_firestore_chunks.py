@@ -0,0 +1,153 @@
+import base64
+import hashlib
+import os
+
+import pytest
+
+import firestore_chunks
+from fake_firestore import FakeFirestore
+from firestore_chunks import CHUNK_SIZE, FORMAT, read_image_to_file, write_image
+
+
+@pytest.fixture
+def db():
+    return FakeFirestore()
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    """Chunks of 1 KiB in batches of 4 KiB, so small images span many chunks and batches"""
+    monkeypatch.setattr(firestore_chunks, 'CHUNK_SIZE', 1024)
+    monkeypatch.setattr(firestore_chunks, 'MAX_BATCH_BYTES', 4096)
+
+
+def write_file(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def chunk_paths(db, doc_ref):
+    return sorted(path for path in db.docs if path[:-1] == tuple(doc_ref.path.split('/')) + ('chunks',))
+
+
+def compressible(size):
+    return (b'tumor scan slice ' * (size // 17 + 1))[:size]
+
+
+@pytest.mark.parametrize('compression, name, encoding', [
+    ('none', 'scan.dcm', 'identity'),
+    ('deflate', 'scan.dcm', 'deflate'),
+    ('auto', 'scan.png', 'identity'),
+    ('auto', 'scan.dcm', firestore_chunks.default_encoding()),
+    ('zstd', 'scan.dcm', 'zstd' if firestore_chunks.zstandard is not None else 'deflate'),
+])
+def test_round_trip_per_encoding(db, small_chunks, tmp_path, compression, name, encoding):
+    data = compressible(20_000) if encoding != 'identity' else os.urandom(20_000)
+    doc_ref = db.collection('images').document('a')
+
+    fields = write_image(db, doc_ref, write_file(tmp_path, name, data), {'name': name}, compression)
+
+    assert fields['encoding'] == encoding and fields['format'] == FORMAT
+    assert fields['size'] == len(data) and fields['sha256'] == hashlib.sha256(data).hexdigest()
+    assert fields['chunkCount'] == len(chunk_paths(db, doc_ref))
+    assert db.docs[('images', 'a')]['name'] == name
+    if encoding == 'identity':
+        assert fields['chunkCount'] == 20 and db.commits == 5
+    else:
+        assert fields['storedSize'] < len(data)
+
+    output = tmp_path / 'out'
+    assert read_image_to_file(doc_ref, fields, str(output)) == len(data)
+    assert output.read_bytes() == data
+
+
+def test_image_larger_than_a_chunk(db, tmp_path):
+    data = os.urandom(2 * CHUNK_SIZE + 123)
+    doc_ref = db.collection('images').document('big')
+
+    fields = write_image(db, doc_ref, write_file(tmp_path, 'big.png', data))
+
+    assert fields['chunkCount'] == 3
+    output = tmp_path / 'out.png'
+    read_image_to_file(doc_ref, fields, str(output))
+    assert output.read_bytes() == data
+
+
+def test_empty_image(db, tmp_path):
+    doc_ref = db.collection('images').document('empty')
+    fields = write_image(db, doc_ref, write_file(tmp_path, 'empty.dcm', b''), compression='none')
+    assert fields['chunkCount'] == 0
+    read_image_to_file(doc_ref, fields, str(tmp_path / 'out'))
+    assert (tmp_path / 'out').read_bytes() == b''
+
+
+def test_legacy_base64_document(db, tmp_path):
+    data = os.urandom(500)
+    doc_ref = db.collection('images').document('legacy')
+    fields = {'name': 'old.png', 'data': base64.b64encode(data).decode('ascii')}
+
+    read_image_to_file(doc_ref, fields, str(tmp_path / 'old.png'))
+    assert (tmp_path / 'old.png').read_bytes() == data
+
+
+def written_image(db, tmp_path):
+    doc_ref = db.collection('images').document('a')
+    fields = write_image(db, doc_ref, write_file(tmp_path, 'a.dcm', os.urandom(10_000)), compression='none')
+    return doc_ref, fields
+
+
+def corrupt_missing_chunk(db, doc_ref, fields):
+    del db.docs[chunk_paths(db, doc_ref)[3]]
+
+
+def corrupt_out_of_order_chunk(db, doc_ref, fields):
+    db.docs[chunk_paths(db, doc_ref)[3]]['index'] = 50
+
+
+def corrupt_data(db, doc_ref, fields):
+    chunk = db.docs[chunk_paths(db, doc_ref)[3]]
+    chunk['data'] = bytes(len(chunk['data']))
+
+
+def corrupt_checksum(db, doc_ref, fields):
+    fields['sha256'] = '0' * 64
+
+
+@pytest.mark.parametrize('corrupt', [corrupt_missing_chunk, corrupt_out_of_order_chunk,
+                                     corrupt_data, corrupt_checksum])
+def test_damaged_images_raise_and_leave_no_partial_file(db, small_chunks, tmp_path, corrupt):
+    doc_ref, fields = written_image(db, tmp_path)
+    corrupt(db, doc_ref, fields)
+    output = tmp_path / 'out.dcm'
+
+    with pytest.raises(ValueError):
+        read_image_to_file(doc_ref, fields, str(output))
+    assert not output.exists()
+    assert not os.path.exists(f"{output}.part")
+
+
+def test_failed_commit_removes_the_written_chunks(db, small_chunks, tmp_path):
+    original_batch = db.batch
+
+    def batch():
+        write_batch = original_batch()
+        commit = write_batch.commit
+
+        def commit_unless_third(**kwargs):
+            if db.commits == 2:
+                db.commits += 1
+                raise PermissionError('denied')
+            return commit(**kwargs)
+
+        write_batch.commit = commit_unless_third
+        return write_batch
+
+    db.batch = batch
+    doc_ref = db.collection('images').document('a')
+    with pytest.raises(PermissionError):
+        write_image(db, doc_ref, write_file(tmp_path, 'a.dcm', os.urandom(20_000)), compression='none')
+
+    # The first two batches were committed, then removed again
+    assert chunk_paths(db, doc_ref) == []
+    assert ('images', 'a') not in db.docs
@@ -0,0 +1,56 @@
+import pytest
+
+import app as server
+from firebase_admin import auth
+
+
+class StubRepository:
+    def __init__(self):
+        self.requested = []
+
+    def history(self, user_id, limit=20, cursor=None):
+        self.requested.append(user_id)
+        return [{'id': 'scan-1'}], None
+
+
+@pytest.fixture
+def repository(monkeypatch):
+    repository = StubRepository()
+    monkeypatch.setattr(server, 'scan_repository', repository)
+    return repository
+
+
+@pytest.fixture
+def client(monkeypatch, repository):
+    def verify_id_token(token):
+        if token != 'alice-token':
+            raise auth.InvalidIdTokenError('bad token')
+        return {'uid': 'alice'}
+
+    monkeypatch.setattr(auth, 'verify_id_token', verify_id_token)
+    return server.app.test_client()
+
+
+def test_history_requires_a_token(client, repository):
+    response = client.get('/api/history?userId=alice')
+    assert response.status_code == 401
+    assert repository.requested == []
+
+
+def test_history_rejects_an_invalid_token(client, repository):
+    response = client.get('/api/history', headers={'Authorization': 'Bearer forged'})
+    assert response.status_code == 401
+    assert repository.requested == []
+
+
+def test_history_rejects_another_users_id(client, repository):
+    response = client.get('/api/history?userId=bob', headers={'Authorization': 'Bearer alice-token'})
+    assert response.status_code == 403
+    assert repository.requested == []
+
+
+def test_history_lists_the_token_users_scans(client, repository):
+    response = client.get('/api/history', headers={'Authorization': 'Bearer alice-token'})
+    assert response.status_code == 200
+    assert response.get_json() == {'scans': [{'id': 'scan-1'}], 'nextCursor': None}
+    assert repository.requested == ['alice']
@@ -0,0 +1,28 @@
+import pytest
+import torch
+
+from checkpoints import build_maskrcnn
+from quantization import load_quantized_model, quantize_model, save_quantized_model
+
+pytestmark = pytest.mark.skipif(not torch.backends.quantized.supported_engines
+                                or torch.backends.quantized.supported_engines == ['none'],
+                                reason='no quantized engine in this torch build')
+
+
+def test_saved_int8_model_reloads_and_predicts_the_same(tmp_path):
+    torch.manual_seed(0)
+    fp32_model = build_maskrcnn(num_classes=2).eval()
+    int8_model = quantize_model(fp32_model, [torch.rand(3, 128, 128)])
+    path = str(tmp_path / 'model.int8.pth')
+    save_quantized_model(int8_model, path)
+
+    reloaded = load_quantized_model(path)
+
+    image = torch.rand(3, 128, 128)
+    with torch.no_grad():
+        expected = int8_model([image])[0]
+        actual = reloaded([image])[0]
+    for name in ('boxes', 'labels', 'scores'):
+        assert torch.equal(expected[name], actual[name]), name
+    # The fp32 model given to quantize_model is left untouched
+    assert not any(name.endswith('_scale_0') for name in fp32_model.state_dict())
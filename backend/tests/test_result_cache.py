@@ -0,0 +1,80 @@
+import numpy as np
+
+from result_cache import ResultCache, make_cache_key
+
+
+def make_result(tumor_size='2.6 cm'):
+    return {
+        'hasTumor': True,
+        'tumorSize': tumor_size,
+        'findings': [{'box': [1, 2, 3, 4], 'centroid': [2, 3], 'score': 0.9}],
+        'segmentation': {'area': 10},
+    }
+
+
+def test_cache_key_depends_on_pixels_model_and_settings():
+    image = np.zeros((4, 4, 3), dtype=np.uint8)
+    changed = image.copy()
+    changed[0, 0, 0] = 1
+    key = make_cache_key(image, 'model-a', {'profile': 'fast'})
+
+    assert key == make_cache_key(image.copy(), 'model-a', {'profile': 'fast'})
+    assert key != make_cache_key(changed, 'model-a', {'profile': 'fast'})
+    assert key != make_cache_key(image, 'model-b', {'profile': 'fast'})
+    assert key != make_cache_key(image, 'model-a', {'profile': 'accurate'})
+    # Same pixels in a different shape are a different image
+    assert key != make_cache_key(image.reshape(2, 8, 3), 'model-a', {'profile': 'fast'})
+
+
+def test_hit_miss_and_lru_eviction():
+    cache = ResultCache(max_bytes=1000)
+    assert cache.get('a') is None
+
+    cache.put('a', make_result(), b'x' * 300)
+    cache.put('b', make_result(), b'x' * 300)
+    assert cache.get('a')[1] == b'x' * 300  # a is now the most recently used
+    cache.put('c', make_result(), b'x' * 300)
+
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    stats = cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['bytes'] <= 1000
+    assert stats['misses'] == 2
+
+
+def test_entries_larger_than_the_budget_are_not_cached():
+    cache = ResultCache(max_bytes=100)
+    cache.put('a', make_result(), b'x' * 200)
+    assert cache.get('a') is None
+
+
+def test_cached_entries_are_isolated_from_callers():
+    cache = ResultCache()
+    result = make_result()
+    cache.put('a', result, b'img')
+    result['findings'][0]['box'][0] = 99
+
+    first, _ = cache.get('a')
+    assert first['findings'][0]['box'][0] == 1
+    first['findings'].append({'box': [0, 0, 0, 0]})
+    first['segmentation']['area'] = 0
+
+    second, _ = cache.get('a')
+    assert second == make_result()
+
+
+def test_disk_tier_survives_a_restart_and_is_evicted_by_size(tmp_path):
+    cache = ResultCache(disk_dir=str(tmp_path), disk_max_bytes=10_000)
+    cache.put('aa11', make_result('1 cm'), b'x' * 4000)
+    cache.put('bb22', make_result('2 cm'), b'x' * 4000)
+
+    restarted = ResultCache(disk_dir=str(tmp_path), disk_max_bytes=10_000)
+    result, image_bytes = restarted.get('aa11')
+    assert result == make_result('1 cm') and image_bytes == b'x' * 4000
+    assert restarted.stats()['diskHits'] == 1
+
+    restarted.put('cc33', make_result('3 cm'), b'x' * 4000)
+    assert restarted.stats()['diskEvictions'] == 1
+    # bb22 was the least recently used entry on disk
+    assert ResultCache(disk_dir=str(tmp_path)).get('bb22') is None
@@ -0,0 +1,83 @@
+import pytest
+
+from fake_firestore import FakeFirestore
+from sample_index import SHARED_OWNER, SampleIndex, decode_cursor, encode_cursor, entry_for_blob, sample_owner
+
+
+class Blob:
+    def __init__(self, name):
+        self.name = name
+        self.size = 100
+        self.content_type = 'image/png'
+        self.public_url = f'https://storage.example/{name}'
+        self.generation = 1
+
+
+@pytest.fixture
+def db():
+    return FakeFirestore()
+
+
+@pytest.fixture
+def index(db):
+    index = SampleIndex(db)
+    names = [f'samples/scan-{number:03d}.png' for number in range(250)]
+    names += ['samples/brain-1.jpg', 'samples/notes.txt', 'users/u1/samples/mine.png']
+    index.upsert(map(entry_for_blob, map(Blob, names)))
+    return index
+
+
+def list_all(index, **kwargs):
+    entries, cursor = [], None
+    while True:
+        page, cursor = index.list(cursor=cursor, **kwargs)
+        entries.extend(page)
+        if cursor is None:
+            return entries
+
+
+def test_sample_owner():
+    assert sample_owner('samples/a.png') == SHARED_OWNER
+    assert sample_owner('users/u1/samples/a.PNG') == 'u1'
+    assert sample_owner('samples/notes.txt') is None
+    assert sample_owner('uploads/a.png') is None
+
+
+def test_cursor_round_trip_and_validation():
+    assert decode_cursor(encode_cursor('samples/ü.png')) == 'samples/ü.png'
+    with pytest.raises(ValueError):
+        decode_cursor('not a cursor!')
+
+
+def test_pages_cover_every_sample_once(index):
+    first, cursor = index.list(limit=100)
+    assert len(first) == 100 and cursor is not None
+
+    entries = list_all(index, limit=100)
+    paths = [entry['storagePath'] for entry in entries]
+    assert len(paths) == 251
+    assert paths == sorted(paths) and len(set(paths)) == len(paths)
+    assert 'users/u1/samples/mine.png' not in paths
+
+
+def test_filters(index):
+    assert [entry['name'] for entry in list_all(index, extension='.JPG')] == ['brain-1.jpg']
+    assert len(list_all(index, name_prefix='scan-1')) == 100
+    assert [entry['name'] for entry in list_all(index, owner='u1')] == ['mine.png']
+
+
+def test_pages_are_cached_until_the_index_changes(db, index):
+    index.list(limit=10)
+    index.list(limit=10)
+    assert db.queries == 1
+
+    index.upsert([entry_for_blob(Blob('samples/aaa.png'))])
+    page, _ = index.list(limit=10)
+    assert page[0]['name'] == 'aaa.png'
+    assert db.queries == 2
+
+
+def test_sync_removes_entries_of_deleted_samples(index):
+    written, removed = index.sync('u1', [Blob('users/u1/samples/new.png')])
+    assert (written, removed) == (1, 1)
+    assert [entry['name'] for entry in list_all(index, owner='u1')] == ['new.png']
@@ -0,0 +1,121 @@
+import pytest
+
+from fake_firestore import FakeFirestore
+from scan_repository import MAX_BATCH_WRITES, MAX_WRITE_ATTEMPTS, ScanRepository
+
+
+def make_scan(index):
+    return {'name': f'scan-{index}', 'result': {'hasTumor': True, 'confidence': 0.9, 'findings': [{'box': [1]}]},
+            'processedImageData': 'x' * 100}
+
+
+@pytest.fixture
+def db():
+    return FakeFirestore()
+
+
+@pytest.fixture
+def repository(db):
+    repository = ScanRepository(db, flush_interval=3600)
+    yield repository
+    repository.close()
+
+
+def add_scans(repository, count, user_id='u1'):
+    ids = [repository.add(user_id, make_scan(index)) for index in range(count)]
+    assert repository.flush() == count
+    return ids
+
+
+def test_queued_scans_are_committed_in_one_batch(db, repository):
+    add_scans(repository, 5)
+    assert db.commits == 1
+    assert repository.stats()['committed'] == 5 and repository.stats()['pending'] == 0
+
+
+def test_history_pages_newest_first_with_only_list_fields(repository):
+    ids = add_scans(repository, 5)
+
+    seen, cursor, pages = [], None, 0
+    while True:
+        scans, cursor = repository.history('u1', limit=2, cursor=cursor)
+        seen.extend(scans)
+        pages += 1
+        if cursor is None:
+            break
+
+    assert pages == 3
+    assert [scan['id'] for scan in seen] == list(reversed(ids))
+    assert [scan['name'] for scan in seen] == [f'scan-{index}' for index in reversed(range(5))]
+    first = seen[0]
+    assert first['result'] == {'hasTumor': True, 'confidence': 0.9}
+    assert 'processedImageData' not in first
+    assert isinstance(first['timestamp'], str)
+
+
+def test_history_is_per_user(repository):
+    add_scans(repository, 2, user_id='u1')
+    add_scans(repository, 1, user_id='u2')
+    assert len(repository.history('u2')[0]) == 1
+
+
+def test_history_pages_are_cached_until_the_user_saves(db, repository):
+    add_scans(repository, 3)
+    repository.history('u1')
+    repository.history('u1')
+    assert db.queries == 1
+
+    repository.add('u1', make_scan(3))
+    scans, _ = repository.history('u1')
+    # The queued scan was committed before the read
+    assert len(scans) == 4 and scans[0]['name'] == 'scan-3'
+    assert db.queries == 2
+
+
+def test_invalid_cursor(repository):
+    with pytest.raises(ValueError):
+        repository.history('u1', cursor='not a cursor!')
+
+
+def test_failed_commits_are_retried_then_dropped(db, repository):
+    # Not transient, so the cloud client doesn't retry it itself
+    db.failure_error = PermissionError('denied')
+    repository.add('u1', make_scan(0))
+    db.failures = 1
+    assert repository.flush() == 0
+    assert repository.stats()['pending'] == 1
+    assert repository.flush() == 1
+
+    repository.add('u1', make_scan(1))
+    db.failures = MAX_WRITE_ATTEMPTS
+    for _ in range(MAX_WRITE_ATTEMPTS):
+        repository.flush()
+    assert repository.stats()['pending'] == 0
+    assert repository.stats()['failed'] == 1
+
+
+def open_breaker(client):
+    for _ in range(client.breaker.failure_threshold):
+        client.breaker.record_failure()
+
+
+def test_backlog_after_an_outage_goes_through_the_bulk_writer(db, repository, fresh_cloud_client):
+    open_breaker(fresh_cloud_client)
+    for index in range(MAX_BATCH_WRITES + 1):
+        repository.add('u1', make_scan(index))
+    assert repository.flush() == 0
+
+    fresh_cloud_client.breaker.record_success()
+    # The background flush may get there first; either way the backlog is committed once flush() returns
+    repository.flush()
+    assert repository.stats()['committed'] == MAX_BATCH_WRITES + 1
+    assert db.bulk_writes == 1 and db.commits == 0
+    assert len(db.docs) == MAX_BATCH_WRITES + 1
+
+
+def test_scans_stay_queued_while_firebase_is_unavailable(db, repository, fresh_cloud_client):
+    open_breaker(fresh_cloud_client)
+
+    repository.add('u1', make_scan(0))
+    assert repository.flush() == 0
+    assert db.commits == 0 and repository.stats()['pending'] == 1
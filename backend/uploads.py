@@ -0,0 +1,142 @@
+"""
+Background uploads of scan images to Firebase Storage
+
+Uploading the original and processed images used to block the scan response
+for four network round trips. UploadManager runs them concurrently on a
+bounded thread pool after the response has gone out, retries failures with
+exponential backoff, and keeps each job's status (including the final public
+URLs) so the client can poll for it. Each attempt goes through the shared
+cloud client, so it has a deadline and stops at once while Firebase is
+unavailable (see cloud_client.py).
+"""
+
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import cloud_client
+from cloud_client import CloudUnavailable
+from metrics import observe_stage
+
+
+class UploadJob:
+    """A group of blobs uploaded for one scan"""
+
+    def __init__(self, job_id, keys):
+        self.job_id = job_id
+        self.created_at = time.time()
+        self.finished_at = None
+        self.urls = {}
+        self.errors = {}
+        self.attempts = {key: 0 for key in keys}
+        self.remaining = len(keys)
+
+    @property
+    def state(self):
+        if self.remaining:
+            return 'running' if any(self.attempts.values()) else 'pending'
+        return 'failed' if self.errors else 'done'
+
+    def to_dict(self):
+        return {
+            'jobId': self.job_id,
+            'state': self.state,
+            'urls': dict(self.urls),
+            'errors': dict(self.errors),
+            'attempts': dict(self.attempts),
+            'createdAt': self.created_at,
+            'finishedAt': self.finished_at,
+        }
+
+
+class UploadManager:
+    """
+    Uploads in-memory blobs to a storage bucket in the background
+    """
+
+    def __init__(self, bucket, max_workers=4, max_attempts=4, base_delay=0.5, max_jobs=1000):
+        """
+        Args:
+            bucket: Firebase Storage bucket
+            max_workers (int): Number of concurrent uploads
+            max_attempts (int): Attempts per blob before giving up
+            base_delay (float): First retry delay in seconds, doubled each retry
+            max_jobs (int): How many job statuses to remember
+        """
+        self.bucket = bucket
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = base_delay
+        self.max_jobs = max_jobs
+
+        self._executor = ThreadPoolExecutor(max_workers=max(1, int(max_workers)),
+                                            thread_name_prefix='firebase-upload')
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+
+    def submit(self, files):
+        """
+        Queue a group of uploads and return immediately
+
+        Args:
+            files (list): (key, storage_path, data, content_type) tuples,
+                where key names the URL in the job status (e.g. 'processed')
+
+        Returns:
+            str: Job ID to look up with status()
+        """
+        job = UploadJob(str(uuid.uuid4()), [key for key, _, _, _ in files])
+        with self._lock:
+            self._jobs[job.job_id] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+
+        for key, storage_path, data, content_type in files:
+            self._executor.submit(self._upload, job, key, storage_path, data, content_type)
+        return job.job_id
+
+    def status(self, job_id):
+        """Status dict for a job, or None if unknown"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job.to_dict() if job else None
+
+    def _upload(self, job, key, storage_path, data, content_type):
+        for attempt in range(1, self.max_attempts + 1):
+            with self._lock:
+                job.attempts[key] = attempt
+            started_at = time.perf_counter()
+            try:
+                blob = self.bucket.blob(storage_path)
+                cloud_client.call('storage.upload', blob.upload_from_string, data,
+                                  content_type=content_type, max_attempts=1)
+                # Make the blob publicly accessible
+                cloud_client.call('storage.metadata', blob.make_public, max_attempts=1)
+                url = blob.public_url
+                error = None
+                observe_stage('firebase_upload', time.perf_counter() - started_at)
+                break
+            except CloudUnavailable as e:
+                # Retrying before the circuit breaker's probe would fail the same way
+                error = str(e)
+                print(f"Upload of {storage_path} skipped: {e}")
+                break
+            except Exception as e:
+                error = str(e)
+                print(f"Upload of {storage_path} failed (attempt {attempt}/{self.max_attempts}): {e}")
+                if attempt < self.max_attempts:
+                    # Exponential backoff with jitter
+                    delay = self.base_delay * (2 ** (attempt - 1))
+                    time.sleep(delay * random.uniform(0.5, 1.5))
+
+        with self._lock:
+            if error is None:
+                job.urls[key] = url
+                print(f"Uploaded {key} image to {storage_path}")
+            else:
+                job.errors[key] = error
+            job.remaining -= 1
+            if not job.remaining:
+                job.finished_at = time.time()
@@ -0,0 +1,257 @@
+"""
+Pre-forked inference worker processes
+
+The model is loaded once in the parent process, its parameters are moved to
+shared memory and N worker processes are forked from it. The workers reuse the
+parent's weight pages instead of each holding its own copy. Forward passes are
+put on a single task queue that every worker pulls from, so each batch goes to
+whichever worker is idle first.
+"""
+
+import itertools
+import os
+import queue
+import threading
+import time
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+import metrics
+from cpu_threads import apply_threads, calibrate_threads, calibration_candidates
+from profiling import run_profiled
+
+
+def _configure_threads(worker_id, models, thread_plan):
+    """Apply the worker's thread plan, calibrating it if asked, and describe the result"""
+    apply_threads(thread_plan)
+    settings = {
+        'intraOpThreads': torch.get_num_threads(),
+        'interOpThreads': torch.get_num_interop_threads(),
+        'cpus': thread_plan.get('cpus'),
+    }
+
+    calibration_size = thread_plan.get('calibrationSize')
+    if calibration_size:
+        model = next(iter(models.values()))
+        image = torch.rand(3, *calibration_size)
+        threads, timings = calibrate_threads(lambda: model([image], with_masks=False),
+                                             calibration_candidates(thread_plan['intraOpThreads']))
+        # The calibration passes aren't requests, don't report their stages
+        metrics.take_observations()
+        settings.update(intraOpThreads=threads, calibration=timings)
+        print(f"Inference worker {worker_id} calibrated to {threads} threads: {timings}")
+    return settings
+
+
+def _worker_loop(worker_id, models, tasks, results, thread_plan=None):
+    """Run forward passes for batches taken from the task queue until told to stop"""
+    print(f"Inference worker {worker_id} started (pid {os.getpid()})")
+    # Stage timings are sent back to the server process with each result
+    metrics.start_buffering()
+    if thread_plan is not None:
+        results.put(('threads', None, (worker_id, _configure_threads(worker_id, models, thread_plan))))
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        task_id, key, image_tensors, kwargs = task
+        results.put(('started', task_id, worker_id))
+        trace_path = kwargs.pop('trace_path', None)
+        try:
+            with torch.no_grad():
+                if trace_path:
+                    predictions = run_profiled(lambda: models[key](image_tensors, **kwargs), trace_path)
+                else:
+                    predictions = models[key](image_tensors, **kwargs)
+            results.put(('metrics', task_id, metrics.take_observations()))
+            results.put(('done', task_id, predictions))
+        except Exception as e:
+            traceback.print_exc()
+            results.put(('metrics', task_id, metrics.take_observations()))
+            results.put(('error', task_id, f"{type(e).__name__}: {e}"))
+
+
+class _Task:
+    def __init__(self):
+        self.done = threading.Event()
+        self.worker_id = None
+        self.predictions = None
+        self.error = None
+
+
+class InferenceWorkerPool:
+    """
+    Dispatches batched forward passes to forked worker processes
+    """
+
+    def __init__(self, models, num_workers, thread_plans=None):
+        """
+        Args:
+            models (dict): Name -> loaded model in eval mode or inference
+                backend wrapping it (anything callable with a share_memory()
+                method). Entries may share weights, e.g. one per profile.
+            num_workers (int): Number of worker processes to fork
+            thread_plans (list, optional): Thread settings per worker, see
+                cpu_threads.plan_threads. An entry with a calibrationSize
+                (height, width) also calibrates its thread count.
+        """
+        self.models = models
+        self.num_workers = max(1, int(num_workers))
+        self.thread_plans = thread_plans
+        self._thread_settings = {}
+
+        # Parameters and buffers live in shared memory, so forked workers
+        # map the same pages instead of copying them
+        for model in self.models.values():
+            model.share_memory()
+
+        self._context = mp.get_context('fork')
+        self._tasks = self._context.Queue()
+        self._results = self._context.Queue()
+        self._task_ids = itertools.count()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._workers = {}
+        self._completed = 0
+        self._failed = 0
+        self._restarts = 0
+        self._closed = False
+
+        for worker_id in range(self.num_workers):
+            self._start_worker(worker_id)
+
+        self._listener = threading.Thread(target=self._listen, name='inference-pool-listener', daemon=True)
+        self._listener.start()
+        print(f"Started {self.num_workers} inference worker processes")
+
+    def forward(self, image_tensors, key, **kwargs):
+        """
+        Run one forward pass in the next idle worker
+
+        Args:
+            image_tensors (list): CHW image tensors
+            key (str): Which of the pool's models to run
+            **kwargs: Extra arguments for the model call (e.g. with_masks)
+
+        Returns:
+            list: Prediction dicts in the same order as image_tensors
+        """
+        task = _Task()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Inference worker pool is closed")
+            task_id = next(self._task_ids)
+            self._pending[task_id] = task
+
+        self._tasks.put((task_id, key, list(image_tensors), kwargs))
+        task.done.wait()
+
+        if task.error is not None:
+            raise RuntimeError(f"Inference worker failed: {task.error}")
+        return task.predictions
+
+    def stats(self):
+        """Worker counts and task totals"""
+        with self._lock:
+            busy = sum(1 for task in self._pending.values() if task.worker_id is not None)
+            return {
+                'workers': self.num_workers,
+                'alive': sum(1 for process in self._workers.values() if process.is_alive()),
+                'busy': busy,
+                'queued': len(self._pending) - busy,
+                'completed': self._completed,
+                'failed': self._failed,
+                'restarts': self._restarts,
+                'threads': {str(worker_id): settings
+                            for worker_id, settings in sorted(self._thread_settings.items())},
+            }
+
+    def worker_pids(self):
+        """Worker ID -> process ID of the live workers"""
+        with self._lock:
+            return {worker_id: process.pid for worker_id, process in self._workers.items()
+                    if process.is_alive()}
+
+    def close(self):
+        """Stop all workers"""
+        with self._lock:
+            self._closed = True
+            workers = list(self._workers.values())
+        for _ in workers:
+            self._tasks.put(None)
+        for process in workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+    def _start_worker(self, worker_id):
+        process = self._context.Process(
+            target=_worker_loop,
+            args=(worker_id, self.models, self._tasks, self._results,
+                  self.thread_plans[worker_id] if self.thread_plans else None),
+            name=f"inference-worker-{worker_id}",
+            daemon=True,
+        )
+        process.start()
+        self._workers[worker_id] = process
+
+    def _listen(self):
+        """Hand results back to waiting threads and replace dead workers"""
+        next_check = time.monotonic() + 1.0
+        while True:
+            if time.monotonic() >= next_check:
+                self._check_workers()
+                next_check = time.monotonic() + 1.0
+
+            try:
+                message = self._results.get(timeout=1.0)
+            except queue.Empty:
+                continue
+
+            kind, task_id, payload = message
+            if kind == 'metrics':
+                metrics.record_observations(payload)
+                continue
+            if kind == 'threads':
+                worker_id, settings = payload
+                with self._lock:
+                    self._thread_settings[worker_id] = settings
+                continue
+            with self._lock:
+                task = self._pending.get(task_id)
+                if task is None:
+                    continue
+                if kind == 'started':
+                    task.worker_id = payload
+                    continue
+                del self._pending[task_id]
+                if kind == 'done':
+                    task.predictions = payload
+                    self._completed += 1
+                else:
+                    task.error = payload
+                    self._failed += 1
+            task.done.set()
+
+    def _check_workers(self):
+        with self._lock:
+            if self._closed:
+                return
+            dead = [worker_id for worker_id, process in self._workers.items() if not process.is_alive()]
+            for worker_id in dead:
+                exitcode = self._workers[worker_id].exitcode
+                print(f"Inference worker {worker_id} exited with code {exitcode}, restarting")
+
+                # Fail whatever the dead worker was running
+                for task_id, task in list(self._pending.items()):
+                    if task.worker_id == worker_id:
+                        del self._pending[task_id]
+                        task.error = f"worker {worker_id} exited with code {exitcode}"
+                        self._failed += 1
+                        task.done.set()
+
+                self._start_worker(worker_id)
+                self._restarts += 1